@@ -9,6 +9,9 @@ import data_blob
 import encoding
 import utils
 import mp_pool
+import scheduler
+import controller
+import change_feed
 try:
     import logger
     import log_manager
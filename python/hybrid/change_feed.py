@@ -0,0 +1,311 @@
+"""
+Change feeds let the manager react to new documents as they are written
+instead of re-querying its view every iteration_sleep seconds. A feed tails
+the input database (CouchDB _changes, a MongoDB change stream or tailable
+cursor, or an _id high water mark), hands back the uuids of documents that
+have all of the input tags and none of the output tags, and checkpoints its
+position in the database so a restarted manager resumes where it left off.
+"""
+"""
+Copyright 2017 Sandia Corporation.
+Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
+the U.S. Government retains certain rights in this software.
+"""
+import collections
+import logging
+import time
+
+import pymongo
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checkpoint writes while changes are flowing
+CHECKPOINT_INTERVAL = 10
+
+
+def create_change_feed(database, input_tags, output_tags, **kwargs):
+    """ Create the change feed for the type of database, None if it can't be tailed """
+    if isinstance(database, db.mongodb):
+        if database._use_gridfs:
+            logger.warning("Change feeds are not supported for GridFS backed collections")
+            return None
+        return mongo_change_feed(database, input_tags, output_tags, **kwargs)
+    elif isinstance(database, db.couchdb):
+        return couch_change_feed(database, input_tags, output_tags, **kwargs)
+    return None
+
+
+class change_feed(object):
+    """
+    Common bookkeeping for the change feeds. Subclasses provide
+    read_changes, loadCheckpoint, currentPosition and storeCheckpoint.
+
+    The checkpoint only moves past a batch of changes once none of its
+    documents are still being processed, so documents that were in flight
+    when the manager stopped are handed out again after a restart.
+    """
+
+    def __init__(self, database, input_tags, output_tags, **kwargs):
+        """
+        change_feed constructor
+
+        Parameters:
+            database:            db.couchdb or db.mongodb instance to tail
+            input_tags:          fields a document must have to be processed
+            output_tags:         fields that mark a document as already processed
+            checkpoint_id:       name the feed position is stored under
+            timeout:             seconds poll waits for new changes
+            checkpoint_interval: seconds between checkpoint writes
+        """
+        self._database = database
+        self._input_tags = list(input_tags or [])
+        self._output_tags = list(output_tags or [])
+        self._checkpoint_id = kwargs.get("checkpoint_id", "hybrid_change_feed")
+        self._timeout = kwargs.get("timeout", 5)
+        self._checkpoint_interval = kwargs.get("checkpoint_interval", CHECKPOINT_INTERVAL)
+
+        # (position, uuids) for every batch handed out that may still be processing
+        self._pending = collections.deque()
+        self._position = self.loadCheckpoint()
+        if self._position is None:
+            # First run: the manager's initial view poll picks up everything already in the database
+            self._position = self.currentPosition()
+        self._checkpoint = self._position
+        self._checkpoint_time = time.time()
+
+    @property
+    def position(self):
+        return self._position
+
+    def matches(self, doc):
+        """ True if the raw document still needs processing """
+        for tag in self._input_tags:
+            if tag not in doc:
+                return False
+        for tag in self._output_tags:
+            if tag in doc:
+                return False
+        return True
+
+    def poll(self, limit=None):
+        """ Wait up to timeout seconds for changes and return the uuids of the changed documents
+            that need processing (at most limit of them) """
+        position, uuids = self.read_changes(limit)
+        if uuids:
+            self._pending.append((position, set(uuids)))
+        self._position = position
+        return uuids
+
+    def acknowledge(self, in_flight_uuids, force=False):
+        """ Checkpoint past every batch none of whose documents are still in flight """
+        checkpoint = self._checkpoint
+        while self._pending and not (self._pending[0][1] & in_flight_uuids):
+            checkpoint = self._pending.popleft()[0]
+        if not self._pending:
+            checkpoint = self._position
+
+        if checkpoint == self._checkpoint:
+            return
+        if not force and (time.time() - self._checkpoint_time) < self._checkpoint_interval:
+            return
+
+        try:
+            self.storeCheckpoint(checkpoint)
+            self._checkpoint = checkpoint
+            self._checkpoint_time = time.time()
+        except Exception:
+            logger.exception("Could not store change feed checkpoint %s" % (self._checkpoint_id,))
+
+    def close(self, in_flight_uuids=frozenset()):
+        """ Store the final checkpoint """
+        self.acknowledge(set(in_flight_uuids), force=True)
+
+    def read_changes(self, limit):
+        """ Return (position, uuids) for the next changes after the current position """
+        raise NotImplementedError("This method should be overloaded by the subclass.")
+
+    def loadCheckpoint(self):
+        """ Return the stored position, None if there is no checkpoint yet """
+        raise NotImplementedError("This method should be overloaded by the subclass.")
+
+    def currentPosition(self):
+        """ Return the position of the newest change in the database """
+        raise NotImplementedError("This method should be overloaded by the subclass.")
+
+    def storeCheckpoint(self, position):
+        raise NotImplementedError("This method should be overloaded by the subclass.")
+
+
+class couch_change_feed(change_feed):
+    """
+    Long polls the CouchDB _changes feed. The checkpoint is the update
+    sequence, stored in a _local document so it is never replicated and
+    never shows up in views.
+    """
+
+    def __init__(self, database, input_tags, output_tags, **kwargs):
+        self._raw_db = database._raw_db
+        change_feed.__init__(self, database, input_tags, output_tags, **kwargs)
+
+    def checkpoint_doc_id(self):
+        return "_local/" + self._checkpoint_id
+
+    def loadCheckpoint(self):
+        doc = self._raw_db.get(self.checkpoint_doc_id())
+        if doc is None:
+            return None
+        return doc.get("since")
+
+    def currentPosition(self):
+        return self._raw_db.info().get("update_seq", 0)
+
+    def storeCheckpoint(self, position):
+        doc = self._raw_db.get(self.checkpoint_doc_id())
+        if doc is None:
+            doc = {"_id": self.checkpoint_doc_id()}
+        doc["since"] = position
+        self._raw_db.save(doc)
+
+    def read_changes(self, limit):
+        params = {"feed": "longpoll", "since": self._position, "timeout": int(self._timeout * 1000),
+                  "include_docs": "true"}
+        if limit:
+            params["limit"] = limit
+        result = self._raw_db.changes(**params)
+
+        uuids = []
+        for change in result.get("results", []):
+            doc_id = change.get("id")
+            if change.get("deleted") or doc_id is None or doc_id.startswith("_"):
+                continue
+            doc = change.get("doc")
+            if doc is not None and self.matches(doc):
+                uuids.append(doc_id)
+
+        return result.get("last_seq", self._position), uuids
+
+
+class mongo_change_feed(change_feed):
+    """
+    Tails a MongoDB collection. Uses a change stream when pymongo and the
+    server support one (the checkpoint is the resume token), a tailable
+    cursor on capped collections, and otherwise polls for documents past an
+    ObjectId high water mark (the checkpoint is the last _id seen).
+
+    The ObjectId modes only see inserts; storeDataBlob and the bulk store
+    replace documents in place under their original _id, so updates are seen
+    by change streams and otherwise picked up by the manager's fallback view
+    poll.
+    """
+
+    CHECKPOINT_COLLECTION = "hybrid_checkpoints"
+
+    def __init__(self, database, input_tags, output_tags, **kwargs):
+        self._collection = database._raw_collection
+        self._checkpoints = database._raw_db[self.CHECKPOINT_COLLECTION]
+        self._poll_interval = kwargs.get("poll_interval", 0.5)
+        self._stream = None
+        self._cursor = None
+        self._capped = self._collection.options().get("capped", False)
+        self._use_stream = hasattr(self._collection, "watch") and not self._capped
+        change_feed.__init__(self, database, input_tags, output_tags, **kwargs)
+
+    def loadCheckpoint(self):
+        doc = self._checkpoints.find_one({"_id": self._checkpoint_id})
+        if doc is None:
+            return None
+        return doc.get("since")
+
+    def currentPosition(self):
+        # Change streams start from now when they have no resume token
+        if self._use_stream:
+            return None
+        newest = list(self._collection.find({}, {"_id": 1}).sort("_id", pymongo.DESCENDING).limit(1))
+        if len(newest) == 0:
+            return None
+        return newest[0]["_id"]
+
+    def storeCheckpoint(self, position):
+        self._checkpoints.update({"_id": self._checkpoint_id}, {"$set": {"since": position}}, upsert=True)
+
+    def query(self):
+        query = {}
+        for tag in self._input_tags:
+            query[tag] = {"$exists": True}
+        for tag in self._output_tags:
+            query[tag] = {"$exists": False}
+        return query
+
+    def read_changes(self, limit):
+        if self._use_stream:
+            try:
+                return self.read_change_stream(limit)
+            except pymongo.errors.OperationFailure:
+                # Standalone servers have no change streams
+                logger.warning("Change streams not available, falling back to polling on _id")
+                self._use_stream = False
+                self._stream = None
+                if isinstance(self._position, dict):
+                    self._position = None
+        if self._capped:
+            return self.read_tailable_cursor(limit)
+        return self.read_high_water_mark(limit)
+
+    def read_change_stream(self, limit):
+        if self._stream is None:
+            kwargs = {"full_document": "updateLookup", "max_await_time_ms": int(self._timeout * 1000)}
+            if isinstance(self._position, dict):
+                kwargs["resume_after"] = self._position
+            self._stream = self._collection.watch(**kwargs)
+
+        position = self._position
+        uuids = []
+        while limit is None or len(uuids) < limit:
+            change = self._stream.try_next()
+            if change is None:
+                break
+            position = change["_id"]
+            doc = change.get("fullDocument")
+            if doc is not None and self.matches(doc) and doc.get("_dataBlobID") is not None:
+                uuids.append(doc.get("_dataBlobID"))
+        return position, uuids
+
+    def read_tailable_cursor(self, limit):
+        if self._cursor is None or not self._cursor.alive:
+            query = self.query()
+            if self._position is not None:
+                query["_id"] = {"$gt": self._position}
+            self._cursor = self._collection.find(query, tailable=True, await_data=True)
+
+        position = self._position
+        uuids = []
+        for doc in self._cursor:
+            position = doc["_id"]
+            if doc.get("_dataBlobID") is not None:
+                uuids.append(doc.get("_dataBlobID"))
+            if limit and len(uuids) >= limit:
+                break
+        return position, uuids
+
+    def read_high_water_mark(self, limit):
+        query = self.query()
+        deadline = time.time() + self._timeout
+        while True:
+            if self._position is not None:
+                query["_id"] = {"$gt": self._position}
+            cursor = self._collection.find(query).sort("_id", pymongo.ASCENDING)
+            if limit:
+                cursor = cursor.limit(limit)
+
+            position = self._position
+            uuids = []
+            for doc in cursor:
+                position = doc["_id"]
+                if doc.get("_dataBlobID") is not None:
+                    uuids.append(doc.get("_dataBlobID"))
+
+            if uuids or time.time() >= deadline:
+                return position, uuids
+            time.sleep(self._poll_interval)
@@ -0,0 +1,253 @@
+"""
+adaptive_controller tunes how many tasks the manager keeps in flight and how
+many documents go into each task, from what the manager sees while it runs:
+whether its queries come back full (a backlog), how long each document takes
+and how often database requests or tasks fail. task_cost_model learns from the
+same task timings how much of a task's time goes to each document and how much
+to each byte of it, to weigh documents when they are split into tasks.
+"""
+"""
+Copyright 2017 Sandia Corporation.
+Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
+the U.S. Government retains certain rights in this software.
+"""
+import logging
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+
+class adaptive_controller(object):
+    """
+    Additive increase / multiplicative decrease on the number of tasks in
+    flight, with the batch size steered toward target_task_seconds of work
+    per task.
+
+    Every window observations (completed tasks, fetches and errors) the
+    controller makes one adjustment:
+        - errors above error_threshold: halve both, the database is struggling
+        - per document time above latency_tolerance times the best seen: one
+          task fewer in flight, more concurrency only makes each task slower
+        - a backlog: one task more in flight, and batches sized for
+          target_task_seconds
+        - no backlog (live traffic): smaller batches, so the few documents
+          that arrive are spread over the pool and finish sooner
+    """
+
+    def __init__(self, min_outstanding, max_outstanding, min_batch_size, max_batch_size, **kwargs):
+        """
+        adaptive_controller constructor
+
+        Parameters:
+            min_outstanding:     fewest tasks kept in flight
+            max_outstanding:     most tasks kept in flight
+            min_batch_size:      fewest documents per task
+            max_batch_size:      most documents per task
+            outstanding:         starting number of tasks in flight (defaults to min_outstanding)
+            batch_size:          starting documents per task (defaults to min_batch_size)
+            target_task_seconds: seconds of work wanted per task while there is a backlog
+            error_threshold:     fraction of failed requests/tasks that triggers a back off
+            latency_tolerance:   per document slow down (over the best seen) that counts as congestion
+            window:              observations between adjustments
+            smoothing:           weight of the newest sample in the per document time average
+        """
+        self._min_outstanding = max(1, min_outstanding)
+        self._max_outstanding = max(self._min_outstanding, max_outstanding)
+        self._min_batch_size = max(1, min_batch_size)
+        self._max_batch_size = max(self._min_batch_size, max_batch_size)
+        self._outstanding = self.clamp(kwargs.get("outstanding", self._min_outstanding), self._min_outstanding,
+                                       self._max_outstanding)
+        self._batch_size = self.clamp(kwargs.get("batch_size", self._min_batch_size), self._min_batch_size,
+                                      self._max_batch_size)
+        self._target_task_seconds = kwargs.get("target_task_seconds", 30.0)
+        self._error_threshold = kwargs.get("error_threshold", 0.1)
+        self._latency_tolerance = kwargs.get("latency_tolerance", 1.5)
+        self._window = kwargs.get("window", 4)
+        self._smoothing = kwargs.get("smoothing", 0.3)
+
+        # Observations since the last adjustment
+        self._num_observations = 0
+        self._num_requests = 0
+        self._num_errors = 0
+        self._backlog = False
+
+        # Smoothed and best seconds per document
+        self._doc_seconds = None
+        self._best_doc_seconds = None
+
+    @staticmethod
+    def clamp(value, low, high):
+        return max(low, min(high, int(value)))
+
+    @property
+    def outstanding(self):
+        return self._outstanding
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    @property
+    def doc_seconds(self):
+        return self._doc_seconds
+
+    def record_task(self, num_docs, elapsed, successful):
+        """ A task of num_docs documents finished after elapsed seconds """
+        self._num_observations += 1
+        self._num_requests += 1
+        if not successful:
+            self._num_errors += 1
+            return
+        if num_docs <= 0:
+            return
+        doc_seconds = float(elapsed) / num_docs
+        if self._doc_seconds is None:
+            self._doc_seconds = doc_seconds
+        else:
+            self._doc_seconds += self._smoothing * (doc_seconds - self._doc_seconds)
+
+    def record_fetch(self, num_fetched, limit):
+        """ A query for up to limit documents returned num_fetched, a full page means there is a backlog """
+        self._num_observations += 1
+        self._num_requests += 1
+        self._backlog = limit is not None and num_fetched >= limit
+
+    def record_error(self):
+        """ A database request failed """
+        self._num_observations += 1
+        self._num_requests += 1
+        self._num_errors += 1
+
+    def update(self):
+        """ Make an adjustment once window observations have come in, returns True if a setting changed """
+        if self._num_observations < self._window:
+            return False
+
+        outstanding = self._outstanding
+        batch_size = self._batch_size
+        error_rate = float(self._num_errors) / max(1, self._num_requests)
+
+        if error_rate > self._error_threshold:
+            reason = "error rate %.2f" % (error_rate,)
+            outstanding /= 2
+            batch_size /= 2
+        elif self.congested() and outstanding > self._min_outstanding:
+            reason = "%.3fs per document, best %.3fs" % (self._doc_seconds, self._best_doc_seconds)
+            outstanding -= 1
+        elif self._backlog:
+            reason = "backlog"
+            outstanding += 1
+            if self._doc_seconds:
+                target = self._target_task_seconds / self._doc_seconds
+                batch_size += (target - batch_size) / 2
+        else:
+            reason = "no backlog"
+            batch_size = batch_size * 3 / 4
+
+        if self._doc_seconds is not None:
+            # Let the baseline drift up slowly, the documents themselves may have got bigger
+            if self._best_doc_seconds is None:
+                self._best_doc_seconds = self._doc_seconds
+            else:
+                self._best_doc_seconds = min(self._best_doc_seconds * 1.1, self._doc_seconds)
+
+        self._num_observations = 0
+        self._num_requests = 0
+        self._num_errors = 0
+
+        outstanding = self.clamp(outstanding, self._min_outstanding, self._max_outstanding)
+        batch_size = self.clamp(batch_size, self._min_batch_size, self._max_batch_size)
+        if outstanding == self._outstanding and batch_size == self._batch_size:
+            return False
+
+        logger.info("Adjusting to %d task(s) in flight of %d docs (was %d of %d): %s" % (
+            outstanding, batch_size, self._outstanding, self._batch_size, reason))
+        self._outstanding = outstanding
+        self._batch_size = batch_size
+        return True
+
+    def congested(self):
+        if self._doc_seconds is None or self._best_doc_seconds is None:
+            return False
+        return self._doc_seconds > self._latency_tolerance * self._best_doc_seconds
+
+    def __str__(self):
+        s = 80 * "=" + "\n"
+        s += "adaptive_controller\n"
+        s += "\tin flight: %d [%d, %d]\n" % (self._outstanding, self._min_outstanding, self._max_outstanding)
+        s += "\tbatch size: %d [%d, %d]\n" % (self._batch_size, self._min_batch_size, self._max_batch_size)
+        s += "\tseconds per doc: %s\n" % (self._doc_seconds,)
+        s += 80 * "=" + "\n"
+        return s
+
+
+class task_cost_model(object):
+    """
+    Fits elapsed = per_doc * num_docs + per_unit * size over the finished
+    tasks (least squares, older tasks decayed away) so documents can be
+    weighed by what they actually cost: per_doc / per_unit size units of
+    overhead plus their size estimate. Until min_tasks tasks have come in,
+    or if the fit makes no sense, documents weigh utils.DOCUMENT_OVERHEAD
+    plus their size.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        task_cost_model constructor
+
+        Parameters:
+            decay:     weight kept by the older tasks each time a task finishes
+            min_tasks: tasks to see before trusting the fit
+        """
+        self._decay = kwargs.get("decay", 0.95)
+        self._min_tasks = kwargs.get("min_tasks", 4)
+        self._num_tasks = 0
+
+        # Decayed sums for the normal equations
+        self._docs_docs = 0.0
+        self._docs_size = 0.0
+        self._size_size = 0.0
+        self._docs_time = 0.0
+        self._size_time = 0.0
+
+        self._overhead = utils.DOCUMENT_OVERHEAD
+
+    @property
+    def overhead(self):
+        """ Size units a document costs before its size is counted, None if size doesn't matter """
+        return self._overhead
+
+    def record_task(self, num_docs, size, elapsed):
+        """ A task of num_docs documents adding up to size finished in elapsed seconds """
+        if num_docs <= 0:
+            return
+        decay = self._decay
+        self._docs_docs = decay * self._docs_docs + num_docs * num_docs
+        self._docs_size = decay * self._docs_size + num_docs * size
+        self._size_size = decay * self._size_size + size * size
+        self._docs_time = decay * self._docs_time + num_docs * elapsed
+        self._size_time = decay * self._size_time + size * elapsed
+        self._num_tasks += 1
+        if self._num_tasks >= self._min_tasks:
+            self.fit()
+
+    def fit(self):
+        determinant = self._docs_docs * self._size_size - self._docs_size * self._docs_size
+        if determinant <= 1e-9 * self._docs_docs * self._size_size:
+            # Every task had the same size per document, nothing to tell the two apart
+            return
+        per_doc = (self._size_size * self._docs_time - self._docs_size * self._size_time) / determinant
+        per_unit = (self._docs_docs * self._size_time - self._docs_size * self._docs_time) / determinant
+
+        if per_unit <= 0:
+            if per_doc > 0:
+                self._overhead = None
+            return
+        self._overhead = max(0.0, per_doc / per_unit)
+
+    def weight(self, size):
+        """ Weight of a document with the given size estimate """
+        if self._overhead is None:
+            return 1
+        return self._overhead + size
@@ -4,9 +4,14 @@ Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
 the U.S. Government retains certain rights in this software.
 """
 import base64
+import collections
+import copy
 import datetime
+import hashlib
+import json
 import logging
 import sys
+import threading
 from uuid import uuid4
 
 import encoding
@@ -28,6 +33,99 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+class attachment_cache():
+    """ Per-process LRU of attachment payloads fetched through binary stubs, bounded by a byte
+        budget. Entries are keyed on the attachment digest so a changed attachment is never served
+        from the cache. A budget of 0 turns the cache off. Workers of a level share it from several
+        threads (see manager.evaluateWorkerLevels), so every access holds the lock. """
+
+    def __init__(self, max_bytes=0):
+        self._max_bytes = max_bytes
+        self._num_bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def setMaxBytes(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def getNumBytes(self):
+        return self._num_bytes
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                # Most recently used goes to the end
+                self._entries[key] = data
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            if key in self._entries:
+                self._num_bytes -= len(self._entries.pop(key))
+            if len(data) > self._max_bytes:
+                return
+            self._entries[key] = data
+            self._num_bytes += len(data)
+            self._evict()
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        while self._entries and self._num_bytes > self._max_bytes:
+            key, data = self._entries.popitem(last=False)
+            self._num_bytes -= len(data)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+
+_attachment_cache = attachment_cache()
+
+
+def setAttachmentCacheBudget(max_bytes):
+    """ Set the number of bytes of lazily loaded attachments kept per process (0 disables the cache) """
+    _attachment_cache.setMaxBytes(max_bytes)
+
+
+def binaryDigest(data):
+    """ md5 hex digest of binary field data (unicode data is digested as utf-8) """
+    if isinstance(data, unicode):
+        data = data.encode("utf-8")
+    return hashlib.md5(data).hexdigest()
+
+
+# Bookkeeping fields owned by the databases, never written through partial updates
+UNTRACKED_FIELDS = frozenset(["_id", "_rev", "_attachments", "_dataBlobID"])
+
+
+def metaDataDigest(value):
+    """ md5 hex digest of a meta data value, used to notice fields that were changed in place """
+    try:
+        serialized = json.dumps(value, sort_keys=True, default=repr)
+    except ValueError:
+        # Byte strings that aren't utf-8
+        serialized = repr(value)
+    return hashlib.md5(serialized).hexdigest()
+
+
+def metaDataSize(value):
+    """ Rough number of characters in a meta data value: string lengths, summed through lists and dicts """
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(key) + metaDataSize(item) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return sum(metaDataSize(item) for item in value)
+    return 8
+
+
 def create(uuid=None, **kwargs):
     """ Create a data blob of a particular type.
         Input:
@@ -82,7 +180,7 @@ def dict2blob(in_dict, **kwargs):
     return blob
 
 
-def blob2dict(blob):
+def blob2dict(blob, include_binary=True):
     # Validate the data blob
     blob.validate()
 
@@ -111,9 +209,10 @@ def blob2dict(blob):
         out_dict[k] = v
 
     attachment_dict = {}
-    for k, v in blob.getBinaryDataDict().iteritems():
-        attachment_dict[k] = {"content_type": v["mime_type"],
-                              "data": base64.b64encode(v["data"])}
+    if include_binary:
+        for k, v in blob.getBinaryDataDict().iteritems():
+            attachment_dict[k] = {"content_type": v["mime_type"],
+                                  "data": base64.b64encode(v["data"])}
 
     if attachment_dict != {}:
         out_dict["_attachments"] = attachment_dict
@@ -150,6 +249,27 @@ class data_blob():
         self._meta_data = {"_dataBlobID": uuid}
         self._binary_data = {}
 
+        # Binary fields known by name, mime type, length and digest only, pulled through the loader on
+        # first access
+        self._binary_stubs = {}
+        self._binary_loader = None
+
+        # md5 of each binary field as the database last stored it, to skip re-uploading unchanged data
+        self._binary_digests = {}
+
+        # Binary fields (and stubs) the blob had when it was made a workingCopy, to merge back only the
+        # fields the copy changed or deleted
+        self._working_binary_data = {}
+        self._working_binary_stubs = {}
+
+        # Meta data paths set or deleted since the blob was loaded from (or stored to) _tracked_db, and a
+        # digest of each top level field as it was then. Nothing is tracked until a database asks for it.
+        self._tracked_db = None
+        self._tracked_uuid = None
+        self._stored_digests = {}
+        self._set_paths = set()
+        self._unset_paths = set()
+
         # Validator information
         self._required_meta_fields = []
         self._required_binary_fields = []
@@ -316,6 +436,8 @@ class data_blob():
 
         # meta_data_dict[final_field] = encoding.convertToUnicode(value)
         meta_data_dict[final_field] = value
+        self._set_paths.add(field)
+        self._unset_paths.discard(field)
 
     #
     #     ''' Add meta data to the data blob, regardless of whether it has the field already '''
@@ -381,12 +503,14 @@ class data_blob():
                 return False
             else:
                 del f[field_array[1]]
-                return True
         else:
-            if field in self._meta_data:
-                del self._meta_data[field]
-                return True
-            return False
+            if field not in self._meta_data:
+                return False
+            del self._meta_data[field]
+
+        self._unset_paths.add(field)
+        self._set_paths.discard(field)
+        return True
 
     def setBinaryData(self, field, mime_type, data):
         """ Add binary data to the data blob, if the data is a vtk object then
@@ -413,6 +537,188 @@ class data_blob():
         # Store the serialized data
         data = {"mime_type": mime_type, "data": serialize_data}
         self._binary_data[field] = data
+        self._binary_stubs.pop(field, None)
+
+    def setBinaryDataStub(self, field, mime_type, length=None, digest=None):
+        """ Record a binary field without its data, the data is pulled through the binary data
+            loader the first time the field is accessed """
+        self._binary_stubs[field] = {"mime_type": mime_type, "length": length, "digest": digest}
+        self._binary_data.pop(field, None)
+
+    def deleteBinaryData(self, field):
+        """ Remove a binary field (loaded or stubbed) from the data blob """
+        if not self.hasBinaryData(field):
+            raise KeyError("No binary data field", field)
+        self._binary_data.pop(field, None)
+        self._binary_stubs.pop(field, None)
+        self._binary_digests.pop(field, None)
+
+    def setBinaryDataLoader(self, loader):
+        """ Set the function called as loader(field) to fetch the raw data of a stubbed binary field """
+        self._binary_loader = loader
+
+    def getBinaryDataStubs(self):
+        """ Returns the stubs of the binary fields that haven't been loaded yet """
+        return self._binary_stubs
+
+    def loadBinaryDataStub(self, field):
+        """ Fetch the data for a stubbed binary field (from the attachment cache if possible) """
+        stub = self._binary_stubs[field]
+        cache_key = None
+        if stub["digest"] is not None:
+            cache_key = (self._uuid, field, stub["digest"])
+
+        data = None
+        if cache_key is not None:
+            data = _attachment_cache.get(cache_key)
+        if data is None:
+            if self._binary_loader is None:
+                raise RuntimeError("No loader for binary field " + field)
+            data = self._binary_loader(field)
+            if cache_key is not None:
+                _attachment_cache.put(cache_key, data)
+
+        self._binary_data[field] = {"mime_type": stub["mime_type"], "data": data}
+        del self._binary_stubs[field]
+        self.markBinaryDataStored(field)
+
+    def markBinaryDataStored(self, field=None):
+        """ Record the loaded binary field (all of them if field is None) as matching what the database holds """
+        if field is None:
+            fields = self._binary_data.keys()
+        else:
+            fields = [field]
+        for field in fields:
+            self._binary_digests[field] = binaryDigest(self._binary_data[field]["data"])
+
+    def isBinaryDataStored(self, field):
+        """ True if the binary field is unchanged since it was loaded from (or stored to) the database """
+        if field in self._binary_stubs:
+            return True
+        if field not in self._binary_data or field not in self._binary_digests:
+            return False
+        return binaryDigest(self._binary_data[field]["data"]) == self._binary_digests[field]
+
+    def getChangedBinaryFields(self):
+        """ Returns the loaded binary fields that differ from what the database last stored """
+        return [field for field in self._binary_data.keys() if not self.isBinaryDataStored(field)]
+
+    def markMetaDataStored(self, db):
+        """ Record the meta data as matching what db holds and start tracking changes against it """
+        self._tracked_db = db
+        self._tracked_uuid = self._uuid
+        self._stored_digests = {}
+        for field, value in self._meta_data.iteritems():
+            if field not in UNTRACKED_FIELDS:
+                self._stored_digests[field] = metaDataDigest(value)
+        self._set_paths = set()
+        self._unset_paths = set()
+
+    def getMetaDataChanges(self, db):
+        """
+        Meta data changed since the blob was loaded from (or stored to) db, as a ({path: value} dict of
+        fields to set, list of paths to delete) tuple, with nested paths ':' separated. Returns None when
+        the changes aren't known and the whole document has to be written.
+
+        Paths set or deleted through setMetaData/deleteMetaData are reported as they are. Top level
+        fields that weren't touched through those but whose value was changed in place (or replaced with
+        setMetaDataDict) are found by comparing digests and reported whole.
+        """
+        if self._tracked_db is None or self._tracked_db is not db or self._tracked_uuid != self._uuid:
+            return None
+
+        set_paths = set(self._set_paths)
+        unset_paths = set(self._unset_paths)
+        touched = set(path.split(':', 1)[0] for path in set_paths | unset_paths)
+        for field, value in self._meta_data.iteritems():
+            if field in UNTRACKED_FIELDS or field in touched:
+                continue
+            if self._stored_digests.get(field) != metaDataDigest(value):
+                set_paths.add(field)
+        for field in self._stored_digests:
+            if field not in self._meta_data and field not in touched:
+                unset_paths.add(field)
+
+        # A path below another changed path is already covered by it
+        changed = set_paths | unset_paths
+
+        def covered(path):
+            parts = path.split(':')
+            return any(':'.join(parts[:i]) in changed for i in range(1, len(parts)))
+
+        set_fields = {}
+        for path in set_paths:
+            if path.split(':', 1)[0] in UNTRACKED_FIELDS or covered(path):
+                continue
+            try:
+                set_fields[path] = self.getMetaData(path)
+            except (KeyError, IndexError, TypeError, ValueError):
+                unset_paths.add(path)
+        unset_fields = sorted(path for path in unset_paths
+                              if path.split(':', 1)[0] not in UNTRACKED_FIELDS and not covered(path))
+
+        return set_fields, unset_fields
+
+    def workingCopy(self):
+        """
+        Copy of the blob for one of several workers processing it at the same time: its own meta data (deep
+        copied) and binary field dictionaries, the binary data itself shared. The copy tracks its changes
+        against this blob so mergeChanges can bring them back.
+        """
+        blob_copy = self.clone()
+        blob_copy.markMetaDataStored(self)
+        blob_copy._working_binary_data = dict(self._binary_data)
+        blob_copy._working_binary_stubs = dict(self._binary_stubs)
+        return blob_copy
+
+    def clone(self):
+        """
+        Independent copy of the blob: its own meta data (deep copied), binary field dictionaries and change
+        tracking. Only the binary data itself is shared, binary fields are replaced rather than changed in
+        place.
+        """
+        blob_copy = copy.copy(self)
+        blob_copy._meta_data = copy.deepcopy(self._meta_data)
+        blob_copy._binary_data = dict(self._binary_data)
+        blob_copy._binary_stubs = dict(self._binary_stubs)
+        blob_copy._binary_digests = dict(self._binary_digests)
+        blob_copy._working_binary_data = dict(self._working_binary_data)
+        blob_copy._working_binary_stubs = dict(self._working_binary_stubs)
+        blob_copy._db_view_info = dict(self._db_view_info)
+        blob_copy._stored_digests = dict(self._stored_digests)
+        blob_copy._set_paths = set(self._set_paths)
+        blob_copy._unset_paths = set(self._unset_paths)
+        blob_copy._required_meta_fields = list(self._required_meta_fields)
+        blob_copy._required_binary_fields = list(self._required_binary_fields)
+        return blob_copy
+
+    def mergeChanges(self, blob_copy):
+        """ Apply the meta data and binary fields changed (or deleted) in a workingCopy of this blob """
+        set_fields, unset_fields = blob_copy.getMetaDataChanges(self)
+        for path in unset_fields:
+            if self.hasMetaData(path):
+                self.deleteMetaData(path)
+        for path in sorted(set_fields.keys()):
+            self.setMetaData(path, set_fields[path])
+
+        # Fields the copy left as they were are skipped, another copy merged earlier may have changed them
+        for field, binary in blob_copy._binary_data.iteritems():
+            if blob_copy._working_binary_data.get(field) is binary:
+                continue
+            if field in blob_copy._working_binary_stubs and blob_copy.isBinaryDataStored(field):
+                # A stub the copy only loaded is still what the database holds, keep the data if the stub is
+                if self._binary_stubs.get(field) is blob_copy._working_binary_stubs[field]:
+                    self._binary_data[field] = binary
+                    del self._binary_stubs[field]
+                    self._binary_digests[field] = blob_copy._binary_digests[field]
+                continue
+            self._binary_data[field] = binary
+            self._binary_stubs.pop(field, None)
+            self._binary_digests.pop(field, None)
+
+        for field in set(blob_copy._working_binary_data) | set(blob_copy._working_binary_stubs):
+            if not blob_copy.hasBinaryData(field) and self.hasBinaryData(field):
+                self.deleteBinaryData(field)
 
     def getBinaryDataMimeType(self, field):
         """
@@ -420,6 +726,8 @@ class data_blob():
         """
         if field in self._binary_data:
             return self._binary_data[field]["mime_type"]
+        elif field in self._binary_stubs:
+            return self._binary_stubs[field]["mime_type"]
         else:
             raise KeyError("No binary data field", field)
 
@@ -428,7 +736,7 @@ class data_blob():
         Just a check on a binary field from the data blob
         """
         # Do we have the binary field
-        return (field in self._binary_data)
+        return (field in self._binary_data) or (field in self._binary_stubs)
 
     def getBinaryData(self, field, mime_type=None):
         """
@@ -440,6 +748,9 @@ class data_blob():
 
         # logger.debug("Looking for binary field %s with value %s" % (field, self._binary_data))
 
+        if field in self._binary_stubs:
+            self.loadBinaryDataStub(field)
+
         # Do we have the binary field
         if field in self._binary_data:
             # If they haven't specified a mime type then de-serialize the object and return
@@ -481,12 +792,29 @@ class data_blob():
         self._meta_data = meta_data.copy()
         return
 
-    def getBinaryDataDict(self):
+    def getBinaryDataDict(self, load_stubs=True):
         """
-        Returns the binary data dictionary
+        Returns the binary data dictionary, loading any stubbed fields first unless load_stubs is False
         """
+        if load_stubs:
+            for field in self._binary_stubs.keys():
+                self.loadBinaryDataStub(field)
         return self._binary_data
 
+    def getSizeEstimate(self):
+        """
+        Cheap estimate of the work in the blob: bytes of binary data (from the stub lengths for fields that
+        aren't loaded) plus characters of meta data. Returns None if a stub has no length.
+        """
+        size = metaDataSize(self._meta_data)
+        for field, stub in self._binary_stubs.iteritems():
+            if stub["length"] is None:
+                return None
+            size += stub["length"]
+        for field, binary in self._binary_data.iteritems():
+            size += len(binary["data"])
+        return size
+
     def getCreationDate(self):
         return self._creation_date
 
@@ -604,19 +932,19 @@ class data_blob():
             if blob is None:
                 raise RuntimeError("Empty binary field:" + field)
 
-        # Couch freaks out on field names that start with an underscore
-        binary = self.getBinaryDataDict()
-        names_to_fix = []
-        for k, v in binary.iteritems():
-            if k[0] == "_":
-                names_to_fix.append(k)
-
-        for name in names_to_fix:
-            logger.warning(
-                self.getDataBlobUUID() + "(" + self.getDataBlobType() + ") Validation error:" + "Field name that starts with an underscore" + name + "changing to err" + name)
-            data = binary[name]
-            del binary[name]
-            binary["err" + name] = data
+        # Couch freaks out on field names that start with an underscore (stubs are left unloaded)
+        for binary in [self._binary_data, self._binary_stubs]:
+            names_to_fix = []
+            for k, v in binary.iteritems():
+                if k[0] == "_":
+                    names_to_fix.append(k)
+
+            for name in names_to_fix:
+                logger.warning(
+                    self.getDataBlobUUID() + "(" + self.getDataBlobType() + ") Validation error:" + "Field name that starts with an underscore" + name + "changing to err" + name)
+                data = binary[name]
+                del binary[name]
+                binary["err" + name] = data
 
     def validateDB(self):
         """
@@ -18,6 +18,7 @@ import json
 import mimetypes
 import os
 import sys
+import threading
 import time
 import utils
 import marshal
@@ -55,6 +56,210 @@ def init(subclass, **kwargs):
         raise TypeError("Cannot create db subclass: %s" % (subclass))
 
 
+# Per-process registry of open database handles, see get_connection()
+_connection_registry = {}
+_connection_registry_pid = None
+_connection_registry_lock = threading.Lock()
+
+# Seconds a registry entry may go unused before it is closed and dropped
+CONNECTION_IDLE_TIMEOUT = 300
+
+# Seconds between health checks of a registry entry
+CONNECTION_HEALTH_CHECK_INTERVAL = 30
+
+# Times an update is retried against the latest revision after a document update conflict
+CONFLICT_RETRIES = 3
+
+# Largest number of documents and (approximate) number of BSON bytes sent in one Mongo bulk write
+BULK_WRITE_BATCH_SIZE = 1000
+BULK_WRITE_BATCH_BYTES = 8 * 1024 * 1024
+
+# Seconds a database lock is held before it expires unless the holder renews it
+LOCK_LEASE_SECONDS = 300
+
+# Seconds the cached lock state is trusted by waitOnLock before the lock document is read again
+LOCK_CACHE_TTL = 10
+
+# Longest single sleep while waiting on someone else's lock
+LOCK_WAIT_SECONDS = 5
+
+
+def isLockHeld(lock, lockInfo, now=None):
+    """
+    True if the lock document is a live lock held by someone other than lockInfo. Lock documents
+    written before leases were added have no expiry and are held until removed.
+
+    :param lock: lock document (dict) or None if there is no lock
+    :param lockInfo: lock instance of the caller
+    :return: bool
+    """
+    if lock is None:
+        return False
+    if now is None:
+        now = time.time()
+    lease_expires = lock.get("lease_expires")
+    if lease_expires is not None and lease_expires <= now:
+        return False
+    return lock.get("lock_instance") != lockInfo
+
+
+def lockWaitSeconds(lock, now=None):
+    """Seconds to sleep before looking at a held lock again, no longer than it has left on its lease"""
+    if now is None:
+        now = time.time()
+    lease_expires = lock.get("lease_expires") if lock is not None else None
+    if lease_expires is None:
+        return LOCK_WAIT_SECONDS
+    return max(0.1, min(LOCK_WAIT_SECONDS, lease_expires - now))
+
+
+class lock_state():
+    """ Locally cached copy of a database's lock document, so the unlocked path of every
+        operation doesn't cost a request. """
+
+    def __init__(self, ttl=LOCK_CACHE_TTL):
+        self._ttl = ttl
+        self._lock = None
+        self._checked = None
+        # Set while something (a changes feed watcher) keeps the cache current
+        self._watched = False
+
+    def isStale(self):
+        if self._watched:
+            return False
+        return self._checked is None or (time.time() - self._checked) > self._ttl
+
+    def get(self):
+        return self._lock
+
+    def set(self, lock):
+        self._lock = lock
+        self._checked = time.time()
+
+    def setWatched(self, watched):
+        self._watched = watched
+
+    def invalidate(self):
+        self._checked = None
+
+
+def _connection_key(subclass, kwargs):
+    return (subclass, kwargs.get('host'), kwargs.get('port'), kwargs.get('database'), kwargs.get('collection'),
+            kwargs.get('use_gridfs'), kwargs.get('username'), kwargs.get('password'))
+
+
+def get_connection(subclass, **kwargs):
+    """
+    Get a db object of a particular subclass from the per-process connection
+    registry, creating it with init() on first use. Handles are keyed by
+    (type, host, database, credentials) so repeated calls in the same process
+    share one server connection instead of reopening it every time.
+
+    The registry is dropped whenever the process id changes, so handles
+    inherited across a fork (e.g. by mp_pool workers) are never reused.
+    Handles that fail a health check, or sit unused for longer than
+    idle_timeout seconds, are discarded and reopened on next use.
+
+    :param subclass: db subclass type (string)
+        eg: 'mongodb','couchdb', None
+    :param kwargs: dict parameters to pass to init (key=value args)
+        idle_timeout:          seconds before an unused handle is evicted
+        health_check_interval: seconds between health checks of a handle
+    :return: database obj
+    """
+    global _connection_registry_pid
+
+    if subclass == None:
+        return None
+
+    idle_timeout = kwargs.pop('idle_timeout', CONNECTION_IDLE_TIMEOUT)
+    health_check_interval = kwargs.pop('health_check_interval', CONNECTION_HEALTH_CHECK_INTERVAL)
+
+    # Requests that modify the database on open always get a fresh handle
+    if kwargs.get('delete_existing', False) or kwargs.get('push_views', False):
+        return init(subclass, **kwargs)
+
+    key = _connection_key(subclass, kwargs)
+    now = time.time()
+
+    with _connection_registry_lock:
+        if _connection_registry_pid != os.getpid():
+            # Forked (or first use): the parent's sockets are not ours to use or close
+            _connection_registry.clear()
+            _connection_registry_pid = os.getpid()
+
+        # Evict idle handles
+        for idle_key in [k for k, entry in _connection_registry.iteritems()
+                         if now - entry["last_used"] > idle_timeout]:
+            _close_connection(_connection_registry.pop(idle_key)["db"])
+
+        entry = _connection_registry.get(key)
+        if entry is not None and now - entry["last_checked"] > health_check_interval:
+            if entry["db"].ping():
+                entry["last_checked"] = now
+            else:
+                logger.warning("Dropping stale %s connection to %s/%s" % (subclass, kwargs.get('host'),
+                                                                          kwargs.get('database')))
+                _close_connection(_connection_registry.pop(key)["db"])
+                entry = None
+
+        if entry is None:
+            entry = {"db": init(subclass, **kwargs), "last_checked": now}
+            _connection_registry[key] = entry
+        entry["last_used"] = now
+
+        return entry["db"]
+
+
+def clear_connections():
+    """
+    Close and drop every handle in this process's connection registry.
+    """
+    with _connection_registry_lock:
+        if _connection_registry_pid == os.getpid():
+            for entry in _connection_registry.itervalues():
+                _close_connection(entry["db"])
+        _connection_registry.clear()
+
+
+def _close_connection(database):
+    try:
+        database.close()
+    except Exception:
+        logger.debug("Error closing database handle %s" % (database,))
+
+
+# Open arguments that change the database, never replayed when a handle is reopened from a pickle
+_REOPEN_EXCLUDED_ARGS = frozenset(["delete_existing", "push_views", "create"])
+
+
+class binary_loader():
+    """
+    Loader for the stubbed binary fields of a data blob, calls method(field=field, **kwargs) on the
+    database the blob came from. Only the arguments for reopening the database are pickled, not the
+    handle, so blobs with stubs can still be shipped to pool processes; an unpickled loader gets its
+    handle through get_connection() on first use.
+    """
+
+    def __init__(self, database, method, **kwargs):
+        self._database = database
+        self._subclass = database._type
+        self._connection_kwargs = dict([(k, v) for k, v in database._kwargs.iteritems()
+                                        if k not in _REOPEN_EXCLUDED_ARGS])
+        self._method = method
+        self._kwargs = kwargs
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_database"] = None
+        return state
+
+    def __call__(self, field):
+        if self._database is None:
+            self._database = get_connection(self._subclass, **self._connection_kwargs)
+        return getattr(self._database, self._method)(field=field, **self._kwargs)
+
+
 # function that will hash multiple data types (e.g., list, dictionary)
 def make_hash(o):
     if isinstance(o, set) or isinstance(o, tuple) or isinstance(o, list):
@@ -98,6 +303,32 @@ class abstract_db():
         """
         raise NotImplementedError("This method is part of a pure virtual class.")
 
+    def loadDataBlobArray(self, uuids, **kwargs):
+        """Gets a list of data blobs from the database in as few requests as the database allows.
+         Input:
+            uuids:  list of unique names for the data blobs
+            kwargs: optional parameters like include_binary, subclass, (key=value args)
+         Output:
+            (data_blobs, missing_uuids) where data_blobs are in the order of uuids
+        """
+        raise NotImplementedError("This method is part of a pure virtual class.")
+
+    def markProgress(self, progress, **kwargs):
+        """Set fields (eg the output tags marking documents as processed) on stored documents in bulk,
+        without the caller loading them and without ever pulling their binary data. Databases that can
+        update fields in place override this; by default the documents are loaded without binaries,
+        changed and stored back.
+         Input:
+            progress: {uuid: {field: value}} fields to set on each document, nested fields ':' separated
+         Output:
+            list of the uuids that could not be marked
+        """
+        data_blobs, missing_uuids = self.loadDataBlobArray(progress.keys())
+        for blob in data_blobs:
+            for field, value in progress[blob.getDataBlobUUID()].iteritems():
+                blob.setMetaData(field, value)
+        return missing_uuids + (self.storeDataBlobArray(data_blobs, ignore_conflict=True) or [])
+
     def deleteDataBlob(self, uuid):
         """Delete the data blob from the database.
             Input:
@@ -113,6 +344,15 @@ class abstract_db():
         """
         raise NotImplementedError("This method is part of a pure virtual class.")
 
+    def ensureTagIndexes(self, input_tags, output_tags):
+        """Create whatever indexes the database needs to answer the manager's tag query (documents with
+        all of the input tags and none of the output tags). Databases that don't need any leave this alone.
+         Input:
+            input_tags:  fields a document must have to be processed
+            output_tags: fields that mark a document as already processed
+        """
+        return []
+
     def delete(self, **kwargs):
         """Delete the database.
          Input:
@@ -162,6 +402,18 @@ class abstract_db():
         """
         raise NotImplementedError("This method is part of a pure virtual class.")
 
+    def ping(self):
+        """
+        Return True/False based on whether the database connection is still usable
+        """
+        raise NotImplementedError("This method is part of a pure virtual class.")
+
+    def close(self):
+        """
+        Release the connection to the database
+        """
+        raise NotImplementedError("This method is part of a pure virtual class.")
+
     def query(self):
         """
         Ad-hoc query for the database
@@ -256,6 +508,17 @@ class couchdb(abstract_db):
         self._server = None
         self._raw_db = None
         self._kwargs = kwargs
+        # Names of the Mango indexes already ensured through this handle
+        self._tag_indexes = set()
+        # Whether the partial update handler is known to be in the database
+        self._update_handler = False
+        # Send the changed meta data of loaded blobs through the update handler instead of the whole document
+        self._partial_updates = kwargs.get('partial_updates', True)
+        # Lock leases and the cached lock state, optionally kept current by watching the changes feed
+        self._lock_lease_seconds = kwargs.get('lock_lease_seconds', LOCK_LEASE_SECONDS)
+        self._lock_state = lock_state(kwargs.get('lock_cache_ttl', LOCK_CACHE_TTL))
+        self._lock_watch = kwargs.get('lock_watch', False)
+        self._lock_watch_pid = None
         self._host = kwargs.get('host', self.DEFAULT_HOST)
         self._database = kwargs.get('database', self.DEFAULT_DATABASE)
         self._username = kwargs.get('username', self.DEFAULT_USERNAME)
@@ -265,6 +528,11 @@ class couchdb(abstract_db):
         self._view_files = kwargs.get('view_files', [])
         self._redirect_view_dirs = kwargs.get('redirect_view_dirs', [])
         self._staging_suffix = kwargs.get('staging_suffix', '')
+        # Leave attachments as stubs on include_binary loads and pull each one when it is first used
+        self._lazy_binary = kwargs.get('lazy_binary', True)
+        # Changed binary fields bigger than this are uploaded as standalone attachments instead of being
+        # base64 inlined into the document body
+        self._inline_binary_limit = kwargs.get('inline_binary_limit', 64 * 1024)
 
         print "Done setting first params"
         log_level = kwargs.get('log_level', None)
@@ -509,8 +777,25 @@ class couchdb(abstract_db):
 
         return True
 
+    def ping(self):
+        """Check the server is reachable and the database still exists."""
+        try:
+            self._raw_db.info()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        """Close the idle HTTP connections pooled by the server handle, they are reopened on next use."""
+        pool = self._server.resource.session.connection_pool
+        with pool.lock:
+            for conns in pool.conns.itervalues():
+                for conn in conns:
+                    conn.close()
+            pool.conns.clear()
+
     def update_doc(self, name, docid=None, **kwargs):
-        val = self._raw_db.update_doc(name, docid=docid)
+        val = self._raw_db.update_doc(name, docid=docid, **kwargs)
         return val
 
     def create_native_doc(self, data_blob, **kwargs):
@@ -558,11 +843,27 @@ class couchdb(abstract_db):
 
         ignore_conflict = kwargs.get('ignore_conflict', False)
 
+        # Attachments that are unchanged (or were never loaded) can stay as stubs when the blob is updated
+        # in place in the database it came from, otherwise they are pulled so they can be written out
+        keep_stubs = (uuid is not None and data_blob.getDB() is self and not kwargs.get('delete_existing', False))
+
+        # If the caller hands in a list, big changed binary fields are left out of the document and their
+        # names appended to the list, to be uploaded as standalone attachments
+        out_of_line_fields = kwargs.get('out_of_line_fields')
+
         # Any binary fields will be added as inline attachments
         attachment_dict = {}
 
-        for k, v in data_blob.getBinaryDataDict().iteritems():
-            attachment_dict[k] = {"content_type": v["mime_type"], "data": base64.b64encode(v["data"])}
+        for k, v in data_blob.getBinaryDataDict(load_stubs=not keep_stubs).iteritems():
+            if keep_stubs and data_blob.isBinaryDataStored(k):
+                attachment_dict[k] = {"stub": True}
+            elif out_of_line_fields is not None and len(v["data"]) > self._inline_binary_limit:
+                out_of_line_fields.append(k)
+            else:
+                attachment_dict[k] = {"content_type": v["mime_type"], "data": base64.b64encode(v["data"])}
+        if keep_stubs:
+            for k in data_blob.getBinaryDataStubs().iterkeys():
+                attachment_dict[k] = {"stub": True}
 
         if attachment_dict != {}:
             couch_doc["_attachments"] = attachment_dict
@@ -576,18 +877,79 @@ class couchdb(abstract_db):
 
         if data_blob is None:
             return False
-        '''Store the data blob to the database using any optional parameters'''
+        '''Store the data blob to the database using any optional parameters
+            Input:
+                delete_existing: delete the stored document and save a new one instead of updating it
+                                 in place (defaults to False)
+                ignore_conflict: give up quietly if the update still conflicts after the retries
+                conflict_retries: times to retry a conflicting update against the latest revision
+                atomic: write the new revision in a single request, big binary fields go inline rather
+                        than up front as standalone attachments, so readers only ever see the old
+                        revision or the new one
+        '''
 
         # All DB operations check for locks
 
         self.waitOnLock(lockInfo, uuid)
 
-        couch_doc = self.create_native_doc(data_blob, **kwargs)
+        ignore_conflict = kwargs.pop('ignore_conflict', False)
+        conflict_retries = kwargs.pop('conflict_retries', CONFLICT_RETRIES)
+        atomic = kwargs.pop('atomic', False)
+        delete_existing = kwargs.get('delete_existing', False)
+
+        if uuid is not None and not delete_existing:
+            # Only meta data changed since the blob was loaded: send just those fields through the update
+            # handler, which applies them to whatever revision the server has
+            changes = self.getMetaDataChanges(data_blob)
+            if changes is not None and not changes[0] and not changes[1]:
+                # Nothing changed
+                return
+            if changes is not None:
+                try:
+                    rev = self.updateFields(uuid, changes[0], changes[1], conflict_retries)
+                except couchdb_interface.ResourceConflict:
+                    if ignore_conflict:
+                        return
+                    logger.error("Conflict for doc " + uuid + " after " + str(conflict_retries) + " retries")
+                    raise
+                if rev is not None:
+                    data_blob.setDataBlobRevision(rev)
+                    if data_blob.hasMetaData("_rev"):
+                        data_blob.setMetaData("_rev", rev)
+                    data_blob.markMetaDataStored(self)
+                    return
+
+            # Update in place: one PUT carrying the current revision, no tombstone. Big changed binary
+            # fields are streamed up first as standalone attachments, unchanged ones go along as stubs.
+            out_of_line_fields = None if atomic else []
+            couch_doc = self.create_native_doc(data_blob, out_of_line_fields=out_of_line_fields, **kwargs)
+            couch_doc.setdefault("_id", uuid)
+            binary_data = data_blob.getBinaryDataDict(load_stubs=False)
+            try:
+                for field in out_of_line_fields or []:
+                    couch_doc["_rev"] = self.putAttachment(couch_doc["_id"], couch_doc.get("_rev"), field,
+                                                           binary_data[field]["data"], binary_data[field]["mime_type"],
+                                                           conflict_retries)
+                    couch_doc.setdefault("_attachments", {})[field] = {"stub": True}
+                doc_info = self.saveNativeDoc(couch_doc, conflict_retries)
+            except couchdb_interface.ResourceConflict:
+                if ignore_conflict:
+                    return
+                logger.error("Conflict for doc " + uuid + " after " + str(conflict_retries) + " retries")
+                raise
+            data_blob.setDataBlobRevision(doc_info[1])
+            if data_blob.hasMetaData("_rev"):
+                data_blob.setMetaData("_rev", doc_info[1])
+            data_blob.markBinaryDataStored()
+            data_blob.markMetaDataStored(self)
+            return
+
+        kwargs.pop('delete_existing', None)
+        couch_doc = self.create_native_doc(data_blob, delete_existing=delete_existing, **kwargs)
 
-        ignore_conflict = kwargs.get('ignore_conflict', False)
         try:
             # Should we delete any existing data blob
-            if uuid != None and kwargs.get('delete_existing', True):
+            if uuid != None and delete_existing:
                 self.deleteDataBlob(uuid, lockInfo=lockInfo)
                 if "_rev" in couch_doc:
                     del couch_doc["_rev"]
@@ -602,6 +964,8 @@ class couchdb(abstract_db):
                 # Storing the id and rev back to the data blob
                 data_blob.setDataBlobUUID(doc_info[0])
                 data_blob.setDataBlobRevision(doc_info[1])
+                data_blob.markBinaryDataStored()
+                data_blob.markMetaDataStored(self)
             # print "Data blob stored!"
             except Exception, e:
                 logger.exception("ERROR SAVING DOCUMENT")
@@ -623,57 +987,175 @@ class couchdb(abstract_db):
                 raise
             logger.error("Hammer worked")
 
+    def getCurrentRevisions(self, doc_ids):
+        """ Latest revision of each document (None for documents that don't exist), in one request """
+        revisions = {}
+        for row in self._raw_db.view("_all_docs", keys=list(doc_ids)):
+            value = row.get("value")
+            if value is None or value.get("deleted"):
+                revisions[row.key] = None
+            else:
+                revisions[row.key] = value.get("rev")
+        return revisions
+
+    def putAttachment(self, doc_id, rev, field, data, mime_type, conflict_retries=CONFLICT_RETRIES):
+        """ Upload one attachment on its own (no base64, no document body), creating the document if it
+            doesn't exist yet. Retries against the latest revision on a conflict. Returns the new revision. """
+        for attempt in range(conflict_retries + 1):
+            doc = {"_id": doc_id}
+            if rev is not None:
+                doc["_rev"] = rev
+            try:
+                self._raw_db.put_attachment(doc, data, field, mime_type)
+                return doc["_rev"]
+            except couchdb_interface.ResourceConflict:
+                if attempt == conflict_retries:
+                    raise
+                rev = self.getCurrentRevisions([doc_id]).get(doc_id)
+
+    def saveNativeDoc(self, couch_doc, conflict_retries=CONFLICT_RETRIES):
+        """ Save a couch document in one PUT, retrying up to conflict_retries times against the latest
+            revision if it conflicts. Returns (id, rev), raises ResourceConflict when out of retries. """
+        for attempt in range(conflict_retries + 1):
+            try:
+                return self._raw_db.save(couch_doc)
+            except couchdb_interface.ResourceConflict:
+                if attempt == conflict_retries:
+                    raise
+                rev = self.getCurrentRevisions([couch_doc["_id"]]).get(couch_doc["_id"])
+                if rev is None:
+                    couch_doc.pop("_rev", None)
+                else:
+                    couch_doc["_rev"] = rev
+
     def storeDataBlobArray(self, data_blob_array, lockInfo=None, **kwargs):
-        """Stores an array of data blobs to the database."""
+        """
+        Stores an array of data blobs to the database with _bulk_docs requests, updating each document
+        in place at its current revision. Conflicting documents are retried (in bulk) against their latest
+        revision up to conflict_retries times.
+            Input:
+                ignore_conflict:  don't log documents that still conflict after the retries as errors
+                conflict_retries: times to retry conflicting documents
+                batch_size:       documents per _bulk_docs request
+            Output:
+                list of the ids of the documents that could not be stored
+        """
         if lockInfo is None:
             lockInfo = self.getLockInfo(None)
 
-        couch_array = []
-        for blob in data_blob_array:
-            couch_array.append(self.create_native_doc(blob), **kwargs)
+        ignore_conflict = kwargs.pop('ignore_conflict', False)
+        conflict_retries = kwargs.pop('conflict_retries', CONFLICT_RETRIES)
+        batch_size = kwargs.pop('batch_size', 500)
 
         # All DB operations check for locks
         self.waitOnLock(lockInfo, None)
 
-        logger.info("Storing " + str(len(couch_array)) + " docs to couch:" + str(kwargs))
-        self._raw_db.update(couch_array, **kwargs)  # Fixme: this is really a big bypass of the data blob class
+        logger.info("Storing " + str(len(data_blob_array)) + " docs to couch")
+
+        failed_ids = []
+        conflicted_ids = []
+        for start in range(0, len(data_blob_array), batch_size):
+            pending = []
+            for blob in data_blob_array[start:start + batch_size]:
+                couch_doc = self.create_native_doc(blob)
+                if blob.getDataBlobUUID() is not None:
+                    couch_doc.setdefault("_id", blob.getDataBlobUUID())
+                pending.append((blob, couch_doc))
+
+            for attempt in range(conflict_retries + 1):
+                conflicts = []
+                results = self._raw_db.update([couch_doc for blob, couch_doc in pending])
+                for (blob, couch_doc), (success, doc_id, rev_or_error) in zip(pending, results):
+                    if success:
+                        blob.setDataBlobRevision(rev_or_error)
+                        if blob.hasMetaData("_rev"):
+                            blob.setMetaData("_rev", rev_or_error)
+                        blob.markBinaryDataStored()
+                        blob.markMetaDataStored(self)
+                    elif isinstance(rev_or_error, couchdb_interface.ResourceConflict):
+                        conflicts.append((blob, couch_doc))
+                    else:
+                        logger.error("Failed to store document " + str(doc_id) + ": " + str(rev_or_error))
+                        failed_ids.append(doc_id)
+
+                if not conflicts:
+                    break
+                if attempt == conflict_retries:
+                    conflicted_ids.extend([couch_doc["_id"] for blob, couch_doc in conflicts])
+                    break
+
+                # Move the conflicting documents onto their latest revision and send them again
+                revisions = self.getCurrentRevisions([couch_doc["_id"] for blob, couch_doc in conflicts])
+                for blob, couch_doc in conflicts:
+                    rev = revisions.get(couch_doc["_id"])
+                    if rev is None:
+                        couch_doc.pop("_rev", None)
+                    else:
+                        couch_doc["_rev"] = rev
+                pending = conflicts
+
+        if conflicted_ids:
+            message = "%d documents still conflict after %d retries in couch database %s %s" % (
+                len(conflicted_ids), conflict_retries, self._host, self._database)
+            if ignore_conflict:
+                logger.info(message)
+            else:
+                logger.error(message)
 
-        ''' If things get squirrely you can check all the responses
-        response_list = self._raw_db.update(data_blob_array, **kwargs)   # Fixme: this is really a big bypass of the data blob class
-        for response in response_list:
-            success = response[0]
-            doc_id = response[1]
-            rev_error = response[2]
-            if (success == False):
-                logger.error( "Failed to store document", doc_id, "error code:", rev_error)
-                sys.exit(1)
-         '''
+        return failed_ids + conflicted_ids
 
     def storeObservationArray(self, observations, lockInfo=None, **kwargs):
-        """Stores an array of data blobs to the database."""
+        """Stores an array of observations to the database, see storeDataBlobArray"""
+        logger.info("Storing " + str(len(observations)) + " docs to couch:" + str(kwargs))
+        return self.storeDataBlobArray(observations, lockInfo, **kwargs)
+
+    def markProgress(self, progress, lockInfo=None, **kwargs):
+        """
+        Set fields on stored documents, see abstract_db. The documents are read and written back as plain
+        couch documents with their attachments left as stubs, a page at a time (_all_docs, then _bulk_docs),
+        and conflicting documents are re-read and retried up to conflict_retries times.
+            Input:
+                conflict_retries: times to retry conflicting documents
+                batch_size:       documents per request
+        """
         if lockInfo is None:
             lockInfo = self.getLockInfo(None)
 
-        # All DB operations check for locks
+        conflict_retries = kwargs.get('conflict_retries', CONFLICT_RETRIES)
+        batch_size = kwargs.get('batch_size', 500)
+
+        # All DB operations check for locks (once for the whole array)
         self.waitOnLock(lockInfo, None)
-        logger.info("Storing " + str(len(observations)) + " docs to couch:" + str(kwargs))
-        #        data_blob_array = []
-        for observation in observations:
-            observation.store()
-        # data_blob_array.append(observation.getMetaDataDict())
-
-        #        self._raw_db.update(data_blob_array, **kwargs)   # Fixme: this is really a big bypass of the data blob class
-
-        ''' If things get squirrely you can check all the responses
-        response_list = self._raw_db.update(data_blob_array, **kwargs)   # Fixme: this is really a big bypass of the data blob class
-        for response in response_list:
-            success = response[0]
-            doc_id = response[1]
-            rev_error = response[2]
-            if (success == False):
-                logger.error( "Failed to store document", doc_id, "error code:", rev_error)
-                sys.exit(1)
-         '''
+
+        failed_ids = []
+        uuids = progress.keys()
+        for start in range(0, len(uuids), batch_size):
+            pending = uuids[start:start + batch_size]
+            for attempt in range(conflict_retries + 1):
+                couch_docs = []
+                for row in self._raw_db.view("_all_docs", keys=pending, include_docs=True):
+                    couch_doc = row.get("doc")
+                    if couch_doc is None:
+                        logger.info("Could not find document " + str(row.key) + " to mark progress on")
+                        failed_ids.append(row.key)
+                        continue
+                    for field, value in progress[couch_doc["_id"]].iteritems():
+                        setNativeField(couch_doc, field, value)
+                    couch_docs.append(couch_doc)
+
+                pending = []
+                for success, doc_id, rev_or_error in self._raw_db.update(couch_docs):
+                    if success:
+                        continue
+                    if isinstance(rev_or_error, couchdb_interface.ResourceConflict) and attempt < conflict_retries:
+                        pending.append(doc_id)
+                    else:
+                        logger.error("Failed to mark progress on document " + str(doc_id) + ": " + str(rev_or_error))
+                        failed_ids.append(doc_id)
+                if not pending:
+                    break
+
+        return failed_ids
 
     def loadDataBlob(self, uuid, lockInfo=None, **kwargs):
         """
@@ -690,7 +1172,7 @@ class couchdb(abstract_db):
         # All DB operations check for locks
         self.waitOnLock(lockInfo, uuid)
         # Grab the attachment info
-        attachments_inline = kwargs.get('include_binary', False)
+        attachments_inline = kwargs.get('include_binary', False) and not self._lazy_binary
 
         # Error if the blob doesn't exist?
         must_exist = kwargs.get('must_exist', False)
@@ -724,8 +1206,21 @@ class couchdb(abstract_db):
             return None
 
         print "creating blob"
+        return self.create_blob_from_native_doc(couchdoc, **kwargs)
+
+    def create_blob_from_native_doc(self, couchdoc, **kwargs):
+        """
+        Builds a data blob from a document already pulled out of couch.
+            Input:
+               couchdoc: couch document (dict), with inline attachments if include_binary is set
+               kwargs: parameters to pass to data blob's __init__ method (key=value args)
+                   include_binary: flag stating the attachments are wanted (defaults to False); attachments
+                                   that are only stubs in the document are fetched on first access
+        """
+        attachments_inline = kwargs.get('include_binary', False)
+
         # Create the data blob
-        _data_blob = data_blob.create(uuid, **kwargs)
+        _data_blob = data_blob.create(couchdoc["_id"], **kwargs)
 
         # Set the database
         _data_blob.setDB(self)
@@ -734,7 +1229,6 @@ class couchdb(abstract_db):
         _data_blob.setDataBlobUUID(couchdoc["_dataBlobID"])
         _data_blob.setDataBlobRevision(couchdoc["_rev"])
 
-        print "looping thru metadata"
         # Loop through the meta data
         for k, v in couchdoc.iteritems():
             if (attachments_inline and (
@@ -742,21 +1236,108 @@ class couchdb(abstract_db):
                 continue
             _data_blob.setMetaData(k, v)
 
-        print "grabbing attachments"
         # Grab the attachments
         if attachments_inline:
             if "_attachments" in couchdoc:
+                doc_id = couchdoc["_id"]
+                rev = couchdoc["_rev"]
                 for k, v in couchdoc["_attachments"].iteritems():
-                    _data_blob.setBinaryData(k, v["content_type"], base64.b64decode(v["data"]))
+                    if "data" in v:
+                        _data_blob.setBinaryData(k, v["content_type"], base64.b64decode(v["data"]))
+                        _data_blob.markBinaryDataStored(k)
+                    else:
+                        _data_blob.setBinaryDataStub(k, v["content_type"], v.get("length"), v.get("digest"))
+                _data_blob.setBinaryDataLoader(binary_loader(self, "loadAttachment", doc_id=doc_id, rev=rev))
 
-        print "validating blob"
         # Now validate the data blob
         _data_blob.validate(**kwargs)
+        _data_blob.markMetaDataStored(self)
 
-        print "Returning"
         # Return the data blob
         return _data_blob
 
+    def loadDataBlobArray(self, uuids, lockInfo=None, **kwargs):
+        """
+        Loads a list of data blobs from the database using bulk _all_docs requests rather than
+        one existence check and one GET per document.
+            Input:
+               uuids:  list of unique ids (unique names) for the data blobs
+               kwargs: parameters to pass to data blob's __init__ method (key=value args)
+                   include_binary: flag for pulling down all binary fields (defaults to False)
+                   page_size: number of documents to pull per request (defaults to 250)
+            Output:
+               (data_blobs, missing_uuids) where data_blobs are in the order of uuids
+        """
+        if lockInfo is None:
+            lockInfo = self.getLockInfo(None)
+
+        # All DB operations check for locks (once for the whole array)
+        self.waitOnLock(lockInfo, None)
+
+        attachments_inline = kwargs.get('include_binary', False) and not self._lazy_binary
+        page_size = kwargs.pop('page_size', 250)
+        if page_size is None or page_size < 1:
+            page_size = 250
+
+        data_blobs = []
+        missing_uuids = []
+        for start in range(0, len(uuids), page_size):
+            keys = uuids[start:start + page_size]
+            try:
+                rows = self._raw_db.view("_all_docs", keys=keys, include_docs=True,
+                                         attachments=attachments_inline).rows
+            except couchdb_interface.http.ServerError:
+                logger.exception("Bulk loading " + str(len(keys)) + " data blobs from database " + self._host + ' ' +
+                                 str(self._database))
+                raise
+
+            for row in rows:
+                couchdoc = row.get("doc")
+                if couchdoc is None:
+                    # Either the key doesn't exist or the document has been deleted
+                    missing_uuids.append(row.key)
+                    continue
+                data_blobs.append(self.create_blob_from_native_doc(couchdoc, **kwargs))
+
+        if missing_uuids:
+            logger.info("Could not find " + str(len(missing_uuids)) + " data blobs in couch database " + self._host +
+                        ' ' + str(self._database))
+
+        return data_blobs, missing_uuids
+
+    def loadAttachment(self, doc_id, field, rev=None):
+        """
+        Fetch the raw data of one attachment, at the given revision of the document if it is still around.
+            Input:
+               doc_id: couch document id
+               field:  attachment name
+               rev:    document revision the attachment stub came from
+        """
+        resource = couchdb_interface.client._doc_resource(self._raw_db.resource, doc_id)
+        try:
+            if rev is None:
+                status, headers, data = resource.get(field)
+            else:
+                try:
+                    status, headers, data = resource.get(field, rev=rev)
+                except couchdb_interface.http.ResourceNotFound:
+                    # The revision has been compacted away
+                    status, headers, data = resource.get(field)
+        except couchdb_interface.http.ResourceNotFound:
+            logger.error("Could not find attachment " + field + " of " + doc_id + " in couch database " + self._host +
+                         ' ' + str(self._database))
+            raise KeyError("No binary data field", field)
+
+        try:
+            return data.read()
+        finally:
+            data.close()
+
+    @property
+    def lazy_binary(self):
+        """True if include_binary loads leave the attachments as stubs until they are used"""
+        return self._lazy_binary
+
     def deleteDataBlob(self, uuid, no_checks=False, lockInfo=None):
         """
         Delete the data blob from the database.
@@ -832,47 +1413,106 @@ class couchdb(abstract_db):
 
         return lockInfo
 
-    def setLock(self, lockInfo=None, doc_id=None):
-
+    def loadLock(self):
+        """Read the lock document (None if the database isn't locked) and refresh the cached lock state"""
+        lock = self._raw_db.get("database_lock")
+        self._lock_state.set(lock)
+        return lock
+
+    def getCachedLock(self):
+        """The lock document as of the last read, re-read once the cache is older than lock_cache_ttl"""
+        if self._lock_watch:
+            self.startLockWatch()
+        if self._lock_state.isStale():
+            return self.loadLock()
+        return self._lock_state.get()
+
+    def startLockWatch(self):
+        """Keep the cached lock state current from the changes feed (one watcher thread per process)"""
+        if self._lock_watch_pid == os.getpid():
+            return
+        self._lock_watch_pid = os.getpid()
+        self._lock_state.setWatched(False)
+        thread = threading.Thread(target=self.watchLock, name="hybrid-lock-watch")
+        thread.daemon = True
+        thread.start()
+
+    def watchLock(self):
+        """Long poll the changes feed for the lock document, updating the cached lock state"""
+        since = None
+        while True:
+            try:
+                if since is None:
+                    since = self._raw_db.info().get("update_seq", 0)
+                    self.loadLock()
+                    self._lock_state.setWatched(True)
+                result = self._raw_db.changes(feed="longpoll", since=since, filter="_doc_ids",
+                                              doc_ids=json.dumps(["database_lock"]), include_docs="true",
+                                              timeout=60000)
+                for change in result.get("results", []):
+                    if change.get("deleted"):
+                        self._lock_state.set(None)
+                    else:
+                        self._lock_state.set(change.get("doc"))
+                since = result.get("last_seq", since)
+            except Exception:
+                logger.exception("Lock watch on " + self._host + ' ' + str(self._database) + " failed, retrying")
+                self._lock_state.setWatched(False)
+                self._lock_state.invalidate()
+                since = None
+                time.sleep(LOCK_WAIT_SECONDS)
+
+    def setLock(self, lockInfo=None, doc_id=None, lease_seconds=None):
+        """
+        Take the database lock, waiting for any other live lock to be removed or to expire. The lock is a
+        lease: it expires lease_seconds (lock_lease_seconds by default) after it was taken unless renewed.
+        """
         logger.info("<<<Attempting to lock the database>>>")
 
         if lockInfo is None:
             lockInfo = self.getLockInfo(doc_id)
+        if lease_seconds is None:
+            lease_seconds = self._lock_lease_seconds
 
-        first = True
-        locked = True
-        lock = {"_dataBlobID": "database_lock", "lock_instance": lockInfo}
-
-        while locked:
-
-            if locked and not first:
-                '''Wait on a locked database'''
+        while True:
+            lock = self.loadLock()
+            if isLockHeld(lock, lockInfo):
                 logger.info("<<<Waiting on Locked Database>>>")
-                time.sleep(random.randint(2, 6))
-
-            first = False
-            locked = self.isLocked(lockInfo, doc_id)
-            if not locked:
-                try:
-                    self._raw_db.save(lock)
-                    locked = False
-                    logger.info("lock set to " + lock["lock_instance"])
-                except couchdb_interface.ResourceConflict, e:
-                    locked = True
-
-    def isLocked(self, lockInfo, doc_id):
-        """Return True/False based on database locked state"""
-        if "database_lock" in self._raw_db:
+                time.sleep(min(random.randint(2, 6), lockWaitSeconds(lock)))
+                continue
 
-            # If the lock is someone elses then it's locked
-            lock_doc = self._raw_db["database_lock"]
-            if doc_id is None:
-                doc_id = "_all"
+            # Take over an expired lock (or renew our own) at its revision so only one process wins
+            new_lock = {"_id": "database_lock", "_dataBlobID": "database_lock", "lock_instance": lockInfo,
+                        "lease_seconds": lease_seconds, "lease_expires": time.time() + lease_seconds}
+            if lock is not None:
+                new_lock["_rev"] = lock["_rev"]
+            try:
+                self._raw_db.save(new_lock)
+            except couchdb_interface.ResourceConflict:
+                continue
+            self._lock_state.set(new_lock)
+            logger.info("lock set to " + str(lockInfo))
+            return
 
-            if (lock_doc["lock_instance"] != lockInfo):
-                return True
+    def renewLock(self, lockInfo=None, doc_id=None):
+        """Extend the lease on a lock we hold. Returns False if the lock isn't ours (anymore)."""
+        if lockInfo is None:
+            lockInfo = self.getLockInfo(doc_id)
+        lock = self.loadLock()
+        if lock is None or lock.get("lock_instance") != lockInfo:
+            return False
+        lease_seconds = lock.get("lease_seconds", self._lock_lease_seconds)
+        lock["lease_expires"] = time.time() + lease_seconds
+        try:
+            self._raw_db.save(lock)
+        except couchdb_interface.ResourceConflict:
+            return False
+        self._lock_state.set(lock)
+        return True
 
-        return False
+    def isLocked(self, lockInfo=None, doc_id=None):
+        """Return True/False based on database locked state (always reads the lock document)"""
+        return isLockHeld(self.loadLock(), lockInfo)
 
     def removeLock(self, lockInfo=None, doc_id=None):
         """Remove the lock on the database"""
@@ -883,6 +1523,7 @@ class couchdb(abstract_db):
             if lock_instance == lockInfo:
                 logger.info("<<<Unlocking Database>>>")
                 self._raw_db.delete(lock_doc)
+                self._lock_state.set(None)
             else:
                 logger.error("Attempting to remove lock that doesn't belong to me!!" + str(lockInfo))
                 #                self._raw_db.delete(self._raw_db["database_lock"])
@@ -890,11 +1531,14 @@ class couchdb(abstract_db):
                 #
 
     def waitOnLock(self, lockInfo, doc_id):
-        """Wait on a locked database"""
+        """Wait on a locked database. Uses the cached lock state, so while the database is unlocked this
+        costs no request; an abandoned lock stops blocking once its lease expires."""
         try:
-            while self.isLocked(lockInfo, doc_id):
-                time.sleep(5)
+            lock = self.getCachedLock()
+            while isLockHeld(lock, lockInfo):
                 logger.info("<<<Waiting on Locked Database>>>")
+                time.sleep(lockWaitSeconds(lock))
+                lock = self.loadLock()
         except couchdb_interface.ResourceNotFound:
             # If the lock isn't found that is fine (it's no longer locked :)
             return
@@ -904,6 +1548,155 @@ class couchdb(abstract_db):
         if (not self._raw_db.compact(ddoc)):
             logger.error("Compaction of database(" + str(ddoc) + ") failed")
 
+    # Design document holding the Mango indexes created for tag queries
+    TAG_INDEX_DDOC = "hybrid-tags"
+
+    def tagIndexName(self, input_tags, output_tags):
+        """Name of the Mango index used for the tag query, None if there are no input tags to index"""
+        if not input_tags:
+            return None
+        name = "tags-" + "-".join(sorted(input_tags))
+        if output_tags:
+            name += "-not-" + "-".join(sorted(output_tags))
+        return name
+
+    def ensureTagIndexes(self, input_tags, output_tags):
+        """
+        Create a Mango JSON index for the tag query (CouchDB 2.0 or later). The index is on the input tags,
+        which a JSON index only holds documents with all of, and is partial on the output tags being absent
+        so processed documents drop out of it.
+            Input:
+                input_tags:  fields a document must have to be processed
+                output_tags: fields that mark a document as already processed
+            Output:
+                list of the index names
+        """
+        name = self.tagIndexName(input_tags, output_tags)
+        if name is None:
+            return []
+        if name in self._tag_indexes:
+            return [name]
+
+        index = {"fields": sorted(input_tags)}
+        if output_tags:
+            index["partial_filter_selector"] = dict((tag, {"$exists": False}) for tag in output_tags)
+        body = {"index": index, "ddoc": self.TAG_INDEX_DDOC, "name": name, "type": "json"}
+        try:
+            self._raw_db.resource.post_json("_index", body=body)
+        except (couchdb_interface.http.ServerError, couchdb_interface.http.ResourceNotFound):
+            logger.warning("Could not create the Mango index " + name + " in couch database " + self._host + ' ' +
+                           str(self._database))
+            return []
+
+        self._tag_indexes.add(name)
+        return [name]
+
+    # Design document holding the update handler used for partial updates
+    UPDATE_HANDLER_DDOC = "hybrid-updates"
+
+    # Update handler applying a {"set": [[path, value], ...], "unset": [path, ...]} request body to the
+    # document, each path a list of the nested field names
+    FIELDS_UPDATE_HANDLER = """function(doc, req) {
+    if (!doc) {
+        return [null, {code: 404, json: {error: "not_found", reason: "missing"}}];
+    }
+    var body = JSON.parse(req.body);
+    function container(path, create) {
+        var current = doc;
+        for (var i = 0; i < path.length - 1; i++) {
+            if (current[path[i]] === null || typeof current[path[i]] !== "object") {
+                if (!create) {
+                    return null;
+                }
+                current[path[i]] = {};
+            }
+            current = current[path[i]];
+        }
+        return current;
+    }
+    var i, path, parent;
+    for (i = 0; i < body.unset.length; i++) {
+        path = body.unset[i];
+        parent = container(path, false);
+        if (parent !== null) {
+            delete parent[path[path.length - 1]];
+        }
+    }
+    for (i = 0; i < body.set.length; i++) {
+        path = body.set[i][0];
+        container(path, true)[path[path.length - 1]] = body.set[i][1];
+    }
+    return [doc, {json: {ok: true}}];
+}"""
+
+    def ensureUpdateHandler(self):
+        """Put the partial update handler in the database if it isn't there yet, False if it can't be"""
+        if self._update_handler:
+            return True
+
+        ddoc_id = "_design/" + self.UPDATE_HANDLER_DDOC
+        try:
+            ddoc = self._raw_db.get(ddoc_id)
+            if ddoc is None:
+                ddoc = {"_id": ddoc_id}
+            if ddoc.get("updates", {}).get("fields") != self.FIELDS_UPDATE_HANDLER:
+                ddoc.setdefault("updates", {})["fields"] = self.FIELDS_UPDATE_HANDLER
+                self._raw_db.save(ddoc)
+        except couchdb_interface.ResourceConflict:
+            # Another process put it there first
+            pass
+        except (couchdb_interface.http.ServerError, couchdb_interface.http.Unauthorized):
+            logger.warning("Could not create the update handler in couch database " + self._host + ' ' +
+                           str(self._database))
+            return False
+
+        self._update_handler = True
+        return True
+
+    def getMetaDataChanges(self, data_blob):
+        """The (set, unset) meta data changes of a blob loaded from (or stored to) this database that can go
+        through the update handler, None if the whole document has to be written"""
+        if not self._partial_updates or data_blob.getChangedBinaryFields():
+            return None
+        return data_blob.getMetaDataChanges(self)
+
+    def updateFields(self, uuid, set_fields, unset_fields, conflict_retries=CONFLICT_RETRIES):
+        """
+        Apply meta data changes (':' separated paths) to the latest revision of a document through the
+        update handler. Returns the new revision, or None if the document (or the handler) isn't there.
+        """
+        if not self.ensureUpdateHandler():
+            return None
+
+        body = json.dumps({"set": [[path.split(':'), value] for path, value in set_fields.iteritems()],
+                           "unset": [path.split(':') for path in unset_fields]})
+        for attempt in range(conflict_retries + 1):
+            try:
+                headers, response = self.update_doc(self.UPDATE_HANDLER_DDOC + "/fields", docid=uuid, body=body,
+                                                    headers={"Content-Type": "application/json"})
+                response.read()
+                return headers.get("X-Couch-Update-NewRev")
+            except couchdb_interface.http.ResourceNotFound:
+                return None
+            except couchdb_interface.ResourceConflict:
+                # Someone else saved the document between the handler reading and writing it
+                if attempt == conflict_retries:
+                    raise
+
+    def find(self, selector, **kwargs):
+        """
+        Run a Mango _find query and return the response (docs, bookmark, warning).
+            Input:
+                selector: Mango selector (dict)
+                kwargs:   other _find fields, eg limit, bookmark, fields, use_index
+        """
+        body = dict(kwargs)
+        body["selector"] = selector
+        status, headers, result = self._raw_db.resource.post_json("_find", body=body)
+        if result.get("warning"):
+            logger.info("_find on " + self._host + ' ' + str(self._database) + ": " + result.get("warning"))
+        return result
+
     def viewExists(self, view_name):
         """ Okay this is really silly, but I don't know of another way"""
         try:
@@ -1124,6 +1917,64 @@ class couchdb(abstract_db):
         logger.info("Redirect design document created at " + design_doc_name)
 
 
+def setNativeField(doc, field, value):
+    """Set a ':' separated (nested) field on a plain document dict, creating the containers on the way"""
+    parts = field.split(':')
+    for part in parts[:-1]:
+        if not isinstance(doc.get(part), dict):
+            doc[part] = {}
+        doc = doc[part]
+    doc[parts[-1]] = value
+
+
+def mongoUpdateDocument(set_fields, unset_fields):
+    """
+    $set/$unset update document for meta data changes given as ':' separated paths ({} if there are
+    none). Returns None if a path can't be written as a Mongo dotted field name.
+    """
+    update = {}
+    for operator, paths in (("$set", set_fields), ("$unset", unset_fields)):
+        for path in paths:
+            parts = path.split(':')
+            for part in parts:
+                if part == "" or "." in part or part.startswith("$"):
+                    return None
+            if operator == "$set":
+                update.setdefault(operator, {})[".".join(parts)] = set_fields[path]
+            else:
+                update.setdefault(operator, {})[".".join(parts)] = ""
+    return update
+
+
+def getQueryPlanStages(explain_output):
+    """
+    List the stages of the winning plan in the output of a MongoDB explain(). Servers older than
+    3.0 only report the cursor type, a BasicCursor there is a collection scan.
+
+    :param explain_output: dict returned by cursor.explain()
+    :return: list of stage names, eg ['FETCH', 'IXSCAN']
+    """
+    stages = []
+    plan = explain_output.get("queryPlanner", {}).get("winningPlan")
+    if plan is None:
+        cursor_type = explain_output.get("cursor", "")
+        if cursor_type.startswith("BasicCursor"):
+            return ["COLLSCAN"]
+        if cursor_type:
+            return ["IXSCAN"]
+        return stages
+
+    pending = [plan]
+    while pending:
+        plan = pending.pop(0)
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        if "inputStage" in plan:
+            pending.append(plan["inputStage"])
+        pending.extend(plan.get("inputStages", []))
+    return stages
+
+
 class mongodb(abstract_db):
     """MongoDB database"""
 
@@ -1148,7 +1999,11 @@ class mongodb(abstract_db):
         self._slave_okay = kwargs.get('slave_okay', False)
         self._collection = kwargs.get('collection', self.DEFAULT_COLLECTION)
         self._use_gridfs = kwargs.get('use_gridfs', False)
+        self._ensure_indexes = kwargs.get('ensure_indexes', True)
+        self._lock_lease_seconds = kwargs.get('lock_lease_seconds', LOCK_LEASE_SECONDS)
+        self._lock_state = lock_state(kwargs.get('lock_cache_ttl', LOCK_CACHE_TTL))
         self._raw_gridfs = None
+        self._raw_gridfs_files = None
         self._raw_db = None
         self._raw_collection = None
         self._kwargs = kwargs
@@ -1290,9 +2145,104 @@ class mongodb(abstract_db):
         if self._use_gridfs:
             self._raw_gridfs = gridfs.GridFS(self._raw_db,
                                              collection=self._collection + "_gfs")
+            self._raw_gridfs_files = self._raw_db[self._collection + "_gfs.files"]
+            if self._ensure_indexes:
+                self._raw_gridfs_files.create_index([("_dataBlobID", pymongo.ASCENDING),
+                                                     ("filename", pymongo.ASCENDING)])
+        elif self._ensure_indexes:
+            self.ensureDataBlobIDIndex()
 
         return True
 
+    def ensureDataBlobIDIndex(self):
+        """Make sure _dataBlobID lookups use an index. The index is unique (and sparse, so plain documents
+        without a _dataBlobID are fine); if the collection already holds duplicate ids a regular index is
+        built instead."""
+        try:
+            return self._raw_collection.create_index("_dataBlobID", unique=True, sparse=True)
+        except pymongo.errors.DuplicateKeyError:
+            logger.warning("Duplicate _dataBlobID values in %s.%s, creating a non unique index" %
+                           (self._database, self._collection))
+        except pymongo.errors.OperationFailure:
+            logger.exception("Could not create the _dataBlobID index on %s.%s" % (self._database, self._collection))
+            return None
+
+        try:
+            return self._raw_collection.create_index("_dataBlobID")
+        except pymongo.errors.OperationFailure:
+            logger.exception("Could not create the _dataBlobID index on %s.%s" % (self._database, self._collection))
+            return None
+
+    def ensureTagIndexes(self, input_tags, output_tags):
+        """Index the fields of the manager's tag query and check the query no longer scans the collection.
+
+        Input tags get sparse indexes, only documents that have the field are indexed, which is exactly the
+        set {tag: {$exists: True}} selects. Output tags get regular indexes since a sparse index can't answer
+        {tag: {$exists: False}}; the unprocessed documents are the (small) null range of that index.
+            Input:
+                input_tags:  fields a document must have to be processed
+                output_tags: fields that mark a document as already processed
+            Output:
+                list of the index names
+        """
+        if self._raw_gridfs is not None:
+            return []
+
+        index_names = []
+        for tag in input_tags or []:
+            try:
+                index_names.append(self._raw_collection.create_index(tag, sparse=True))
+            except pymongo.errors.OperationFailure:
+                logger.exception("Could not create an index on %s in %s.%s" % (tag, self._database, self._collection))
+        for tag in output_tags or []:
+            try:
+                index_names.append(self._raw_collection.create_index(tag))
+            except pymongo.errors.OperationFailure:
+                logger.exception("Could not create an index on %s in %s.%s" % (tag, self._database, self._collection))
+
+        query = {}
+        for tag in input_tags or []:
+            query[tag] = {"$exists": True}
+        for tag in output_tags or []:
+            query[tag] = {"$exists": False}
+        if query:
+            self.explainQuery(query)
+
+        return index_names
+
+    def explainQuery(self, query, **kwargs):
+        """Run explain() on a query and warn if the winning plan is still a collection scan.
+            Input:
+                query:  mongo query document
+                kwargs: sort and limit for the cursor
+            Output:
+                list of the stages in the winning plan
+        """
+        cursor = self._raw_collection.find(query)
+        if kwargs.get("sort") is not None:
+            cursor = cursor.sort(kwargs.get("sort"))
+        if kwargs.get("limit"):
+            cursor = cursor.limit(kwargs.get("limit"))
+
+        try:
+            stages = getQueryPlanStages(cursor.explain())
+        except pymongo.errors.OperationFailure:
+            logger.exception("Could not explain query %s on %s.%s" % (str(query), self._database, self._collection))
+            return []
+
+        if "COLLSCAN" in stages:
+            logger.warning("Query %s on %s.%s is doing a collection scan" % (str(query), self._database,
+                                                                                self._collection))
+        return stages
+
+    def ping(self):
+        """Check the server still answers commands."""
+        try:
+            self._server.admin.command('ping')
+            return True
+        except Exception:
+            return False
+
     def close(self):
         """Close connection to MongoDB."""
         self._server.close()
@@ -1318,28 +2268,218 @@ class mongodb(abstract_db):
         return saved
 
     def storeDataBlob(self, blob, update_rev=False, **kwargs):
-        """Store the data blob to the database using any optional parameters"""
+        """Store the data blob to the database using any optional parameters. A blob loaded from this
+        database only sends the meta data fields that changed ($set/$unset), unless its binary data changed."""
         if blob is None:
             return False
 
         # All DB operations check for locks
         self.waitOnLock()
 
+        if self._raw_gridfs is not None:
+            return self.storeGridFSBlob(blob)
+
+        uuid = blob.getDataBlobUUID()
+        update = self.create_partial_update(blob)
+        if update is not None and (not update or self.updateDocument(uuid, update)):
+            blob.markMetaDataStored(self)
+            return uuid
+
+        mongo_doc = self.create_native_doc(blob)
+        if uuid is None:
+            return self.store(mongo_doc, **kwargs)
+
+        # Replace in place (or insert) in one round trip, keeping the stored _id
+        if hasattr(self._raw_collection, "replace_one"):
+            self._raw_collection.replace_one({"_dataBlobID": uuid}, mongo_doc, upsert=True)
+        else:
+            self._raw_collection.update({"_dataBlobID": uuid}, mongo_doc, upsert=True)
+        self.markDataBlobStored(blob)
+
+        return uuid
+
+    def create_native_doc(self, blob):
+        """Mongo document for a data blob, without an _id so replacing it keeps the stored one"""
         mongo_doc = data_blob.blob2dict(blob)
+        mongo_doc.pop("_id", None)
+        return mongo_doc
 
-        # TODO Temporary fix
-        self.deleteDataBlob(blob.getMetaData("_dataBlobID"))
+    def create_partial_update(self, blob):
+        """$set/$unset update document carrying the meta data changed since the blob was loaded from (or
+        stored to) this database, {} if nothing changed, None if the whole document has to be written"""
+        if blob.getDataBlobUUID() is None or blob.getChangedBinaryFields():
+            return None
+        changes = blob.getMetaDataChanges(self)
+        if changes is None:
+            return None
+        return mongoUpdateDocument(changes[0], changes[1])
 
-        doc_info = self.store(mongo_doc, **kwargs)
+    def updateDocument(self, uuid, update):
+        """Apply an update document to the stored document, False if there is no such document"""
+        if hasattr(self._raw_collection, "update_one"):
+            return self._raw_collection.update_one({"_dataBlobID": uuid}, update).matched_count > 0
+        return self._raw_collection.update({"_dataBlobID": uuid}, update).get("n", 0) > 0
 
-        return doc_info
+    def markDataBlobStored(self, blob):
+        """Record the blob as matching what this database holds so later stores only send what changed"""
+        blob.markBinaryDataStored()
+        blob.markMetaDataStored(self)
 
     def storeDataBlobArray(self, data_blob_array, **kwargs):
-        """Stores an array of data blobs to the database."""
-        # All DB operations check for locks
+        """Stores an array of data blobs to the database with unordered bulk writes keyed on _dataBlobID,
+        sent in chunks of at most batch_size documents and batch_bytes bytes. Blobs loaded from this database
+        are sent as partial ($set/$unset) updates of their changed fields, the others replace (or insert)
+        the whole document.
+            Input:
+                batch_size:  documents per bulk request
+                batch_bytes: approximate BSON bytes per bulk request
+            Output:
+                list of the ids of the documents that could not be stored
+        """
+        batch_size = kwargs.get('batch_size', BULK_WRITE_BATCH_SIZE)
+        batch_bytes = kwargs.get('batch_bytes', BULK_WRITE_BATCH_BYTES)
+
+        # All DB operations check for locks (once for the whole array)
         self.waitOnLock()
+
+        failed_ids = []
+        if self._raw_gridfs is not None:
+            for blob in data_blob_array:
+                try:
+                    self.storeGridFSBlob(blob)
+                except Exception:
+                    logger.exception("Failed to store document " + str(blob.getDataBlobUUID()))
+                    failed_ids.append(blob.getDataBlobUUID())
+            return failed_ids
+
+        batch = []
+        num_bytes = 0
         for blob in data_blob_array:
-            self.storeDataBlob(blob)
+            update = self.create_partial_update(blob)
+            if update == {}:
+                # Nothing changed
+                continue
+            if update is None:
+                operation = (blob, None, self.create_native_doc(blob))
+                doc_bytes = len(bson.BSON.encode(operation[2]))
+            else:
+                operation = (blob, update, None)
+                doc_bytes = len(bson.BSON.encode(update))
+            if batch and (len(batch) >= batch_size or num_bytes + doc_bytes > batch_bytes):
+                failed_ids.extend(self.bulkStore(batch))
+                batch = []
+                num_bytes = 0
+            batch.append(operation)
+            num_bytes += doc_bytes
+        if batch:
+            failed_ids.extend(self.bulkStore(batch))
+
+        return failed_ids
+
+    def storeObservationArray(self, observations, **kwargs):
+        """Stores an array of observations to the database, see storeDataBlobArray"""
+        logger.info("Storing " + str(len(observations)) + " docs to mongo:" + str(kwargs))
+        return self.storeDataBlobArray(observations, **kwargs)
+
+    def markProgress(self, progress, **kwargs):
+        """Set fields on stored documents with bulk $set updates, nothing is loaded. See abstract_db.
+            Input:
+                batch_size: documents per bulk request
+        """
+        if self._raw_gridfs is not None:
+            return abstract_db.markProgress(self, progress, **kwargs)
+
+        batch_size = kwargs.get('batch_size', BULK_WRITE_BATCH_SIZE)
+
+        # All DB operations check for locks (once for the whole array)
+        self.waitOnLock()
+
+        failed_ids = []
+        operations = []
+        for uuid, fields in progress.iteritems():
+            update = mongoUpdateDocument(fields, [])
+            if update is None:
+                logger.error("Can't mark progress on document " + str(uuid) + " with fields " + str(fields.keys()))
+                failed_ids.append(uuid)
+            elif update:
+                operations.append((uuid, update, None))
+
+        for start in range(0, len(operations), batch_size):
+            batch = operations[start:start + batch_size]
+            matched, batch_failed_ids = self.bulkWrite(batch)
+            failed_ids.extend(batch_failed_ids)
+            num_missing = len(batch) - len(batch_failed_ids) - matched
+            if num_missing > 0:
+                logger.info("Could not find " + str(num_missing) + " documents to mark progress on in mongo database " +
+                            self._host + ' ' + str(self._database))
+                # The bulk result only counts them, look up which ones are gone
+                uuids = [uuid for uuid, update, mongo_doc in batch if uuid not in batch_failed_ids]
+                found = set(mongo_doc["_dataBlobID"] for mongo_doc in
+                            self._raw_collection.find({"_dataBlobID": {"$in": uuids}}, {"_dataBlobID": 1}))
+                failed_ids.extend(uuid for uuid in uuids if uuid not in found)
+
+        return failed_ids
+
+    def bulkStore(self, operations):
+        """Send the (blob, update, mongo_doc) operations of one chunk, the partial updates first. If some
+        of those find no document (deleted since it was loaded) the chunk's updated blobs are written whole.
+        Returns the ids of the documents that failed."""
+        updates = [operation for operation in operations if operation[1] is not None]
+        replaces = [operation for operation in operations if operation[1] is None]
+
+        failed_ids = []
+        if updates:
+            matched, update_failed_ids = self.bulkWrite([(blob.getDataBlobUUID(), update, mongo_doc)
+                                                         for blob, update, mongo_doc in updates])
+            if matched < len(updates) - len(update_failed_ids):
+                replaces.extend([(blob, None, self.create_native_doc(blob)) for blob, update, mongo_doc in updates
+                                 if blob.getDataBlobUUID() not in update_failed_ids])
+            failed_ids.extend(update_failed_ids)
+        if replaces:
+            failed_ids.extend(self.bulkWrite([(blob.getDataBlobUUID(), update, mongo_doc)
+                                              for blob, update, mongo_doc in replaces])[1])
+
+        for blob, update, mongo_doc in operations:
+            if blob.getDataBlobUUID() not in failed_ids:
+                self.markDataBlobStored(blob)
+        return failed_ids
+
+    def bulkWrite(self, operations):
+        """Send one unordered bulk request for the (uuid, update, mongo_doc) operations: apply the update
+        to the document with that _dataBlobID, or replace (or insert) the document by _dataBlobID.
+        Documents without a _dataBlobID are inserted. Returns (number of updated documents found, ids of
+        the documents that failed)."""
+        if hasattr(self._raw_collection, "bulk_write"):
+            requests = []
+            for uuid, update, mongo_doc in operations:
+                if update is not None:
+                    requests.append(pymongo.UpdateOne({"_dataBlobID": uuid}, update))
+                elif uuid is None:
+                    requests.append(pymongo.InsertOne(mongo_doc))
+                else:
+                    requests.append(pymongo.ReplaceOne({"_dataBlobID": uuid}, mongo_doc, upsert=True))
+            execute = lambda: self._raw_collection.bulk_write(requests, ordered=False).bulk_api_result
+        else:
+            bulk = self._raw_collection.initialize_unordered_bulk_op()
+            for uuid, update, mongo_doc in operations:
+                if update is not None:
+                    bulk.find({"_dataBlobID": uuid}).update_one(update)
+                elif uuid is None:
+                    bulk.insert(mongo_doc)
+                else:
+                    bulk.find({"_dataBlobID": uuid}).upsert().replace_one(mongo_doc)
+            execute = bulk.execute
+
+        try:
+            result = execute()
+        except pymongo.errors.BulkWriteError, e:
+            result = e.details
+        failed_ids = []
+        for error in result.get("writeErrors", []):
+            doc_id = operations[error["index"]][0]
+            logger.error("Failed to store document " + str(doc_id) + ": " + str(error.get("errmsg")))
+            failed_ids.append(doc_id)
+        return result.get("nMatched", 0), failed_ids
 
     def loadDataBlob(self, uuid, **kwargs):
         """Loads a data blob from the database. Returns a reference to the
@@ -1363,12 +2503,10 @@ class mongodb(abstract_db):
         must_exist = kwargs.get('must_exist', True)
 
         if self._raw_gridfs is not None:
-            try:
-                mongo_doc = marshal.loads(self._raw_gridfs.get(uuid, **kwargs).read())
-            except:
-                if (must_exist):
-                    raise RuntimeError("Data Retrieval Error")
-                return None
+            blob = self.loadGridFSBlob(uuid)
+            if blob is None and must_exist:
+                raise RuntimeError("Data Retrieval Error")
+            return blob
         else:
             cursor = self._raw_collection.find({"_dataBlobID": uuid})
             # See if the document is in db
@@ -1381,10 +2519,67 @@ class mongodb(abstract_db):
 
         # Create the data blob
         blob = data_blob.dict2blob(mongo_doc)
+        self.markDataBlobStored(blob)
 
         # Return the data blob
         return blob
 
+    def loadDataBlobArray(self, uuids, **kwargs):
+        """Loads a list of data blobs from the database with one $in query per page
+           of uuids instead of a find and count per document.
+
+            Input:
+               uuids:  list of unique ids (unique names) for the data blobs
+               kwargs: parameters to pass to data blob's __init__ method
+                            (key=value args)
+                   include_binary: flag for pulling down all binary fields
+                            (defaults to False)
+                   page_size: number of uuids per query (defaults to 1000)
+            Output:
+               (data_blobs, missing_uuids) where data_blobs are in the order of uuids
+        """
+        page_size = kwargs.pop('page_size', 1000)
+        if page_size is None or page_size < 1:
+            page_size = 1000
+
+        # GridFS files are stored whole, so there is nothing to batch
+        if self._raw_gridfs is not None:
+            data_blobs = []
+            missing_uuids = []
+            for uuid in uuids:
+                # loadDataBlob passes its kwargs through to gridfs, so rely on its must_exist error
+                try:
+                    data_blobs.append(self.loadDataBlob(uuid))
+                except RuntimeError:
+                    missing_uuids.append(uuid)
+            return data_blobs, missing_uuids
+
+        # All DB operations check for locks (once for the whole array)
+        self.waitOnLock()
+
+        mongo_docs = {}
+        for start in range(0, len(uuids), page_size):
+            keys = uuids[start:start + page_size]
+            for mongo_doc in self._raw_collection.find({"_dataBlobID": {"$in": keys}}):
+                mongo_docs.setdefault(mongo_doc["_dataBlobID"], mongo_doc)
+
+        data_blobs = []
+        missing_uuids = []
+        for uuid in uuids:
+            mongo_doc = mongo_docs.get(uuid)
+            if mongo_doc is None:
+                missing_uuids.append(uuid)
+            else:
+                blob = data_blob.dict2blob(mongo_doc)
+                self.markDataBlobStored(blob)
+                data_blobs.append(blob)
+
+        if missing_uuids:
+            logger.info("Could not find " + str(len(missing_uuids)) + " data blobs in mongo database " +
+                        str(self._host) + ' ' + str(self._database))
+
+        return data_blobs, missing_uuids
+
     def deleteDataBlob(self, uuid, no_checks=False):
         """Delete the data blob from the database.
             Input:
@@ -1395,10 +2590,91 @@ class mongodb(abstract_db):
             self.waitOnLock()
 
         if self._raw_gridfs is not None:
-            self._raw_gridfs.delete(uuid)
+            for gridfs_file in self._raw_gridfs_files.find({"_dataBlobID": uuid}, {"_id": 1}):
+                self._raw_gridfs.delete(gridfs_file["_id"])
         else:
             self._raw_collection.remove({"_dataBlobID": uuid})
 
+    def storeGridFSBlob(self, blob):
+        """Store a data blob in GridFS as one file holding the marshalled meta data plus one file per binary
+        field, streamed as is. Binary files whose digest hasn't changed since the last store are kept, so a
+        meta data update only rewrites the (small) meta data file."""
+        uuid = blob.getDataBlobUUID()
+        if isinstance(uuid, bson.objectid.ObjectId):
+            uuid = str(uuid)
+
+        old_meta_files = []
+        old_binary_files = {}
+        for gridfs_file in self._raw_gridfs_files.find({"_dataBlobID": uuid}).sort("uploadDate", pymongo.ASCENDING):
+            if gridfs_file.get("filename") is None:
+                old_meta_files.append(gridfs_file["_id"])
+            else:
+                old_binary_files.setdefault(gridfs_file["filename"], []).append(gridfs_file)
+
+        # Stubs that came from this database still point at their files; anything else has to be loaded
+        binary_files = {}
+        for field in blob.getBinaryDataStubs().keys():
+            if blob.getDB() is self and field in old_binary_files:
+                gridfs_file = old_binary_files[field][-1]
+                binary_files[field] = {"file_id": str(gridfs_file["_id"]), "digest": gridfs_file.get("digest"),
+                                       "content_type": gridfs_file.get("contentType"),
+                                       "length": gridfs_file.get("length")}
+            else:
+                blob.loadBinaryDataStub(field)
+
+        for field, binary in blob.getBinaryDataDict(load_stubs=False).iteritems():
+            digest = data_blob.binaryDigest(binary["data"])
+            if field in old_binary_files and old_binary_files[field][-1].get("digest") == digest:
+                gridfs_file = old_binary_files[field][-1]
+                file_id = gridfs_file["_id"]
+            else:
+                file_id = self._raw_gridfs.put(binary["data"], filename=field, contentType=binary["mime_type"],
+                                               encoding="utf-8", _dataBlobID=uuid, digest=digest)
+            binary_files[field] = {"file_id": str(file_id), "digest": digest, "content_type": binary["mime_type"],
+                                   "length": len(binary["data"])}
+
+        mongo_doc = data_blob.blob2dict(blob, include_binary=False)
+        mongo_doc.pop("_id", None)
+        mongo_doc["_dataBlobID"] = uuid
+        mongo_doc["_binary_files"] = binary_files
+        self._raw_gridfs.put(marshal.dumps(mongo_doc), _dataBlobID=uuid)
+        blob.markBinaryDataStored()
+
+        # Drop the previous meta data and any binary files no longer referenced
+        kept_ids = set([binary["file_id"] for binary in binary_files.itervalues()])
+        for file_id in old_meta_files:
+            self._raw_gridfs.delete(file_id)
+        for gridfs_files in old_binary_files.itervalues():
+            for gridfs_file in gridfs_files:
+                if str(gridfs_file["_id"]) not in kept_ids:
+                    self._raw_gridfs.delete(gridfs_file["_id"])
+
+        return uuid
+
+    def loadGridFSBlob(self, uuid):
+        """Load the meta data of a GridFS stored data blob, its binary fields are stubs read from their own
+        files on first access. Returns None if there is no such blob."""
+        meta_file = self._raw_gridfs_files.find_one({"_dataBlobID": uuid, "filename": {"$exists": False}},
+                                                    sort=[("uploadDate", pymongo.DESCENDING)])
+        if meta_file is None:
+            return None
+
+        mongo_doc = marshal.loads(self._raw_gridfs.get(meta_file["_id"]).read())
+        binary_files = mongo_doc.pop("_binary_files", {})
+
+        # Documents written before the binaries were split out still carry inline _attachments
+        blob = data_blob.dict2blob(mongo_doc)
+        blob.setDB(self)
+        for field, binary in binary_files.iteritems():
+            blob.setBinaryDataStub(field, binary["content_type"], binary["length"], binary["digest"])
+        file_ids = dict([(field, binary["file_id"]) for field, binary in binary_files.iteritems()])
+        blob.setBinaryDataLoader(binary_loader(self, "loadGridFSBinary", file_ids=file_ids))
+        return blob
+
+    def loadGridFSBinary(self, field, file_ids):
+        """Read the data of one binary field of a GridFS stored data blob from its own file"""
+        return self._raw_gridfs.get(bson.objectid.ObjectId(file_ids[field])).read()
+
     def getBlobRevision(self, uuid):
         doc = self.loadDataBlob(uuid)
         rev = doc.getDataBlobRevision()
@@ -1421,35 +2697,71 @@ class mongodb(abstract_db):
         else:
             return self.view(self, name, logger, **kwargs)
 
-    def setLock(self):
-        """Lock the database"""
-        self.waitOnLock()
+    def loadLock(self):
+        """Read the lock document (None if the database isn't locked) and refresh the cached lock state"""
+        lock = self._raw_collection.find_one({"_dataBlobID": "database_lock"})
+        self._lock_state.set(lock)
+        return lock
+
+    def setLock(self, lease_seconds=None):
+        """Lock the database with a lease that expires lease_seconds (lock_lease_seconds by default) after
+        it was taken unless renewed"""
+        if lease_seconds is None:
+            lease_seconds = self._lock_lease_seconds
+        while True:
+            lock = self.loadLock()
+            if isLockHeld(lock, id(self)):
+                logger.info("<<<Waiting on Locked Database>>>")
+                time.sleep(lockWaitSeconds(lock))
+                continue
 
-        lock = {"_dataBlobID": "database_lock", "lock_instance": id(self)}
-        self._raw_collection.insert(lock)
+            # Clear an expired lease, then race for the lock
+            self._raw_collection.remove({"_dataBlobID": "database_lock", "lease_expires": {"$lte": time.time()}})
+            new_lock = {"_dataBlobID": "database_lock", "lock_instance": id(self), "lease_seconds": lease_seconds,
+                        "lease_expires": time.time() + lease_seconds}
+            try:
+                self._raw_collection.insert(dict(new_lock))
+                break
+            except pymongo.errors.DuplicateKeyError:
+                # The _dataBlobID index is unique, so the insert fails if someone else took the lock
+                # between the read and the insert (or we already hold it)
+                if self._raw_collection.find_one({"_dataBlobID": "database_lock", "lock_instance": id(self)}):
+                    self.renewLock()
+                    break
+        self._lock_state.set(new_lock)
         logger.info("<<<Locking Database>>>")
 
+    def renewLock(self):
+        """Extend the lease on a lock we hold. Returns False if the lock isn't ours (anymore)."""
+        lock = self._raw_collection.find_one({"_dataBlobID": "database_lock", "lock_instance": id(self)})
+        if lock is None:
+            return False
+        lock["lease_expires"] = time.time() + lock.get("lease_seconds", self._lock_lease_seconds)
+        self._raw_collection.update({"_id": lock["_id"]}, {"$set": {"lease_expires": lock["lease_expires"]}})
+        self._lock_state.set(lock)
+        return True
+
     def isLocked(self):
-        """Return True/False based on database locked state"""
-        cursor = self._raw_collection.find({"_dataBlobID": "database_lock"})
-        if cursor.count() == 1:
-            # If the lock is someone elses then it's locked
-            lock = cursor[0]
-            if (lock["lock_instance"] != id(self)):
-                return True
-        return False
+        """Return True/False based on database locked state (always reads the lock document)"""
+        return isLockHeld(self.loadLock(), id(self))
 
     def removeLock(self):
         """Remove the lock on the database"""
         self._raw_collection.remove({"_dataBlobID": "database_lock",
                                      "lock_instance": id(self)})
+        self._lock_state.invalidate()
         logger.info("<<<Unlocking Database>>>")
 
     def waitOnLock(self):
-        """Wait on a locked database"""
-        while self.isLocked():
-            time.sleep(5)
+        """Wait on a locked database. Uses the cached lock state, so while the database is unlocked this
+        costs no query; an abandoned lock stops blocking once its lease expires."""
+        lock = self._lock_state.get()
+        if self._lock_state.isStale():
+            lock = self.loadLock()
+        while isLockHeld(lock, id(self)):
+            time.sleep(lockWaitSeconds(lock))
             logger.info("<<<Waiting on Locked Database>>>")
+            lock = self.loadLock()
 
     def compact(self):
         """Send the compact command to the raw database"""
@@ -6,6 +6,9 @@ the U.S. Government retains certain rights in this software.
 import datetime
 import gc
 import logging
+import math
+import multiprocessing
+import multiprocessing.pool
 import sys
 import time
 
@@ -15,27 +18,52 @@ import utils
 
 logger = logging.getLogger(__name__)
 
+# Workers built in this process by initializeWorkers, by configuration id
+_process_workers = {}
+
+
+def initializeWorkers(worker_configs):
+    """
+    Pool initializer: build the workers of each configuration once in the pool process, from their JSON
+    definitions, so every task the process runs reuses them
+    worker_configs : {config_id: [worker JSON definition (utils.getJSONDefinition), ...]}
+    """
+    for config_id, definitions in worker_configs.iteritems():
+        _process_workers[config_id] = [utils.instantiateJSONDefinition(definition) for definition in definitions]
+
+
+def taskEvaluateConfiguredDocuments(config_id, task, **kwargs):
+    """
+    TASK for pools started with initializeWorkers, only the task and the configuration id are sent over
+    config_id : id of the workers' configuration
+    task      : task (equivalent to items on threading.queue previously)
+    """
+    return taskEvaluateDocuments(_process_workers[config_id], task, **kwargs)
+
 
 def taskEvaluateDocuments(workers, task, **kwargs):
     """
     TASK
     task   : task (equivalent to items on threading.queue previously)
+    Returns the start_time and end_time of the task as measured where it ran, so the manager times the
+    work itself rather than the time the task spent queued in the pool
     """
     #    sys.stdout = open(str(os.getpid()) + ".out", "w")
     #    sys.stderr = open(str(os.getpid()) + ".err", "w")
 
+    start_time = time.time()
     print "taskEvalauate documents"
     input_db_type = kwargs.get("input_db_type")
     input_db_host = kwargs.get("input_db_host")
     input_db_name = kwargs.get("input_db_name")
 
-    input_db = hybrid.db.init(input_db_type, host=input_db_host, database=input_db_name, create=False)
+    input_db = hybrid.db.get_connection(input_db_type, host=input_db_host, database=input_db_name, create=False)
 
     output_db_type = kwargs.get("output_db_type")
     output_db_host = kwargs.get("output_db_host")
     output_db_name = kwargs.get("output_db_name")
 
-    output_db = hybrid.db.init(output_db_type, host=output_db_host, database=output_db_name, create=False)
+    output_db = hybrid.db.get_connection(output_db_type, host=output_db_host, database=output_db_name, create=False)
 
     same_db = True
     if not (input_db_type == output_db_type):
@@ -49,18 +77,26 @@ def taskEvaluateDocuments(workers, task, **kwargs):
     if (output_tag_list == None):
         output_tag_list = []
 
-    observations = []
-    uuids = task["uuids"]
-    for document_index in range(0, len(uuids)):
-        uuid = uuids[document_index]
+    # Run the workers level by level from their dependencies instead of one at a time
+    concurrent_workers = kwargs.pop("concurrent_workers", False)
 
+    # Pull the whole task's documents in one batched request
+    uuids = task["uuids"]
+    try:
+        observations, missing_uuids = input_db.loadDataBlobArray(uuids, include_binary=True)
+        for uuid in missing_uuids:
+            logger.info("Skipping uuid %s for evaluation from db name= %s" % (uuid, input_db.db_name))
+    except:
+        logger.exception("Could not load the documents for evaluation from db name= %s" % (input_db.db_name,))
+        observations = []
+
+    if concurrent_workers:
         try:
-            doc = input_db.loadDataBlob(uuid, include_binary=True)
-            if not (doc == None):
-                observations.append(doc)
+            observations, incomplete_observations = evaluateWorkerLevels(workers, observations, **kwargs)
+            storeResults(input_db, output_db, same_db, output_tag_list, observations, incomplete_observations)
         except:
-            logger.info("Skipping uuid %s for evaluation from db name= %s" % (uuid, input_db.getDBName))
-            continue
+            logger.exception("manager having issues")
+        return {"start_time": start_time, "end_time": time.time()}
 
     for worker in workers:
         # Open a connection to the database and couch logger
@@ -68,57 +104,8 @@ def taskEvaluateDocuments(workers, task, **kwargs):
             # Register cleanup command
             # evaluation.registerCleanupCommand(evaluation.cleanup)
 
-            batch_context = {}
-            worker.batch_init(batch_context=batch_context, **kwargs)
-            if worker.uses_model() == True:
-                model = worker.get_model()
-                loaded = False
-                reloaded = False
-                while not (loaded):
-                    try:
-                        loaded = model.loadFromDB()
-                        if (reloaded):
-                            logger.info("Loaded model successfully after reloading!!!!!]]]]]]]")
-                    except Exception, e:
-                        logger.exception("Gonna try this again hopefully...")
-                        reloaded = True
-
-            observations, incomplete_observations = worker.process_observations(observations, **kwargs)
-            worker.batch_finalize(batch_context=batch_context, **kwargs)
-
-            # If the input and output databases aren't the same, go ahead and store the datablob to the output_db
-            if not same_db:
-                for observation in observations:
-                    output_db.storeDataBlob(observation, ignore_conflict=True)
-                for observation in incomplete_observations:
-                    output_db.storeDataBlob(observation, ignore_conflict=True)
-
-            # Modify the input database to mark the current observations as having been processed.
-            # This is done by adding the output tags.
-            #
-            # If everything was fine with the processing, the output tag gets a "complete" value.
-            # A value of "incomplete" signifies that something was wrong, such as a missing data dependency.
-            logger.info("====Storing output tags for documents====")
-            for observation in observations:
-                if same_db:
-                    doc = observation
-                else:
-                    doc = input_db.loadDataBlob(observation.getMetaData("_dataBlobID"), include_binary=True)
-                for j in range(0, len(output_tag_list)):
-                    doc.setMetaData(output_tag_list[j], "complete")
-                    doc.setMetaData(output_tag_list[j] + "_datetime",
-                                    datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%SZ"))
-                               # logger.info("storing tag " + output_tag_list[j] + " = complete on doc " + doc.getDataBlobUUID() + " in database " + str(input_db)
-                input_db.storeDataBlob(doc, ignore_conflict=True)
-            for observation in incomplete_observations:
-                if same_db:
-                    doc = observation
-                else:
-                    doc = input_db.loadDataBlob(observation.getMetaData("_dataBlobID"), include_binary=True)
-                for j in range(0, len(output_tag_list)):
-                    doc.setMetaData(output_tag_list[j], "incomplete")
-                input_db.storeDataBlob(doc, ignore_conflict=True)
-            logger.info("====Done storing output tags for documents====")
+            observations, incomplete_observations = evaluateWorker(worker, observations, **kwargs)
+            storeResults(input_db, output_db, same_db, output_tag_list, observations, incomplete_observations)
 
             # Check if something bad happened (like the models were changed)
             # if (len(observations) + len(incomplete_observations) == 0):
@@ -131,7 +118,172 @@ def taskEvaluateDocuments(workers, task, **kwargs):
         #            logger.error("(Exception):, %s"%(str(e)) )
         #            logger.error( "LDA on this range [%s to %s] num_docs=%d"%(start_key, end_key, num_docs))
         # sys.exit(1)
-    return None
+    return {"start_time": start_time, "end_time": time.time()}
+
+
+def evaluateWorker(worker, observations, **kwargs):
+    """ Run one worker over the batch: batch_init, (re)load its model, process_observations and
+        batch_finalize. Returns the (complete, incomplete) observations. """
+    batch_context = {}
+    worker.batch_init(batch_context=batch_context, **kwargs)
+    if worker.uses_model() == True:
+        model = worker.get_model()
+        loaded = False
+        reloaded = False
+        while not (loaded):
+            try:
+                loaded = model.loadFromDB()
+                if (reloaded):
+                    logger.info("Loaded model successfully after reloading!!!!!]]]]]]]")
+            except Exception, e:
+                logger.exception("Gonna try this again hopefully...")
+                reloaded = True
+
+    observations, incomplete_observations = worker.process_observations(observations, **kwargs)
+    worker.batch_finalize(batch_context=batch_context, **kwargs)
+    return observations, incomplete_observations
+
+
+def storeResults(input_db, output_db, same_db, output_tag_list, observations, incomplete_observations):
+    """ Write the processed observations back (to the output database too if it isn't the input database)
+        and mark them with the output tags """
+    # If the input and output databases aren't the same, go ahead and store the datablob to the output_db
+    if not same_db:
+        output_db.storeDataBlobArray(observations + incomplete_observations, ignore_conflict=True)
+
+    # Modify the input database to mark the current observations as having been processed.
+    # This is done by adding the output tags.
+    #
+    # If everything was fine with the processing, the output tag gets a "complete" value.
+    # A value of "incomplete" signifies that something was wrong, such as a missing data dependency.
+    logger.info("====Storing output tags for documents====")
+    completed_datetime = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%SZ")
+    progress = {}
+    for observation in observations:
+        tags = {}
+        for j in range(0, len(output_tag_list)):
+            tags[output_tag_list[j]] = "complete"
+            tags[output_tag_list[j] + "_datetime"] = completed_datetime
+        progress[observation.getMetaData("_dataBlobID")] = tags
+    for observation in incomplete_observations:
+        tags = {}
+        for j in range(0, len(output_tag_list)):
+            tags[output_tag_list[j]] = "incomplete"
+        progress[observation.getMetaData("_dataBlobID")] = tags
+
+    if same_db:
+        # The observations go back to the input database anyway, the tags ride along in one bulk write
+        for observation in observations + incomplete_observations:
+            for field, value in progress[observation.getMetaData("_dataBlobID")].iteritems():
+                observation.setMetaData(field, value)
+        input_db.storeDataBlobArray(observations + incomplete_observations, ignore_conflict=True)
+    else:
+        # Only the tags go back to the input database, its documents are never reloaded
+        input_db.markProgress(progress)
+    logger.info("====Done storing output tags for documents====")
+
+
+def workerLevels(workers):
+    """
+    Group the workers into levels from their data dependencies (set_worker_dependency or
+    worker_data_dependencies, by worker name or nest name): each worker goes in the level after the last
+    of the workers it depends on, so the workers in a level don't depend on each other. Dependencies on
+    workers outside the list are left to check_data_versions. If the dependencies have a cycle every
+    worker gets a level of its own, in the configured order.
+    """
+    indexes_by_name = {}
+    for index, worker in enumerate(workers):
+        for name in set([worker.get_name(), worker.get_nest_name()]):
+            indexes_by_name.setdefault(name, []).append(index)
+
+    dependencies = []
+    for index, worker in enumerate(workers):
+        depends_on = set()
+        for name in worker.get_worker_dependencies():
+            depends_on.update(other for other in indexes_by_name.get(name, []) if other != index)
+        dependencies.append(depends_on)
+
+    level_of = {}
+    remaining = range(len(workers))
+    while remaining:
+        ready = [index for index in remaining if dependencies[index].issubset(level_of)]
+        if not ready:
+            logger.warning("The worker dependencies have a cycle, running the workers one at a time")
+            return [[worker] for worker in workers]
+        for index in ready:
+            level_of[index] = 1 + max([level_of[other] for other in dependencies[index]] or [-1])
+        remaining = [index for index in remaining if index not in level_of]
+
+    levels = [[] for i in range(1 + max(level_of.values() or [-1]))]
+    for index, worker in enumerate(workers):
+        levels[level_of[index]].append(worker)
+    return levels
+
+
+def evaluateWorkerLevels(workers, observations, **kwargs):
+    """
+    Run the workers level by level (see workerLevels) over the one loaded batch, the workers of a level
+    concurrently in threads. Each of those threads works on its own copies of the observations
+    (data_blob.workingCopy), and once the level is done every copy's changes are merged back into the
+    observations in the configured worker order. Fields all workers write (worker_data_version,
+    worker_bad_data, processed_datetime) come out as they would one worker at a time, and the observations
+    are only changed from this thread, ready for a single store afterwards. An observation goes on to the
+    next level only if every worker of the level completed it; a worker that raises is logged and its
+    changes dropped.
+    Returns the (complete, incomplete) observations.
+    """
+    levels = workerLevels(workers)
+    thread_pool = None
+    if max(len(level) for level in levels) > 1:
+        thread_pool = multiprocessing.pool.ThreadPool(max(len(level) for level in levels))
+
+    def evaluate(worker, level_observations):
+        try:
+            return evaluateWorker(worker, level_observations, **kwargs)
+        except:
+            logger.exception("Worker %s failed" % (worker.get_name(),))
+            return None
+
+    incomplete_observations = []
+    incomplete_uuids = set()
+    try:
+        for level in levels:
+            if len(level) == 1:
+                results = [evaluate(level[0], list(observations))]
+            else:
+                copies = [[observation.workingCopy() for observation in observations] for worker in level]
+                results = thread_pool.map(lambda args: evaluate(*args), zip(level, copies))
+                for worker_copies, result in zip(copies, results):
+                    if result is None:
+                        continue
+                    for observation, observation_copy in zip(observations, worker_copies):
+                        observation.mergeChanges(observation_copy)
+
+            observations_by_uuid = dict((observation.getMetaData("_dataBlobID"), observation)
+                                        for observation in observations)
+            complete_uuids = None
+            for result in results:
+                if result is None:
+                    continue
+                complete, incomplete = result
+                uuids = set(observation.getMetaData("_dataBlobID") for observation in complete)
+                complete_uuids = uuids if complete_uuids is None else complete_uuids & uuids
+                for observation in incomplete:
+                    uuid = observation.getMetaData("_dataBlobID")
+                    if uuid not in incomplete_uuids and uuid in observations_by_uuid:
+                        incomplete_uuids.add(uuid)
+                        incomplete_observations.append(observations_by_uuid[uuid])
+
+            if complete_uuids is not None:
+                observations = [observation for observation in observations
+                                if observation.getMetaData("_dataBlobID") in complete_uuids and
+                                observation.getMetaData("_dataBlobID") not in incomplete_uuids]
+    finally:
+        if thread_pool is not None:
+            thread_pool.close()
+            thread_pool.join()
+
+    return observations, incomplete_observations
 
 
 class manager:
@@ -180,8 +332,67 @@ class manager:
             self._adaptive_threads = True
         self._mp = None
 
+        # Number of batches allowed in flight at once; by default keep one
+        # batch queued behind every busy worker process
+        self._max_outstanding_tasks = kwargs.get("max_outstanding_tasks")
+        if self._max_outstanding_tasks is None:
+            self._max_outstanding_tasks = 2 * self._worker_threads
+        self._scheduler = None
+
+        # With adaptive_batches the number of batches in flight (1 to max_outstanding_tasks) and the documents
+        # per batch (observation_limit, min_observation_limit to max_observation_limit) are tuned while running
+        # from the backlog, the time per document and the database error rate, see controller.py
+        self._adaptive_batches = kwargs.get("adaptive_batches", False)
+        self._min_observation_limit = kwargs.get("min_observation_limit", max(1, self._observation_limit / 10))
+        self._max_observation_limit = kwargs.get("max_observation_limit", 4 * self._observation_limit)
+        self._target_task_seconds = kwargs.get("target_task_seconds", 30)
+        self._controller = None
+
+        # Learns what documents cost from the task timings, so tasks are balanced on work rather than counts
+        self._cost_model = hybrid.controller.task_cost_model()
+
+        # Build the workers once in every pool process from their JSON definitions instead of pickling them
+        # into every batch (needs workers loaded through utils.loadJSON). Pool processes are replaced after
+        # max_tasks_per_child batches, or once they grow past max_child_rss_mb.
+        self._persistent_workers = kwargs.get("persistent_workers", True)
+        self._max_tasks_per_child = kwargs.get("max_tasks_per_child")
+        self._max_child_rss_mb = kwargs.get("max_child_rss_mb")
+        self._worker_config_id = None
+
+        # Run independent workers (no set_worker_dependency/worker_data_dependencies between them) concurrently
+        # on each batch and store the batch once, rather than each worker in turn with a store after each
+        self._concurrent_workers = kwargs.get("concurrent_workers", False)
+
+        # Retrain stale models in a background process while batches are scored against the stored revision,
+        # for at most max_model_staleness seconds (None for no bound). Retrains by model uuid.
+        self._background_retraining = kwargs.get("background_retraining", False)
+        self._max_model_staleness = kwargs.get("max_model_staleness", 3600)
+        self._retrains = {}
+        if self._concurrent_workers:
+            logger.info("Worker levels: %s" % ([[worker.get_name() for worker in level]
+                                                 for level in workerLevels(self._workers)],))
+
         self._iteration_sleep = kwargs.get("iteration_sleep", 5)
         self._model_update_sleep = kwargs.get("model_update_sleep", 10)
+
+        # Event driven ingest: tail the input database's change feed instead of re-querying the view
+        # every iteration_sleep seconds. The view is still polled on start up, whenever the feed fails and
+        # every fallback_poll_interval seconds, to pick up anything the feed can't see.
+        self._use_change_feed = kwargs.get("change_feed", False)
+        self._change_feed_checkpoint_id = kwargs.get("change_feed_checkpoint_id")
+        if self._change_feed_checkpoint_id is None:
+            self._change_feed_checkpoint_id = "hybrid_" + "-".join(sorted(self._output_tag_list or []))
+        self._change_feed_timeout = kwargs.get("change_feed_timeout", self._iteration_sleep)
+        self._fallback_poll_interval = kwargs.get("fallback_poll_interval", 300)
+        self._change_feed = None
+        self._last_view_poll = None
+
+        # Let the input database index the fields of the tag query this manager runs every iteration
+        if kwargs.get("ensure_indexes", True) and self._input_db is not None:
+            try:
+                self._input_db.ensureTagIndexes(self._input_tag_list, self._output_tag_list)
+            except Exception:
+                logger.exception("Could not create the tag indexes on %s" % (str(self._input_db),))
         # log_manager.start_async()
 
     def cleanup(self):
@@ -226,23 +437,30 @@ class manager:
         #            document_view = input_db.loadView(query,limit=observation_limit*worker_threads)
         #            logger.info("Grabbing query",query
 
-        maximum_retrievable_number_of_documents = observation_limit * worker_threads
-        document_view = hybrid.view.create_view_from_query_info(query_info,
-                                                                limit=maximum_retrievable_number_of_documents)
-
-        rows = document_view.rows()
-
-        # Increment the number of workers if we are maxed        
-        #         if (self._adaptive_threads==True and not(self._debug==True)):
-        #             if ((number_of_documents_retrieved == maximum_retrievable_number_of_documents) and (self._worker_threads < self._max_worker_threads)):
-        #                 self._worker_threads = self._worker_threads + 1
-        #                 logger.info("This executor is overwhelmed. Increasing the number of worker threads to",self._worker_threads
-        #             elif (number_of_documents_retrieved < (maximum_retrievable_number_of_documents/2)):
-        #                 if (self._worker_threads > 1):
-        #                     self._worker_threads = self._worker_threads - 1
-        #                     logger.info("This executor is underwhelmed. Decreasing the number of worker threads to",self._worker_threads
-
+        # Reap finished batches; documents in the ones still running have not been
+        # tagged yet, so over-fetch by that many and filter them out below
+        in_flight_uuids = set()
+        if self._scheduler is not None:
+            self._scheduler.poll()
+            in_flight_uuids = self._scheduler.in_flight_uuids()
 
+        maximum_retrievable_number_of_documents = self.fetchLimit() + len(in_flight_uuids)
+        query_info["limit"] = maximum_retrievable_number_of_documents
+        try:
+            document_view = hybrid.view.create_view_from_query_info(query_info,
+                                                                    limit=maximum_retrievable_number_of_documents)
+            rows = document_view.rows()
+        except Exception:
+            if self._controller is None:
+                raise
+            logger.exception("Could not query the input database")
+            self._controller.record_error()
+            self.adjust()
+            return True, True
+
+        if self._controller is not None:
+            self._controller.record_fetch(len(rows), maximum_retrievable_number_of_documents)
+            self.adjust()
 
         for row in rows:
             if row == None:
@@ -254,12 +472,28 @@ class manager:
             #        logger.info("static "
             #        print self._static
 
-        if (document_view.num_rows() == 0):
-            if (self._static):
+        if in_flight_uuids:
+            rows = [row for row in rows if row.getMetaData("_dataBlobID") not in in_flight_uuids]
+
+        if len(rows) == 0:
+            if self._scheduler is not None and self._scheduler.num_outstanding > 0:
+                # Nothing new yet, but batches are still running
+                self._scheduler.wait_any()
+                return True, False
+            if self._static:
                 return False, False  # Do not keep processing, and not waiting on data
             return True, True  # Do keep processing, and waiting on data
 
-        tasks = utils.computeTaskProcessingRanges(rows, self._worker_threads)
+        tasks = self.computeTasks([row.getMetaData("_dataBlobID") for row in rows], rows)
+        self.dispatchTasks(workers, tasks, mp)
+
+        if (self._uuids):
+            return False, False
+        return True, False  # Do keep processing, and not waiting on data
+
+    def dispatchTasks(self, workers, tasks, mp):
+        input_db = self._input_db
+        output_db = self._output_db
 
         # Debugging mode
         if (mp == None):
@@ -272,31 +506,215 @@ class manager:
                                   output_db_type=output_db.getType(),
                                   output_db_host=output_db.getHost(),
                                   output_db_name=output_db.getDBName(),
-                                  output_tag_list=self._output_tag_list)
+                                  output_tag_list=self._output_tag_list,
+                                  concurrent_workers=self._concurrent_workers)
 
         # Normal mode
         else:
+            task_kwargs = {"input_db_type": input_db.getType(),
+                           "input_db_host": input_db.getHost(),
+                           "input_db_name": input_db.getDBName(),
+                           "output_db_type": output_db.getType(),
+                           "output_db_host": output_db.getHost(),
+                           "output_db_name": output_db.getDBName(),
+                           "func2": taskEvaluateDocuments,
+                           "output_tag_list": self._output_tag_list,
+                           "concurrent_workers": self._concurrent_workers}
             for task in tasks:
-                logger.info("Adding worker task")
-                mp.add_task(taskEvaluateDocuments,
-                            workers,
-                            task,
-                            input_db_type=input_db.getType(),
-                            input_db_host=input_db.getHost(),
-                            input_db_name=input_db.getDBName(),
-                            output_db_type=output_db.getType(),
-                            output_db_host=output_db.getHost(),
-                            output_db_name=output_db.getDBName(),
-                            func2=taskEvaluateDocuments,
-                            output_tag_list=self._output_tag_list)
-
-                logger.info("Waiting for tasks to complete")
-                # Wait for the tasks to complete (but don't kill processes)
-                mp.wait_completion()
+                # Blocks only while max_outstanding_tasks batches are in flight
+                if self._worker_config_id is not None:
+                    # The pool processes already hold the workers
+                    self._scheduler.submit(task, taskEvaluateConfiguredDocuments, self._worker_config_id, task,
+                                           **task_kwargs)
+                else:
+                    self._scheduler.submit(task, taskEvaluateDocuments, workers, task, **task_kwargs)
+
+    def workerPoolArguments(self, workers):
+        """ Keyword arguments for the mp_pool: the initializer building the workers in every pool process
+            when all of them have JSON definitions, and the recycling limits """
+        pool_kwargs = {"maxtasksperchild": self._max_tasks_per_child}
+        if self._max_child_rss_mb:
+            pool_kwargs["max_rss_bytes"] = int(self._max_child_rss_mb * 1024 * 1024)
+
+        self._worker_config_id = None
+        definitions = [utils.getJSONDefinition(worker) for worker in workers]
+        if self._persistent_workers and definitions and None not in definitions:
+            self._worker_config_id = "-".join(definition["alias"] for definition in definitions)
+            pool_kwargs["initializer"] = initializeWorkers
+            pool_kwargs["initargs"] = ({self._worker_config_id: definitions},)
+        elif self._persistent_workers:
+            logger.info("Workers weren't loaded from JSON definitions, sending them along with every batch")
+        return pool_kwargs
+
+    def fetchLimit(self):
+        """ Most new documents to pull for one round of dispatching """
+        if self._controller is None:
+            return self._observation_limit * self._worker_threads
+        return self._controller.batch_size * self._controller.outstanding
+
+    def computeTasks(self, uuids, rows=None):
+        """ Split the documents into tasks, one per worker process or, when adaptive, observation_limit
+            documents each. Loaded rows are balanced on their size estimates, bare uuids are split into
+            small chunks the pool processes pick up as they free up. """
+        num_tasks = self._worker_threads
+        chunks_per_thread = utils.CHUNKS_PER_THREAD
+        if self._controller is not None:
+            # The controller already sized the tasks, they aren't split into smaller chunks
+            num_tasks = max(1, int(math.ceil(len(uuids) / float(self._controller.batch_size))))
+            chunks_per_thread = 1
+        if rows is None:
+            return utils.computeTaskProcessingChunks(uuids, num_tasks, chunks_per_thread)
+        return utils.computeTaskProcessingRanges(rows, num_tasks, cost_model=self._cost_model,
+                                                 chunks_per_thread=chunks_per_thread)
+
+    def taskComplete(self, task, successful, elapsed):
+        """ task_scheduler callback, feeds the task's time (as timed in the pool process) to the controller and
+            the cost model """
+        if self._controller is not None:
+            self._controller.record_task(task.get("num_docs", 0), elapsed, successful)
+        if successful and "size" in task:
+            self._cost_model.record_task(task.get("num_docs", 0), task["size"], elapsed)
+
+    def adjust(self):
+        """ Apply the controller's settings to the running scheduler, the pool itself is left alone """
+        if self._controller is not None and self._controller.update():
+            self._scheduler.max_outstanding = self._controller.outstanding
+            self._observation_limit = self._controller.batch_size
+
+    def projectModelObservations(self, worker, worker_model):
+        """ Run the model observations of the worker's (just updated) model through a static manager, if the
+            model observations manager has a target database """
+        logger.info("Attempting to project observations through the model..")
+        # If there is a target database for the model observations manager of this worker, then
+        # project the model observations through their own model
+        model_observations_manager = worker_model.getModelObservationsManager()
+        model_observations_target_db = model_observations_manager.getTargetDB()
+        if not (model_observations_target_db == None):
+            print "projecting for worker model:", worker_model.getMetaData("_dataBlobID")
+            logger.info("Removing keys...%s" % (self._output_tag_list,))
+            utils.removeKeysFromManagerView(model_observations_manager, self._output_tag_list)
+            utils.removeWorkerMetaDataFromManagerView(model_observations_manager, worker)
+            mini_manager = hybrid.manager.manager(
+                workers=[worker],
+                query=self._query,  # Will be removed once we have tag to query methods
+                input_tag_list=self._input_tag_list,
+                output_tag_list=self._output_tag_list,
+                static=True,
+                worker_threads=self._worker_threads,
+                input_db=model_observations_target_db,
+                output_db=model_observations_target_db,
+                observation_limit=self._observation_limit)
+            mini_manager.run()
+            mini_manager = None
+            print "finished projecting"
+            logger.info("Finished projecting!!!!")
+
+    def retrainModel(self, worker):
+        """
+        Body of the background retrain process: update the worker's model with its stores held back, write
+        the new revision in one store only if update_model didn't fail (raise or return False) and, for self
+        validating models, the model validates, then project the model observations through it. Exits non
+        zero if nothing was stored.
+        """
+        worker_model = worker.get_model()
+        hybrid.model.deferStores()
+        try:
+            correct_update = worker.update_model()
+        except Exception:
+            logger.exception("Retraining model %s failed" % (worker_model.getParameters().getDataBlobUUID(),))
+            correct_update = False
+        if correct_update == False or (worker_model.getSelfValidate() and not worker_model.isValid()):
+            logger.warning("Retrained model %s didn't validate, the stored revision stays in use" %
+                           (worker_model.getParameters().getDataBlobUUID(),))
+            hybrid.model.discardDeferredStores()
+            sys.exit(1)
+        hybrid.model.commitDeferredStores()
+        self.projectModelObservations(worker, worker_model)
+
+    def retrainInBackground(self, worker, worker_model):
+        """
+        Start, or check on, the background process retraining a stale model. Batches go on being scored
+        against the revision in the database, which the process replaces in a single store. Models that
+        aren't self updating are left to whatever updates them. Returns False once the model has been stale
+        for more than max_model_staleness seconds, then the manager stops scoring until the new revision is in.
+        """
+        uuid = worker_model.getParameters().getDataBlobUUID()
+        now = time.time()
+        retrain = self._retrains.setdefault(uuid, {"process": None, "stale_since": now, "retry_after": 0})
+
+        process = retrain["process"]
+        if process is not None and not process.is_alive():
+            process.join()
+            retrain["process"] = None
+            if process.exitcode == 0:
+                # The next check of the stored model decides whether it needs another retrain
+                logger.info("Retrained model %s stored" % (uuid,))
+                return True
+            else:
+                logger.warning("Retraining model %s failed (exit code %s), retrying in %s seconds" %
+                               (uuid, process.exitcode, self._model_update_sleep))
+                retrain["retry_after"] = now + self._model_update_sleep
+
+        if retrain["process"] is None and worker_model.isSelfUpdating() and now >= retrain["retry_after"]:
+            logger.info("Retraining model %s in the background" % (uuid,))
+            retrain["process"] = multiprocessing.Process(target=self.retrainModel, args=(worker,),
+                                                         name="retrain-%s" % (uuid,))
+            retrain["process"].start()
+
+        staleness = now - retrain["stale_since"]
+        if self._max_model_staleness is not None and staleness > self._max_model_staleness:
+            logger.warning("Model %s has been stale for %d seconds, waiting for the retrained revision" %
+                           (uuid, staleness))
+            return False
+        return True
+
+    def modelCurrent(self, worker_model):
+        """ The stored model is up to date, stop tracking its staleness """
+        uuid = worker_model.getParameters().getDataBlobUUID()
+        retrain = self._retrains.get(uuid)
+        if retrain is not None and (retrain["process"] is None or not retrain["process"].is_alive()):
+            if retrain["process"] is not None:
+                retrain["process"].join()
+            del self._retrains[uuid]
+
+    def useChangeFeed(self):
+        """ Whether this iteration should read the change feed rather than query the view """
+        if self._change_feed is None or self._last_view_poll is None:
+            return False
+        return (time.time() - self._last_view_poll) < self._fallback_poll_interval
+
+    def processChanges(self, workers, mp):
+        """ Change feed counterpart of processObservations: dispatches the documents reported by the
+            feed without querying the view """
+        in_flight_uuids = set()
+        if self._scheduler is not None:
+            self._scheduler.poll()
+            in_flight_uuids = self._scheduler.in_flight_uuids()
+
+        limit = self.fetchLimit()
+        try:
+            self._change_feed.acknowledge(in_flight_uuids)
+            uuids = self._change_feed.poll(limit=limit)
+        except Exception:
+            logger.exception("Change feed failed, falling back to polling the view")
+            self._last_view_poll = None
+            if self._controller is not None:
+                self._controller.record_error()
+            return True, True
 
-        if (self._uuids):
-            return False, False
-        return True, False  # Do keep processing, and not waiting on data
+        if self._controller is not None:
+            self._controller.record_fetch(len(uuids), limit)
+            self.adjust()
+
+        uuids = [uuid for uuid in uuids if uuid not in in_flight_uuids]
+        if len(uuids) == 0:
+            # The feed already waited change_feed_timeout seconds for something to arrive
+            return True, False
+
+        tasks = self.computeTasks(uuids)
+        self.dispatchTasks(workers, tasks, mp)
+
+        return True, False
 
     def run(self, **kwargs):
         workers = self._workers
@@ -316,9 +734,31 @@ class manager:
                 # Fire up the multiprocessing pool
                 # mp_log = multiprocessing.log_to_stderr()
                 # mp_log.setLevel(multiprocessing.SUBDEBUG)
-                self._mp = hybrid.mp_pool.mp_pool(processes=worker_threads)
+                self._mp = hybrid.mp_pool.mp_pool(processes=worker_threads, **self.workerPoolArguments(workers))
             elif self._mp_type == "mp_celery":
                 self._mp = hybrid.mp_celery.mp_celery(processes=worker_threads)
+            self._scheduler = hybrid.scheduler.task_scheduler(self._mp,
+                                                              max_outstanding=self._max_outstanding_tasks,
+                                                              on_complete=self.taskComplete)
+            if self._adaptive_batches:
+                self._controller = hybrid.controller.adaptive_controller(
+                    1, self._max_outstanding_tasks, self._min_observation_limit, self._max_observation_limit,
+                    outstanding=min(worker_threads, self._max_outstanding_tasks),
+                    batch_size=self._observation_limit,
+                    target_task_seconds=self._target_task_seconds)
+                self._scheduler.max_outstanding = self._controller.outstanding
+
+        if self._use_change_feed and not self._static:
+            try:
+                self._change_feed = hybrid.change_feed.create_change_feed(self._input_db,
+                                                                          self._input_tag_list,
+                                                                          self._output_tag_list,
+                                                                          checkpoint_id=self._change_feed_checkpoint_id,
+                                                                          timeout=self._change_feed_timeout)
+            except Exception:
+                logger.exception("Could not open the change feed, polling the view instead")
+                self._change_feed = None
+            self._last_view_poll = None
 
         logger.info("Running manager")
         while (keep_processing == True):
@@ -373,42 +813,30 @@ class manager:
                     # print "model_needs_updating=%s" % (model_needs_updating,)
                     logger.info("model_loaded=%s" % (model_loaded,))
                     logger.info("model_needs_updating=%s" % (model_needs_updating,))
+                    if model_loaded and not model_needs_updating:
+                        self.modelCurrent(worker_model)
 
                     if (model_needs_updating or (model_loaded == False)):
                         print "model needs updating"
                         logger.info("model needs updating")
-                        if (worker_model.isSelfUpdating()):
+                        if self._background_retraining and model_loaded:
+                            # Batches keep being scored against the stored revision while the model retrains
+                            if not self.retrainInBackground(worker, worker_model):
+                                waiting_on_model_update = True
+                                models_updated_correctly = False
+                                break
+                        elif (worker_model.isSelfUpdating()):
                             print "model is selfupdating. Updating through hybrid manager"
                             logger.info("model is selfupdating. Updating through hybrid manager")
+                            # Let batches scored against the previous model finish first
+                            if self._scheduler is not None:
+                                self._scheduler.wait_all()
                             correct_update = worker.update_model()
                             print "\t\tcorrect_update=%s" % (correct_update,)
                             logger.info("\t\tcorrect_update=%s" % (correct_update,))
                             models_updated_correctly = (correct_update and models_updated_correctly)
 
-                            logger.info("Attempting to project observations through the model..")
-                            # If there is a target database for the model observations manager of this worker, then
-                            # project the model observations through their own model
-                            model_observations_manager = worker_model.getModelObservationsManager()
-                            model_observations_target_db = model_observations_manager.getTargetDB()
-                            if not (model_observations_target_db == None):
-                                print "projecting for worker model:", worker_model.getMetaData("_dataBlobID")
-                                logger.info("Removing keys...%s" % (self._output_tag_list,))
-                                utils.removeKeysFromManagerView(model_observations_manager, self._output_tag_list)
-                                utils.removeWorkerMetaDataFromManagerView(model_observations_manager, worker)
-                                mini_manager = hybrid.manager.manager(
-                                    workers=[worker],
-                                    query=self._query,  # Will be removed once we have tag to query methods
-                                    input_tag_list=self._input_tag_list,
-                                    output_tag_list=self._output_tag_list,
-                                    static=True,
-                                    worker_threads=self._worker_threads,
-                                    input_db=model_observations_target_db,
-                                    output_db=model_observations_target_db,
-                                    observation_limit=self._observation_limit)
-                                mini_manager.run()
-                                mini_manager = None
-                                print "finished projecting"
-                                logger.info("Finished projecting!!!!")
+                            self.projectModelObservations(worker, worker_model)
                         else:
                             print "model is not selfupdating"
                             logger.info("model needs to do some things before it is updated")
@@ -428,11 +856,29 @@ class manager:
                 time.sleep(self._model_update_sleep)
                 continue
 
-            keep_processing, waiting_on_data = self.processObservations(workers, uuids, self._mp)
-            if waiting_on_data:
+            if self.useChangeFeed():
+                keep_processing, waiting_on_data = self.processChanges(workers, self._mp)
+            else:
+                keep_processing, waiting_on_data = self.processObservations(workers, uuids, self._mp)
+                if waiting_on_data and self._change_feed is not None:
+                    # The view is drained, follow the feed from here
+                    self._last_view_poll = time.time()
+            if waiting_on_data and not self.useChangeFeed():
                 print "Waiting on data..."
                 logger.info("Waiting on data...")
                 time.sleep(self._iteration_sleep)
+        if self._scheduler is not None:
+            self._scheduler.wait_all()
+            self._scheduler = None
+            self._controller = None
+        if self._change_feed is not None:
+            self._change_feed.close()
+            self._change_feed = None
+        for uuid, retrain in self._retrains.items():
+            if retrain["process"] is not None:
+                logger.info("Waiting for the retrain of model %s" % (uuid,))
+                retrain["process"].join()
+        self._retrains = {}
         self._mp.finish_and_close()
         del self._mp
         gc.collect()
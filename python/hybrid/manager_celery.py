@@ -36,14 +36,14 @@ def taskEvaluateDocuments(worker, task, **kwargs):
         manager_logger = logger.logger()
         manager_logger.setLogLevel(2)
 
-    input_db = hybrid.db.init(input_db_type, host=input_db_host, database=input_db_name, create=False,
+    input_db = hybrid.db.get_connection(input_db_type, host=input_db_host, database=input_db_name, create=False,
                               log_level=manager_logger.getLogLevel())
 
     output_db_type = kwargs.get("output_db_type")
     output_db_host = kwargs.get("output_db_host")
     output_db_name = kwargs.get("output_db_name")
 
-    output_db = hybrid.db.init(output_db_type, host=output_db_host, database=output_db_name, create=False,
+    output_db = hybrid.db.get_connection(output_db_type, host=output_db_host, database=output_db_name, create=False,
                                log_level=manager_logger.getLogLevel())
 
     same_db = True
@@ -58,18 +58,15 @@ def taskEvaluateDocuments(worker, task, **kwargs):
     if output_tag_list is None:
         output_tag_list = []
 
-    observations = []
+    # Pull the whole task's documents in one batched request
     uuids = task["uuids"]
-    for document_index in range(0, len(uuids)):
-        uuid = uuids[document_index]
-
-        try:
-            doc = input_db.loadDataBlob(uuid, include_binary=True)
-            if not (doc == None):
-                observations.append(doc)
-        except:
-            print "Skipping uuid ", uuid, " for evaluation from db name=", input_db.getDBName()
-            continue
+    try:
+        observations, missing_uuids = input_db.loadDataBlobArray(uuids, include_binary=True)
+        for uuid in missing_uuids:
+            print "Skipping uuid ", uuid, " for evaluation from db name=", input_db.db_name
+    except:
+        print "Could not load the documents for evaluation from db name=", input_db.db_name
+        observations = []
 
     # Open a connection to the database and couch logger
     try:
@@ -98,10 +95,7 @@ def taskEvaluateDocuments(worker, task, **kwargs):
 
         # If the input and output databases aren't the same, go ahead and store the datablob to the output_db
         if not same_db:
-            for observation in observations:
-                output_db.storeDataBlob(observation, ignore_conflict=True)
-            for observation in incomplete_observations:
-                output_db.storeDataBlob(observation, ignore_conflict=True)
+            output_db.storeDataBlobArray(observations + incomplete_observations, ignore_conflict=True)
 
         # Modify the input database to mark the current observations as having been processed.
         # This is done by adding the output tags.
@@ -109,25 +103,29 @@ def taskEvaluateDocuments(worker, task, **kwargs):
         # If everything was fine with the processing, the output tag gets a "complete" value.
         # A value of "incomplete" signifies that something was wrong, such as a missing data dependency.
         print "====Storing output tags for documents===="
+        completed_datetime = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%SZ")
+        progress = {}
         for observation in observations:
-            if same_db:
-                doc = observation
-            else:
-                doc = input_db.loadDataBlob(observation.getMetaData("_dataBlobID"), include_binary=True)
+            tags = {}
             for j in range(0, len(output_tag_list)):
-                doc.setMetaData(output_tag_list[j], "complete")
-                doc.setMetaData(output_tag_list[j] + "_datetime",
-                                datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%SZ"))
-                # print "storing tag " + output_tag_list[j] + " = complete on doc " + doc.getDataBlobUUID() + " in database " + str(input_db)
-            input_db.storeDataBlob(doc, ignore_conflict=True)
+                tags[output_tag_list[j]] = "complete"
+                tags[output_tag_list[j] + "_datetime"] = completed_datetime
+            progress[observation.getMetaData("_dataBlobID")] = tags
         for observation in incomplete_observations:
-            if same_db:
-                doc = observation
-            else:
-                doc = input_db.loadDataBlob(observation.getMetaData("_dataBlobID"), include_binary=True)
+            tags = {}
             for j in range(0, len(output_tag_list)):
-                doc.setMetaData(output_tag_list[j], "incomplete")
-            input_db.storeDataBlob(doc, ignore_conflict=True)
+                tags[output_tag_list[j]] = "incomplete"
+            progress[observation.getMetaData("_dataBlobID")] = tags
+
+        if same_db:
+            # The observations go back to the input database anyway, the tags ride along in one bulk write
+            for observation in observations + incomplete_observations:
+                for field, value in progress[observation.getMetaData("_dataBlobID")].iteritems():
+                    observation.setMetaData(field, value)
+            input_db.storeDataBlobArray(observations + incomplete_observations, ignore_conflict=True)
+        else:
+            # Only the tags go back to the input database, its documents are never reloaded
+            input_db.markProgress(progress)
         print "====Done storing output tags for documents===="
 
         # Check if something bad happened (like the models were changed)
@@ -197,9 +195,35 @@ class manager:
             self._adaptive_threads = True
         self._mp = None
 
+        # Number of batches allowed in flight at once; by default keep one
+        # batch queued behind every busy worker process
+        self._max_outstanding_tasks = kwargs.get("max_outstanding_tasks")
+        if self._max_outstanding_tasks is None:
+            self._max_outstanding_tasks = 2 * self._worker_threads
+        self._scheduler = None
+
         self._iteration_sleep = kwargs.get("iteration_sleep", 5)
         self._model_update_sleep = kwargs.get("model_update_sleep", 10)
 
+        # Event driven ingest: tail the input database's change feed instead of re-querying the view
+        # every iteration_sleep seconds. The view is still polled on start up, whenever the feed fails and
+        # every fallback_poll_interval seconds, to pick up anything the feed can't see.
+        self._use_change_feed = kwargs.get("change_feed", False)
+        self._change_feed_checkpoint_id = kwargs.get("change_feed_checkpoint_id")
+        if self._change_feed_checkpoint_id is None:
+            self._change_feed_checkpoint_id = "hybrid_" + "-".join(sorted(self._output_tag_list or []))
+        self._change_feed_timeout = kwargs.get("change_feed_timeout", self._iteration_sleep)
+        self._fallback_poll_interval = kwargs.get("fallback_poll_interval", 300)
+        self._change_feed = None
+        self._last_view_poll = None
+
+        # Let the input database index the fields of the tag query this manager runs every iteration
+        if kwargs.get("ensure_indexes", True) and self._input_db is not None:
+            try:
+                self._input_db.ensureTagIndexes(self._input_tag_list, self._output_tag_list)
+            except Exception:
+                logger.exception("Could not create the tag indexes on %s" % (str(self._input_db),))
+
     def cleanup(self):
         if not (self._mp is None):
             self._mp.finish_and_close()
@@ -233,7 +257,15 @@ class manager:
         #            document_view = input_db.loadView(query,limit=observation_limit*worker_threads)
         #            print "Grabbing query",query
 
-        maximum_retrievable_number_of_documents = observation_limit * worker_threads
+        # Reap finished batches; documents in the ones still running have not been
+        # tagged yet, so over-fetch by that many and filter them out below
+        in_flight_uuids = set()
+        if self._scheduler is not None:
+            self._scheduler.poll()
+            in_flight_uuids = self._scheduler.in_flight_uuids()
+
+        maximum_retrievable_number_of_documents = observation_limit * worker_threads + len(in_flight_uuids)
+        query_info["limit"] = maximum_retrievable_number_of_documents
         document_view = hybrid.view.create_view_from_query_info(query_info,
                                                                 limit=maximum_retrievable_number_of_documents)
 
@@ -262,12 +294,28 @@ class manager:
                 #        print "static "
                 #        print self._static
 
-        if document_view.num_rows() == 0:
+        if in_flight_uuids:
+            rows = [row for row in rows if row.getMetaData("_dataBlobID") not in in_flight_uuids]
+
+        if len(rows) == 0:
+            if self._scheduler is not None and self._scheduler.num_outstanding > 0:
+                # Nothing new yet, but batches are still running
+                self._scheduler.wait_any()
+                return True, False
             if self._static:
                 return False, False  # Do not keep processing, and not waiting on data
             return True, True  # Do keep processing, and waiting on data
 
         tasks = utils.computeTaskProcessingRanges(rows, self._worker_threads)
+        self.dispatchTasks(workers, tasks, mp)
+
+        if self._uuids:
+            return False, False
+        return True, False  # Do keep processing, and not waiting on data
+
+    def dispatchTasks(self, workers, tasks, mp):
+        input_db = self._input_db
+        output_db = self._output_db
 
         # Debugging mode
         if mp is None:
@@ -286,27 +334,52 @@ class manager:
         # Normal mode
         else:
             for task in tasks:
-                logger.info("Adding worker task")
-                mp.add_task(taskEvaluateDocuments,
-                            workers,
-                            task,
-                            logger=self._logger,
-                            input_db_type=input_db.getType(),
-                            input_db_host=input_db.getHost(),
-                            input_db_name=input_db.getDBName(),
-                            output_db_type=output_db.getType(),
-                            output_db_host=output_db.getHost(),
-                            output_db_name=output_db.getDBName(),
-                            func2=taskEvaluateDocuments,
-                            output_tag_list=self._output_tag_list)
-
-                logger.info("Waiting for tasks to complete")
-                # Wait for the tasks to complete (but don't kill processes)
-                mp.wait_completion()
+                # Blocks only while max_outstanding_tasks batches are in flight
+                self._scheduler.submit(task,
+                                       taskEvaluateDocuments,
+                                       workers,
+                                       task,
+                                       logger=self._logger,
+                                       input_db_type=input_db.getType(),
+                                       input_db_host=input_db.getHost(),
+                                       input_db_name=input_db.getDBName(),
+                                       output_db_type=output_db.getType(),
+                                       output_db_host=output_db.getHost(),
+                                       output_db_name=output_db.getDBName(),
+                                       func2=taskEvaluateDocuments,
+                                       output_tag_list=self._output_tag_list)
+
+    def useChangeFeed(self):
+        """ Whether this iteration should read the change feed rather than query the view """
+        if self._change_feed is None or self._last_view_poll is None:
+            return False
+        return (time.time() - self._last_view_poll) < self._fallback_poll_interval
+
+    def processChanges(self, workers, mp):
+        """ Change feed counterpart of processObservations: dispatches the documents reported by the
+            feed without querying the view """
+        in_flight_uuids = set()
+        if self._scheduler is not None:
+            self._scheduler.poll()
+            in_flight_uuids = self._scheduler.in_flight_uuids()
 
-        if self._uuids:
-            return False, False
-        return True, False  # Do keep processing, and not waiting on data
+        try:
+            self._change_feed.acknowledge(in_flight_uuids)
+            uuids = self._change_feed.poll(limit=self._observation_limit * self._worker_threads)
+        except Exception:
+            logger.exception("Change feed failed, falling back to polling the view")
+            self._last_view_poll = None
+            return True, True
+
+        uuids = [uuid for uuid in uuids if uuid not in in_flight_uuids]
+        if len(uuids) == 0:
+            # The feed already waited change_feed_timeout seconds for something to arrive
+            return True, False
+
+        tasks = utils.computeTaskProcessingChunks(uuids, self._worker_threads)
+        self.dispatchTasks(workers, tasks, mp)
+
+        return True, False
 
     def run(self, **kwargs):
         workers = self._workers
@@ -330,6 +403,20 @@ class manager:
                 self._mp = hybrid.mp_pool.mp_pool(processes=worker_threads)
             elif self._mp_type == "mp_celery":
                 self._mp = hybrid.mp_celery.mp_celery(processes=worker_threads)
+            self._scheduler = hybrid.scheduler.task_scheduler(self._mp,
+                                                              max_outstanding=self._max_outstanding_tasks)
+
+        if self._use_change_feed and not self._static:
+            try:
+                self._change_feed = hybrid.change_feed.create_change_feed(self._input_db,
+                                                                          self._input_tag_list,
+                                                                          self._output_tag_list,
+                                                                          checkpoint_id=self._change_feed_checkpoint_id,
+                                                                          timeout=self._change_feed_timeout)
+            except Exception:
+                logger.exception("Could not open the change feed, polling the view instead")
+                self._change_feed = None
+            self._last_view_poll = None
 
         print "Running manager"
         while keep_processing:
@@ -377,6 +464,9 @@ class manager:
                         print "model needs updating"
                         if worker_model.isSelfUpdating():
                             print "model is selfupdating. Updating through hybrid manager"
+                            # Let batches scored against the previous model finish first
+                            if self._scheduler is not None:
+                                self._scheduler.wait_all()
                             correct_update = worker.update_model()
                             print "\t\tcorrect_update=", correct_update
                             models_updated_correctly = (correct_update and models_updated_correctly)
@@ -418,10 +508,22 @@ class manager:
                 time.sleep(self._model_update_sleep)
                 continue
 
-            keep_processing, waiting_on_data = self.processObservations(workers, uuids, self._mp)
-            if waiting_on_data:
+            if self.useChangeFeed():
+                keep_processing, waiting_on_data = self.processChanges(workers, self._mp)
+            else:
+                keep_processing, waiting_on_data = self.processObservations(workers, uuids, self._mp)
+                if waiting_on_data and self._change_feed is not None:
+                    # The view is drained, follow the feed from here
+                    self._last_view_poll = time.time()
+            if waiting_on_data and not self.useChangeFeed():
                 self._logger.info("Waiting on data...")
                 time.sleep(self._iteration_sleep)
+        if self._scheduler is not None:
+            self._scheduler.wait_all()
+            self._scheduler = None
+        if self._change_feed is not None:
+            self._change_feed.close()
+            self._change_feed = None
         self._mp.finish_and_close()
         del self._mp
         del mp_log
@@ -8,6 +8,7 @@ import hashlib
 import json
 import logging
 import shlex
+import time
 
 from hybrid import utils,view,encoding
 
@@ -20,6 +21,44 @@ from collections import defaultdict
 
 logger = logging.getLogger(__name__)
 
+# Per-process cache of model parameters keyed by (db type, host, name, uuid);
+# each entry remembers the revision it was loaded at and keeps its own copy of the parameters, which
+# every hit clones so models never share (and change) one parameters blob, see model.loadFromDB
+_parameter_cache = {}
+
+# Seconds a cached revision is trusted before the database is probed again
+MODEL_REVISION_TTL = 0
+
+# Models whose storeToDB is being held back in this process, see deferStores
+_deferred_stores = None
+
+def deferStores():
+    ''' Hold back every storeToDB in this process until commitDeferredStores, so a model being retrained
+        replaces its stored revision in one write at the end, and only if it validates '''
+    global _deferred_stores
+    _deferred_stores = {}
+
+def commitDeferredStores():
+    ''' Write the held back models (the last store of each) and stop deferring '''
+    global _deferred_stores
+    deferred = _deferred_stores or {}
+    _deferred_stores = None
+    for deferred_model, lock_id in deferred.itervalues():
+        deferred_model.storeToDB(lock_id, atomic=True)
+
+def discardDeferredStores():
+    ''' Drop the held back models, the stored revisions stay as they are '''
+    global _deferred_stores
+    _deferred_stores = None
+
+def clearParameterCache():
+    ''' Drop every cached set of model parameters in this process '''
+    _parameter_cache.clear()
+
+def _cacheable_revision(rev):
+    # Backends without real revisions (mongodb) report None or 0
+    return not (rev is None or rev == 0 or rev == "0")
+
 def loadFromCache(subclass, uuid, **kwargs):
 
     """ Load a model of a particular subclass from cache, if not in cache
@@ -75,6 +114,7 @@ class model():
         self._db_type = kwargs.get('db_type',None)        
         self._db_host = kwargs.get('host', None)
         self._db_name = kwargs.get('database', None)
+        self._revision_ttl = kwargs.get('revision_ttl', MODEL_REVISION_TTL)
 
         model_observations_manager_name = kwargs.get("model_observations_manager_name")
         
@@ -216,6 +256,38 @@ class model():
     def setNotSelfUpdating(self):
         self.getParameters().setMetaData("selfUpdate",False)
 
+    def getHighWaterMark(self):
+        ''' Datetime dict stamp of the newest model observation folded into the model, None if the
+            model has never been trained incrementally '''
+        if self.getParameters().hasMetaData("high_water_mark"):
+            return self.getParameters().getMetaData("high_water_mark")
+        return None
+
+    def setHighWaterMark(self,high_water_mark):
+        self.getParameters().setMetaData("high_water_mark",high_water_mark)
+
+    def getFoldedObservations(self):
+        ''' Set of the uuids of the model observations already folded into the model, None if the
+            model has never been trained incrementally '''
+        params = self.getParameters()
+        if not params.hasBinaryData("folded_observations"):
+            return None
+        return set(json.loads(params.getBinaryData("folded_observations")))
+
+    def setFoldedObservations(self,uuids):
+        # Kept as a binary field so the (possibly long) list stays out of the parameters document
+        self.getParameters().setBinaryData("folded_observations", "application/json", json.dumps(sorted(uuids)))
+
+    def getObservationPositions(self):
+        ''' Server side positions (e.g. couch update sequences) of the model observation sources as of
+            the last incremental update, keyed by source '''
+        if self.getParameters().hasMetaData("observation_positions"):
+            return self.getParameters().getMetaData("observation_positions")
+        return {}
+
+    def setObservationPositions(self,positions):
+        self.getParameters().setMetaData("observation_positions",positions)
+
     def getModelObservationsManager(self):
         if (self.getParameters().hasMetaData("model_observations_manager_name")):
             model_observations_manager_name = self.getParameters().getMetaData("model_observations_manager_name")
@@ -306,8 +378,8 @@ class model():
         return True
 
     def compareModelBinaryData(self,other_model):
-        param_binary_data = self.getParameters()._binary_data
-        other_param_binary_data = other_model.getParameters()._binary_data
+        param_binary_data = self.getParameters().getBinaryDataDict()
+        other_param_binary_data = other_model.getParameters().getBinaryDataDict()
         
         if not(len(param_binary_data)==len(other_param_binary_data)):
             return False
@@ -358,13 +430,22 @@ class model():
         if (self._db_type==None):
             return None
         
-        db_handle = db.init(self._db_type,host=self._db_host,database=self._db_name)
+        db_handle = db.get_connection(self._db_type,host=self._db_host,database=self._db_name)
         
         
         return db_handle
 
+    def _parameter_cache_key(self, uuid):
+        return (self._db_type, self._db_host, self._db_name, uuid)
+
     def loadFromDB(self, **kwargs):
-        ''' This method replaces the internal parameters storage object with the one from the database '''
+        ''' This method replaces the internal parameters storage object with the one from the database.
+            Parameters are cached per process by uuid and revision, so the blob is only pulled when the
+            revision in the database has changed.
+            Input:
+                revision_ttl: seconds to trust a cached revision without probing the database
+                              (defaults to the model's revision_ttl)
+        '''
 
         # Grab my uuid and db from the current storage object
         print "model.loadFromDB"
@@ -376,25 +457,34 @@ class model():
             return False
 #        db = self.getParameters().getDB()
         rev = self.getRevision()
+        revision_ttl = kwargs.pop("revision_ttl", self._revision_ttl)
+        now = time.time()
+
+        # Within the ttl trust the cached revision instead of probing the database
+        cache_key = self._parameter_cache_key(uuid)
+        cached = _parameter_cache.get(cache_key)
+        if (cached is not None and (now - cached["probed"]) < revision_ttl):
+            self._parameters = cached["parameters"].clone()
+            return True
 
         try: 
             db_rev = self.getRevisionFromDB()
         except RuntimeError, e:
+            _parameter_cache.pop(cache_key, None)
             if rev != None and rev != 0:
                 print "Can't find model in database - hopefully its just re-loading - keep using the current version for the time being %s %s",rev, str(e)
                 logger.warning( "Can't find model in database - hopefully its just re-loading - keep using the current version for the time being %s %s",
                     rev, str(e))
             return False
 
-        # TODO Check revision
-#         if (rev == db_rev):
-#             print "Model revision the same: skipping load..."
-#             logger.info( "Model revision the same: skipping load...")
-#             return True
-#         else:
-#             print "revisions are different"
-#             logger.info( "Revisions are different (" + 
-#                                     self.getRevision() + ' ' +  self.getRevisionFromDB() + ") loading...")
+        # Skip the load if the cached parameters are still at the database revision
+        if (cached is not None):
+            if (cached["rev"] == db_rev):
+                logger.info( "Model revision the same: skipping load...")
+                cached["probed"] = now
+                self._parameters = cached["parameters"].clone()
+                return True
+            logger.info( "Revisions are different (%s %s) loading..." % (cached["rev"], db_rev))
 
         # Delete current storage
         logger.info( "Deleting model parameter storage")
@@ -405,27 +495,44 @@ class model():
         if (self._parameters==None):
             print "model has no parameters!!!"
             logger.warning( "Model has no parameters!!",uuid,kwargs)
+            _parameter_cache.pop(cache_key, None)
         else:
             # Make sure my parameters are properly loaded
             print "validating"
             self._parameters.validate()
 
+            loaded_rev = self._parameters.getDataBlobRevision()
+            if _cacheable_revision(loaded_rev):
+                _parameter_cache[cache_key] = {"rev": loaded_rev, "probed": now,
+                                               "parameters": self._parameters.clone()}
+
         return True
 
-    def storeToDB(self,lock_id=None):
-        ''' This method saves the internal parameters storage object to the database '''
+    def storeToDB(self,lock_id=None,atomic=False):
+        ''' This method saves the internal parameters storage object to the database. With atomic the stored
+            document is replaced in place in one write (instead of deleted and saved again), so processes
+            loading the model meanwhile get the old revision or the new one, never a missing model '''
         print 
         print
         print "Storing blob"
         print
         if (lock_id==None):
             lock_id=id(self)
+        if _deferred_stores is not None:
+            _deferred_stores[self.getParameters().getDataBlobUUID()] = (self, lock_id)
+            return True
         # Store my parameters to the database
 #        db = self.getParameters().getDB()
         db = self.getDB()
         if (db==None):
             return False
-        db.storeDataBlob(self.getParameters(), lock_id, delete_existing=True) # Review is this isn't here get version error
+        # The stored revision changes, so whatever is cached is out of date
+        _parameter_cache.pop(self._parameter_cache_key(self.getParameters().getDataBlobUUID()), None)
+        if atomic:
+            db.storeDataBlob(self.getParameters(), lock_id, atomic=True)
+        else:
+            db.storeDataBlob(self.getParameters(), lock_id, delete_existing=True) # Review is this isn't here get version error
+        return True
 
     def update(self):
         '''update is the workhorse method of the model. The model data will be accessed/pulled,
@@ -611,6 +718,10 @@ class db_management_model(model):
         else:
             target_db_delete_on_update = False
 
+        # Only copy source documents stamped after the last import into the target db
+        incremental_update = kwargs.get("incremental_update", False)
+        high_water_mark_field = kwargs.get("high_water_mark_field", u"processed_datetime")
+
         # Set various bits of meta data, these are defaults and can be changed later
         params.setMetaData("model_type", u"db_management_model")
         params.setMetaData("model_desc", u"The most awesome db management model ever")
@@ -620,6 +731,8 @@ class db_management_model(model):
         params.setMetaData("target_db_view_files",target_db_view_files)
         params.setMetaData("target_db_redirect_dirs",target_db_redirect_dirs)
         params.setMetaData("target_db_delete_on_update",target_db_delete_on_update)
+        params.setMetaData("incremental_update",incremental_update)
+        params.setMetaData("high_water_mark_field",high_water_mark_field)
 
         # Validation fields
         params.addRequiredMetaFields(["target_db_type","target_db_host","target_db_name"])
@@ -776,7 +889,14 @@ class db_management_model(model):
         datasource_hashes = self.getMetaData("datasource_hashes")
         
         self._documents = []
-        
+
+        # Incremental imports only copy documents stamped after the last import, documents already
+        # in the target db are left alone (so this can't be combined with delete on update)
+        incremental_update = self.isIncrementalUpdate()
+        high_water_mark_field = self.getMetaData("high_water_mark_field")
+        high_water_mark = self.getHighWaterMark()
+        latest_stamp = high_water_mark
+
         datasource_hash_pairs = datasource_hashes.iterkeys()
         for datasource_key in datasource_hash_pairs:
             query_info = self.getQueryInfoFromHashKey(datasource_key)
@@ -800,6 +920,14 @@ class db_management_model(model):
             datasource_hashes[datasource_key] = view_hash
             
             rows = view_to_add.rows()
+            if (incremental_update):
+                latest_stamp = utils.getLatestDateTimeDict(
+                    [latest_stamp] + [row.getMetaDataSafe(high_water_mark_field) for row in rows])
+                if not (high_water_mark == None):
+                    # Unstamped documents can't be placed relative to the mark so they are copied again
+                    new_rows, unmarked_rows = utils.splitObservationsOnHighWaterMark(rows, high_water_mark,
+                                                                                     high_water_mark_field)
+                    rows = new_rows + unmarked_rows
             for row in rows:
                 # Grab the whole document
                 row_id = row.getMetaData("_dataBlobID") 
@@ -811,6 +939,8 @@ class db_management_model(model):
                 self._documents.append(row)
         
         self.setMetaData("datasource_hashes", datasource_hashes)
+        if (incremental_update):
+            self.setHighWaterMark(latest_stamp)
         target_db = self.getTargetDB()
         if (target_db==None):
             self.setValid()
@@ -824,6 +954,15 @@ class db_management_model(model):
     
 
 
+    def isIncrementalUpdate(self):
+        params = self._parameters
+        if not (params.hasMetaData("incremental_update") and params.getMetaData("incremental_update")):
+            return False
+        # A target db that is wiped on update has to be fully re-imported
+        if (params.hasMetaData("target_db_delete_on_update") and params.getMetaData("target_db_delete_on_update")):
+            return False
+        return True
+
     def getTargetDB(self):
         if self._target_db == None:
             if (self._db_type == None):
@@ -968,6 +1107,36 @@ class db_management_model(model):
             model_observations = model_observations_view.rows()
              
         return model_observations
+
+    def iterRowViews(self):
+        ''' (source key, view) for every source of model observations '''
+        targetDB = self.getTargetDB()
+        if targetDB is None:
+            datasource_hashes = self.getMetaData("datasource_hashes")
+            for datasource_key,stored_hash in datasource_hashes.iteritems():
+                query_info = self.getQueryInfoFromHashKey(datasource_key)
+                yield datasource_key, view.create_view_from_query_info(query_info)
+        else:
+            yield "target", view.create_view(targetDB, "", [], [])
+
+    def getRowPositions(self):
+        ''' Current server side position of every model observation source (None for the ones
+            that don't have one), see view.couch_view.position '''
+        return dict((key, db_view.position()) for key, db_view in self.iterRowViews())
+
+    def iterRows(self, page_size=1000, include_binary=False, since=None, skip_uuids=None):
+        ''' Generator version of getRows that yields the model observations a page of data blobs
+            at a time, so the whole set never has to be held in memory at once
+            Input:
+                since:      positions from getRowPositions, only the observations changed after
+                            them are read from the sources that have one
+                skip_uuids: set of observation uuids to leave out '''
+        if since is None:
+            since = {}
+        for key, db_view in self.iterRowViews():
+            for page in db_view.iterpages(page_size, include_binary=include_binary, since=since.get(key),
+                                          skip_uuids=skip_uuids):
+                yield page
                  
     #         targetDB = self.getTargetDB()
 #         model_observations_view = view.create_view(targetDB, "", [], [])
@@ -45,6 +45,14 @@ class mp_celery(object):
 
         return True
 
+    def submit(self, func, *args, **kwargs):
+        """
+        Submit a task and return its celery AsyncResult without placing it
+        on the task queue (see mp_pool.submit)
+        """
+        task = mp_celery_task.mp_celery_task()
+        return task.delay(*args, **kwargs)
+
     def wait_completion(self, timeout=None):
         """
         Blocks until all the tasks currently in the queue have completed.
@@ -40,5 +40,6 @@ class mp_celery_task(task.Task):
         #func = getattr(mod, function_name)
 
         r = func(*args, **kwargs)
+        return r
 
 tasks.register(mp_celery_task)
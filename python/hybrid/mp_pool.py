@@ -12,7 +12,11 @@ Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
 the U.S. Government retains certain rights in this software.
 """
 import Queue
+import logging
 import multiprocessing
+import multiprocessing.pool
+import os
+import resource
 import time
 
 # Module info
@@ -21,6 +25,67 @@ __email__ = "wcmclen@sandia.gov"
 __version__ = "0.1"
 __status__ = "Development"
 
+logger = logging.getLogger(__name__)
+
+
+def currentRSS():
+    """
+    Resident set size of this process in bytes. Read from /proc where there
+    is one, elsewhere this is the peak resident size.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux, bytes on OS X
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class rss_limited_queue(object):
+    """
+    Wraps a pool's task queue in a child process. Once the child has grown
+    past max_rss_bytes the next get() hands back the exit sentinel, so the
+    child stops between tasks (never holding a task or the queue lock) and
+    the pool starts a fresh one in its place.
+    """
+
+    def __init__(self, queue, max_rss_bytes):
+        self._queue = queue
+        self._max_rss_bytes = max_rss_bytes
+        self._num_tasks = 0
+
+    def get(self):
+        # Every child runs at least one task, however big it starts out
+        if self._num_tasks > 0:
+            rss = currentRSS()
+            if rss > self._max_rss_bytes:
+                logger.info("Pool worker %d using %d bytes (limit %d) after %d tasks, recycling it" %
+                            (os.getpid(), rss, self._max_rss_bytes, self._num_tasks))
+                return None
+        self._num_tasks += 1
+        return self._queue.get()
+
+    def __getattr__(self, name):
+        return getattr(self._queue, name)
+
+
+class recycling_pool(multiprocessing.pool.Pool):
+    """
+    multiprocessing.Pool whose children are replaced once they have run
+    maxtasksperchild tasks or their resident size passes max_rss_bytes.
+    """
+
+    def __init__(self, processes=None, initializer=None, initargs=(), maxtasksperchild=None, max_rss_bytes=None):
+        self._max_rss_bytes = max_rss_bytes
+        multiprocessing.pool.Pool.__init__(self, processes, initializer, initargs, maxtasksperchild)
+
+    def Process(self, *args, **kwargs):
+        # Called by the pool to start each child with target=pool worker, args=(inqueue, outqueue, ...)
+        if self._max_rss_bytes and "args" in kwargs:
+            child_args = kwargs["args"]
+            kwargs["args"] = (rss_limited_queue(child_args[0], self._max_rss_bytes),) + tuple(child_args[1:])
+        return multiprocessing.Process(*args, **kwargs)
+
 
 class mp_pool(object):
     """
@@ -34,10 +99,15 @@ class mp_pool(object):
 
         Parameters:
 
-        mp_pool([processes[, initializer[, initargs[, maxtasksperchild]]]])
+        mp_pool([processes[, initializer[, initargs[, maxtasksperchild[, max_rss_bytes]]]]])
+
+        initializer(*initargs) runs once in every child as it starts, so
+        state it builds (eg workers) is reused by all the tasks that child
+        runs. Children are replaced after maxtasksperchild tasks, or once
+        they grow past max_rss_bytes.
         """
         self._tasks = Queue.Queue()
-        self._pool = multiprocessing.Pool(*args, **kargs)
+        self._pool = recycling_pool(*args, **kargs)
         return
 
     def __del__(self):
@@ -58,6 +128,14 @@ class mp_pool(object):
         self._tasks.put(r)
         return True
 
+    def submit(self, func, *args, **kargs):
+        """
+        Submit func(*args, **kargs) to the process pool and return its
+        AsyncResult. Unlike add_task the result is not placed on the task
+        queue, so wait_completion() does not block on it.
+        """
+        return self._pool.apply_async(func, args, kargs)
+
     def wait_completion(self, timeout=None):
         """
         Blocks until all the tasks currently in the queue have completed.
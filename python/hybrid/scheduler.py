@@ -0,0 +1,176 @@
+"""
+task_scheduler keeps a bounded number of manager tasks in flight on an
+mp_pool or mp_celery instance, so the manager can go back to the database
+for the next batch while the previous ones are still being processed.
+"""
+"""
+Copyright 2017 Sandia Corporation.
+Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
+the U.S. Government retains certain rights in this software.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class task_scheduler(object):
+    """
+    Dispatches tasks (dicts from utils.computeTaskProcessingRanges) to a
+    process pool without waiting on each one, and reports each task as it
+    completes.
+    """
+
+    def __init__(self, mp, max_outstanding=None, poll_interval=0.1, on_complete=None):
+        """
+        task_scheduler constructor
+
+        Parameters:
+            mp:              mp_pool or mp_celery instance (anything with a submit method)
+            max_outstanding: maximum number of tasks in flight, None means no limit
+            poll_interval:   seconds between completion checks while blocked
+            on_complete:     optional callable(task, successful, elapsed) run as tasks finish. elapsed is the
+                             task's service time if it returned a dict with start_time and end_time (taken
+                             where it ran), otherwise the time from submit to the poll that reaped it, which
+                             includes time queued in the pool
+        """
+        self._mp = mp
+        self._max_outstanding = max_outstanding
+        self._poll_interval = poll_interval
+        self._on_complete = on_complete
+        self._in_flight = []
+        self._num_submitted = 0
+        self._num_completed = 0
+        self._num_failed = 0
+
+    @property
+    def max_outstanding(self):
+        return self._max_outstanding
+
+    @max_outstanding.setter
+    def max_outstanding(self, max_outstanding):
+        self._max_outstanding = max_outstanding
+
+    @property
+    def num_outstanding(self):
+        return len(self._in_flight)
+
+    @property
+    def num_completed(self):
+        return self._num_completed
+
+    @property
+    def num_failed(self):
+        return self._num_failed
+
+    def is_full(self):
+        if self._max_outstanding is None:
+            return False
+        return len(self._in_flight) >= self._max_outstanding
+
+    def in_flight_uuids(self):
+        """ Set of document uuids belonging to tasks that have not completed yet """
+        uuids = set()
+        for entry in self._in_flight:
+            uuids.update(entry["task"].get("uuids", []))
+        return uuids
+
+    def submit(self, task, func, *args, **kwargs):
+        """
+        Submit func(*args, **kwargs) for the given task. Blocks only while the
+        number of outstanding tasks is at max_outstanding.
+        """
+        while self.is_full():
+            self.wait_any()
+
+        result = self._mp.submit(func, *args, **kwargs)
+        self._num_submitted += 1
+        self._in_flight.append({"task": task, "result": result, "id": self._num_submitted,
+                                "start_time": time.time()})
+        logger.info("Submitted task %d (%d docs), %d task(s) in flight" % (
+            self._num_submitted, task.get("num_docs", 0), len(self._in_flight)))
+        return True
+
+    def poll(self):
+        """ Reap every finished task without blocking, returns the list of finished tasks """
+        finished = []
+        still_running = []
+        for entry in self._in_flight:
+            if entry["result"].ready():
+                self._finish(entry)
+                finished.append(entry["task"])
+            else:
+                still_running.append(entry)
+        self._in_flight = still_running
+        return finished
+
+    def wait_any(self, timeout=None):
+        """ Block until at least one in flight task finishes (or timeout seconds pass) """
+        start = time.time()
+        while self._in_flight:
+            finished = self.poll()
+            if finished:
+                return finished
+            if timeout is not None and (time.time() - start) >= timeout:
+                break
+            time.sleep(self._poll_interval)
+        return []
+
+    def wait_all(self, timeout=None):
+        """ Block until every in flight task has finished (or timeout seconds pass) """
+        start = time.time()
+        finished = []
+        while self._in_flight:
+            remaining = None
+            if timeout is not None:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    break
+            finished.extend(self.wait_any(remaining))
+        return finished
+
+    def _finish(self, entry):
+        task = entry["task"]
+        elapsed = time.time() - entry["start_time"]
+        try:
+            successful = entry["result"].successful()
+        except Exception:
+            successful = False
+
+        if successful:
+            service_time = self.service_time(entry["result"])
+            if service_time is not None:
+                elapsed = service_time
+
+        if successful:
+            self._num_completed += 1
+            logger.info("Task %d complete: %d docs [%s .. %s] in %.2fs" % (
+                entry["id"], task.get("num_docs", 0), task.get("start_key"), task.get("end_key"), elapsed))
+        else:
+            self._num_failed += 1
+            logger.error("Task %d failed: %d docs [%s .. %s] after %.2fs" % (
+                entry["id"], task.get("num_docs", 0), task.get("start_key"), task.get("end_key"), elapsed))
+
+        if self._on_complete is not None:
+            self._on_complete(task, successful, elapsed)
+
+    @staticmethod
+    def service_time(result):
+        """ Seconds the task spent running, from the start_time and end_time it returned, None if it didn't """
+        try:
+            value = result.get(0)
+        except Exception:
+            return None
+        if not isinstance(value, dict) or "start_time" not in value or "end_time" not in value:
+            return None
+        return max(0.0, value["end_time"] - value["start_time"])
+
+    def __str__(self):
+        s = 80 * "=" + "\n"
+        s += "task_scheduler\n"
+        s += "\tmax outstanding: %s\n" % (self._max_outstanding,)
+        s += "\tin flight: %d\n" % (len(self._in_flight),)
+        s += "\tsubmitted: %d completed: %d failed: %d\n" % (self._num_submitted, self._num_completed,
+                                                              self._num_failed)
+        s += 80 * "=" + "\n"
+        return s
@@ -0,0 +1,119 @@
+"""
+Copyright 2017 Sandia Corporation.
+Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
+the U.S. Government retains certain rights in this software.
+"""
+import unittest
+
+import hybrid.change_feed
+import hybrid.data_blob
+import hybrid.utils
+
+
+class list_change_feed(hybrid.change_feed.change_feed):
+    """ Feed over an in memory list of (sequence, doc) changes """
+
+    def __init__(self, changes, stored=None, **kwargs):
+        self.changes = changes
+        self.stored = stored
+        self.checkpoints = []
+        hybrid.change_feed.change_feed.__init__(self, None, ["text"], ["done"], **kwargs)
+
+    def loadCheckpoint(self):
+        return self.stored
+
+    def currentPosition(self):
+        return 0
+
+    def storeCheckpoint(self, position):
+        self.checkpoints.append(position)
+        self.stored = position
+
+    def read_changes(self, limit):
+        changes = [(seq, doc) for seq, doc in self.changes if seq > self._position][:limit]
+        if not changes:
+            return self._position, []
+        return changes[-1][0], [doc["_id"] for seq, doc in changes if self.matches(doc)]
+
+
+class change_feed_tests(unittest.TestCase):
+    def setUp(self):
+        self.changes = [(1, {"_id": "a", "text": "x"}),
+                        (2, {"_id": "b", "text": "x", "done": True}),
+                        (3, {"_id": "c"}),
+                        (4, {"_id": "d", "text": "x"})]
+
+    def test_poll_filters_on_tags(self):
+        feed = list_change_feed(self.changes)
+        self.assertEqual(feed.poll(limit=2), ["a"])
+        self.assertEqual(feed.poll(limit=2), ["d"])
+        self.assertEqual(feed.poll(limit=2), [])
+        self.assertEqual(feed.position, 4)
+
+    def test_checkpoint_waits_for_in_flight(self):
+        feed = list_change_feed(self.changes, checkpoint_interval=0)
+        feed.poll(limit=2)
+        feed.poll(limit=2)
+
+        feed.acknowledge(set(["a"]))
+        self.assertEqual(feed.checkpoints, [])
+        feed.acknowledge(set(["d"]))
+        self.assertEqual(feed.checkpoints, [2])
+        feed.acknowledge(set())
+        self.assertEqual(feed.checkpoints, [2, 4])
+
+    def test_resume_from_checkpoint(self):
+        feed = list_change_feed(self.changes, stored=2)
+        self.assertEqual(feed.poll(), ["d"])
+
+    def test_close_stores_checkpoint(self):
+        feed = list_change_feed(self.changes, checkpoint_interval=60)
+        feed.poll()
+        feed.acknowledge(set())
+        self.assertEqual(feed.checkpoints, [])
+        feed.close()
+        self.assertEqual(feed.checkpoints, [4])
+
+
+class task_range_tests(unittest.TestCase):
+    def test_ranges_for_uuids(self):
+        uuids = ["u%d" % i for i in range(7)]
+        tasks = hybrid.utils.computeTaskProcessingRangesForUUIDs(uuids, 3)
+        self.assertEqual([task["uuids"] for task in tasks], [uuids[0:2], uuids[2:4], uuids[4:]])
+        self.assertEqual([task["num_docs"] for task in tasks], [2, 2, 3])
+        self.assertEqual((tasks[2]["start_key"], tasks[2]["end_key"]), ("u4", "u6"))
+
+    def test_fewer_uuids_than_threads(self):
+        tasks = hybrid.utils.computeTaskProcessingRangesForUUIDs(["u0", "u1"], 4)
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0]["uuids"], ["u0", "u1"])
+
+    def test_ranges_balanced_by_cost(self):
+        uuids = ["u%d" % i for i in range(6)]
+        tasks = hybrid.utils.computeTaskProcessingRangesByCost(uuids, [100, 1, 1, 1, 1, 1], 2, [100, 1, 1, 1, 1, 1])
+        self.assertEqual([task["uuids"] for task in tasks], [["u0"], uuids[1:]])
+        self.assertEqual([task["cost"] for task in tasks], [100, 5])
+        self.assertEqual([task["size"] for task in tasks], [100, 5])
+
+    def test_ranges_from_blob_sizes(self):
+        rows = []
+        for i in range(4):
+            blob = hybrid.data_blob.create("u%d" % i)
+            blob.setBinaryData("text", "text/plain", "x" * (100000 if i == 1 else 10))
+            rows.append(blob)
+        tasks = hybrid.utils.computeTaskProcessingRanges(rows, 2)
+        self.assertEqual([task["uuids"] for task in tasks], [["u1"], ["u0", "u2", "u3"]])
+
+    def test_unsized_rows_are_chunked(self):
+        rows = []
+        for i in range(16):
+            blob = hybrid.data_blob.create("u%d" % i)
+            blob.setBinaryDataStub("text", "text/plain")
+            rows.append(blob)
+        tasks = hybrid.utils.computeTaskProcessingRanges(rows, 2)
+        self.assertEqual(len(tasks), 2 * hybrid.utils.CHUNKS_PER_THREAD)
+        self.assertEqual(sum(task["num_docs"] for task in tasks), 16)
+
+
+if __name__ == "__main__":
+    unittest.main()
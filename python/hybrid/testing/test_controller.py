@@ -0,0 +1,80 @@
+"""
+Copyright 2017 Sandia Corporation.
+Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
+the U.S. Government retains certain rights in this software.
+"""
+import unittest
+
+import hybrid.controller
+import hybrid.utils
+
+
+class controller_tests(unittest.TestCase):
+    def setUp(self):
+        self.controller = hybrid.controller.adaptive_controller(1, 8, 10, 1000, outstanding=2, batch_size=100,
+                                                                target_task_seconds=10, window=2)
+
+    def test_waits_for_window(self):
+        self.controller.record_fetch(200, 200)
+        self.assertFalse(self.controller.update())
+        self.assertEqual(self.controller.outstanding, 2)
+
+    def test_backlog_grows(self):
+        # 0.01s per document, so 1000 documents make a 10s task
+        self.controller.record_task(100, 1.0, True)
+        self.controller.record_fetch(200, 200)
+        self.assertTrue(self.controller.update())
+        self.assertEqual(self.controller.outstanding, 3)
+        self.assertEqual(self.controller.batch_size, 550)
+
+    def test_no_backlog_shrinks_batches(self):
+        self.controller.record_fetch(5, 200)
+        self.controller.record_fetch(0, 200)
+        self.assertTrue(self.controller.update())
+        self.assertEqual(self.controller.outstanding, 2)
+        self.assertEqual(self.controller.batch_size, 75)
+
+    def test_errors_back_off(self):
+        self.controller.record_error()
+        self.controller.record_fetch(200, 200)
+        self.assertTrue(self.controller.update())
+        self.assertEqual(self.controller.outstanding, 1)
+        self.assertEqual(self.controller.batch_size, 50)
+
+    def test_congestion(self):
+        self.controller.record_task(100, 1.0, True)
+        self.controller.record_fetch(200, 200)
+        self.controller.update()
+        for i in range(4):
+            self.controller.record_task(100, 10.0, True)
+        self.assertTrue(self.controller.congested())
+        self.controller.update()
+        self.assertEqual(self.controller.outstanding, 2)
+
+    def test_bounds(self):
+        controller = hybrid.controller.adaptive_controller(1, 2, 10, 20, outstanding=5, batch_size=500)
+        self.assertEqual((controller.outstanding, controller.batch_size), (2, 20))
+
+
+class cost_model_tests(unittest.TestCase):
+    def test_learns_overhead(self):
+        # One second per document and a millisecond per byte: a document costs as much as 1000 bytes
+        model = hybrid.controller.task_cost_model(min_tasks=2)
+        for num_docs, size in [(10, 1000), (10, 50000), (40, 2000), (5, 80000)]:
+            model.record_task(num_docs, size, num_docs + size / 1000.0)
+        self.assertAlmostEqual(model.overhead, 1000, places=3)
+        self.assertAlmostEqual(model.weight(500), 1500, places=3)
+
+    def test_size_does_not_matter(self):
+        model = hybrid.controller.task_cost_model(min_tasks=2)
+        for num_docs, size in [(10, 1000), (10, 50000), (40, 2000), (5, 80000)]:
+            model.record_task(num_docs, size, float(num_docs))
+        self.assertEqual(model.weight(100), model.weight(100000))
+
+    def test_default_until_trained(self):
+        model = hybrid.controller.task_cost_model()
+        self.assertEqual(model.weight(10), hybrid.utils.DOCUMENT_OVERHEAD + 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
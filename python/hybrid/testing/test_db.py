@@ -3,10 +3,16 @@ Copyright 2017 Sandia Corporation.
 Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
 the U.S. Government retains certain rights in this software.
 """
+import marshal
+import pickle
+import StringIO
 import unittest
 
+import bson
+
 import hybrid.data_blob as data_blob
 import hybrid.db as db
+import hybrid.model as model
 
 
 class SimpleDBTests(unittest.TestCase):
@@ -86,6 +92,16 @@ class SimpleDBTests(unittest.TestCase):
     def cleanDatabase(self):
         self._db.delete()
 
+    def test_get_connection(self):
+        db.clear_connections()
+        kwargs = {"host": self._kwargs["host"], "database": self._kwargs["database"], "create": True}
+        handle = db.get_connection("couchdb", **kwargs)
+        self.assertIs(handle, db.get_connection("couchdb", **kwargs))
+        # Idle handles are reopened, destructive opens bypass the registry
+        self.assertIsNot(handle, db.get_connection("couchdb", idle_timeout=-1, **kwargs))
+        self.assertIsNot(handle, db.get_connection("couchdb", delete_existing=True, **kwargs))
+        db.clear_connections()
+
     '''
     def test_interface(self):
         for method,value in inspect.getmembers(db.abstract_db(), predicate=inspect.ismethod):
@@ -259,5 +275,261 @@ class SimpleDBTests(unittest.TestCase):
         '''
 
 
+class QueryPlanTests(unittest.TestCase):
+    def test_winning_plan_stages(self):
+        explain_output = {"queryPlanner": {"winningPlan": {
+            "stage": "FETCH", "inputStage": {
+                "stage": "OR", "inputStages": [{"stage": "IXSCAN"}, {"stage": "COLLSCAN"}]}}}}
+        self.assertEqual(db.getQueryPlanStages(explain_output), ["FETCH", "OR", "IXSCAN", "COLLSCAN"])
+
+    def test_legacy_cursor(self):
+        self.assertEqual(db.getQueryPlanStages({"cursor": "BasicCursor"}), ["COLLSCAN"])
+        self.assertEqual(db.getQueryPlanStages({"cursor": "BtreeCursor _dataBlobID_1"}), ["IXSCAN"])
+        self.assertEqual(db.getQueryPlanStages({}), [])
+
+
+class LeaseLockTests(unittest.TestCase):
+    def test_lock_held(self):
+        lock = {"lock_instance": "other", "lease_expires": 100.0}
+        self.assertTrue(db.isLockHeld(lock, "mine", now=50.0))
+        self.assertFalse(db.isLockHeld(lock, "other", now=50.0))
+        self.assertFalse(db.isLockHeld(None, "mine", now=50.0))
+
+    def test_expired_lease(self):
+        self.assertFalse(db.isLockHeld({"lock_instance": "other", "lease_expires": 100.0}, "mine", now=100.0))
+        # Locks from before leases never expire on their own
+        self.assertTrue(db.isLockHeld({"lock_instance": "other"}, "mine", now=1e12))
+
+    def test_wait_bounded_by_lease(self):
+        self.assertEqual(db.lockWaitSeconds({"lease_expires": 101.0}, now=100.0), 1.0)
+        self.assertEqual(db.lockWaitSeconds({"lease_expires": 1000.0}, now=100.0), db.LOCK_WAIT_SECONDS)
+        self.assertEqual(db.lockWaitSeconds({}, now=100.0), db.LOCK_WAIT_SECONDS)
+
+    def test_cached_state(self):
+        state = db.lock_state(ttl=60)
+        self.assertTrue(state.isStale())
+        state.set(None)
+        self.assertFalse(state.isStale())
+        state.invalidate()
+        self.assertTrue(state.isStale())
+        state.setWatched(True)
+        self.assertFalse(state.isStale())
+
+
+
+class MetaDataChangeTests(unittest.TestCase):
+    def setUp(self):
+        self.blob = data_blob.dict2blob({"_dataBlobID": "blob", "text": "x", "counts": {"a": 1}, "tags": [1]})
+        self.db = object()
+        self.blob.markMetaDataStored(self.db)
+
+    def test_untracked_db(self):
+        self.assertEqual(self.blob.getMetaDataChanges(self.db), ({}, []))
+        self.assertEqual(self.blob.getMetaDataChanges(object()), None)
+        self.assertEqual(data_blob.data_blob("new").getMetaDataChanges(self.db), None)
+
+    def test_set_and_delete_paths(self):
+        self.blob.setMetaData("counts:b", 2)
+        self.blob.setMetaData("done", True)
+        self.blob.deleteMetaData("text")
+        self.assertEqual(self.blob.getMetaDataChanges(self.db), ({"counts:b": 2, "done": True}, ["text"]))
+        self.blob.markMetaDataStored(self.db)
+        self.assertEqual(self.blob.getMetaDataChanges(self.db), ({}, []))
+
+    def test_changed_in_place(self):
+        self.blob.getMetaData("tags").append(2)
+        self.assertEqual(self.blob.getMetaDataChanges(self.db), ({"tags": [1, 2]}, []))
+
+    def test_nested_paths_covered_by_parent(self):
+        self.blob.setMetaData("counts:b", 2)
+        self.blob.setMetaData("counts", {"c": 3})
+        self.assertEqual(self.blob.getMetaDataChanges(self.db), ({"counts": {"c": 3}}, []))
+
+    def test_mongo_update_document(self):
+        self.assertEqual(db.mongoUpdateDocument({"counts:b": 2}, ["text"]),
+                         {"$set": {"counts.b": 2}, "$unset": {"text": ""}})
+        self.assertEqual(db.mongoUpdateDocument({}, []), {})
+        self.assertEqual(db.mongoUpdateDocument({"a.b": 1}, []), None)
+
+    def test_set_native_field(self):
+        doc = {"_id": "blob", "counts": 1}
+        db.setNativeField(doc, "done", "complete")
+        db.setNativeField(doc, "counts:b", 2)
+        self.assertEqual(doc, {"_id": "blob", "done": "complete", "counts": {"b": 2}})
+
+
+class revision_db(object):
+    """ Stands in for a database holding one model parameters blob at revision "1-a" """
+
+    def __init__(self):
+        self.loads = 0
+
+    def getBlobRevision(self, uuid):
+        return "1-a"
+
+    def loadDataBlob(self, uuid, **kwargs):
+        self.loads += 1
+        blob = data_blob.create(uuid)
+        blob.setDataBlobRevision("1-a")
+        blob.setMetaData("model_type", u"test")
+        blob.setMetaData("model_desc", u"test")
+        blob.setMetaData("weights", [1, 2])
+        return blob
+
+
+class cached_model(model.model):
+    database = None
+
+    def getDB(self):
+        return cached_model.database
+
+
+class ParameterCacheTests(unittest.TestCase):
+    def setUp(self):
+        model.clearParameterCache()
+        cached_model.database = revision_db()
+
+    def tearDown(self):
+        model.clearParameterCache()
+
+    def test_hits_are_independent(self):
+        first = cached_model("m")
+        second = cached_model("m")
+        self.assertTrue(first.loadFromDB())
+        self.assertTrue(second.loadFromDB())
+        self.assertEqual(cached_model.database.loads, 1)
+
+        first.getParameters().setMetaData("weights", [3])
+        self.assertEqual(second.getParameters().getMetaData("weights"), [1, 2])
+
+        third = cached_model("m")
+        third.loadFromDB()
+        self.assertEqual(third.getParameters().getMetaData("weights"), [1, 2])
+        self.assertIsNot(third.getParameters(), second.getParameters())
+
+
+class offline_couchdb(db.couchdb):
+    """ couchdb handle that never opens a connection, serving attachments from a dict """
+    attachments = {}
+
+    def open(self):
+        pass
+
+    def loadAttachment(self, doc_id, field, rev=None):
+        return offline_couchdb.attachments[(doc_id, field, rev)]
+
+
+class all_docs_row(dict):
+    def __init__(self, key, doc):
+        dict.__init__(self, doc=doc)
+        self.key = key
+
+
+class progress_couch(object):
+    """ Stands in for a raw couch database holding docs, answering _all_docs and _bulk_docs """
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.updated = []
+
+    def get(self, doc_id):
+        return self.docs.get(doc_id)
+
+    def view(self, view_uri, keys=None, include_docs=False):
+        return [all_docs_row(key, self.docs.get(key)) for key in keys]
+
+    def update(self, docs):
+        self.updated.extend(docs)
+        return [(True, doc["_id"], "2-b") for doc in docs]
+
+
+class MarkProgressTests(unittest.TestCase):
+    def test_missing_documents_fail(self):
+        database = offline_couchdb(host="http://localhost:5984", database="tests", delete_existing=True)
+        database._raw_db = progress_couch({"a": {"_id": "a", "_rev": "1-a"}})
+        failed_ids = database.markProgress({"a": {"tags:done": True}, "gone": {"tags:done": True}})
+        self.assertEqual(failed_ids, ["gone"])
+        self.assertEqual(database._raw_db.updated, [{"_id": "a", "_rev": "1-a", "tags": {"done": True}}])
+
+
+class offline_mongodb(db.mongodb):
+    """ mongodb handle that never opens a connection """
+
+    def open(self):
+        pass
+
+
+class offline_gridfs(object):
+    def __init__(self, files):
+        self.files = files
+
+    def get(self, file_id):
+        return StringIO.StringIO(self.files[file_id])
+
+
+class offline_gridfs_files(object):
+    def __init__(self, meta_file):
+        self.meta_file = meta_file
+
+    def find_one(self, spec, **kwargs):
+        return self.meta_file
+
+
+class BinaryLoaderTests(unittest.TestCase):
+    def setUp(self):
+        offline_couchdb.attachments = {("blob", "model", "2-b"): "pickled model"}
+        self._get_connection = db.get_connection
+
+    def tearDown(self):
+        db.get_connection = self._get_connection
+
+    def test_pickled_couch_blob(self):
+        database = offline_couchdb(host="http://localhost:5984", database="tests", delete_existing=True)
+        doc = {"_id": "blob", "_rev": "2-b", "_dataBlobID": "blob", "name": u"parameters",
+               "_attachments": {"model": {"content_type": "text/plain", "length": 13, "digest": "md5-a",
+                                          "stub": True}}}
+        blob = database.create_blob_from_native_doc(doc, include_binary=True)
+
+        unpickled = pickle.loads(pickle.dumps(blob))
+        self.assertEqual(unpickled.getBinaryDataStubs().keys(), ["model"])
+
+        # The unpickled loader reopens its database through the connection registry
+        reopened = []
+
+        def get_connection(subclass, **kwargs):
+            reopened.append((subclass, kwargs))
+            return database
+
+        db.get_connection = get_connection
+        self.assertEqual(unpickled.getBinaryData("model", "text/plain"), "pickled model")
+        self.assertEqual(reopened, [("couchdb", {"host": "http://localhost:5984", "database": "tests"})])
+
+    def test_pickled_gridfs_blob(self):
+        file_id = bson.objectid.ObjectId()
+        meta_id = bson.objectid.ObjectId()
+        database = offline_mongodb(database="tests", use_gridfs=True, delete_existing=True)
+        database._raw_gridfs = offline_gridfs({
+            meta_id: marshal.dumps({"_id": "blob", "_dataBlobID": "blob", "name": u"parameters",
+                                    "_binary_files": {"model": {"file_id": str(file_id), "digest": "a",
+                                                                "content_type": "text/plain",
+                                                                "length": 13}}}),
+            file_id: "pickled model"})
+        database._raw_gridfs_files = offline_gridfs_files({"_id": meta_id})
+        blob = database.loadGridFSBlob("blob")
+
+        unpickled = pickle.loads(pickle.dumps(blob))
+        self.assertEqual(unpickled.getBinaryDataStubs().keys(), ["model"])
+
+        reopened = []
+
+        def get_connection(subclass, **kwargs):
+            reopened.append((subclass, kwargs))
+            return database
+
+        db.get_connection = get_connection
+        self.assertEqual(unpickled.getBinaryData("model", "text/plain"), "pickled model")
+        self.assertEqual(reopened, [("mongodb", {"database": "tests", "use_gridfs": True})])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,301 @@
+"""
+Copyright 2017 Sandia Corporation.
+Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
+the U.S. Government retains certain rights in this software.
+"""
+import pickle
+import threading
+import time
+import unittest
+
+import hybrid.controller
+import hybrid.data_blob
+import hybrid.manager
+import hybrid.model
+import hybrid.utils
+from hybrid.worker.worker import abstract_worker
+from hybrid_sklearn import gaussiannb_worker, sklearn_utils
+
+
+class recording_worker(abstract_worker):
+    """ Marks each observation under its name and records what it saw and the threads it ran in """
+
+    def __init__(self, name, fail_uuids=(), **kwargs):
+        abstract_worker.__init__(self, name=name, nest_metadata=True, **kwargs)
+        self.fail_uuids = set(fail_uuids)
+        self.threads = set()
+        self.seen = []
+
+    def initializeObservation(self, observation):
+        self.setMetaData(observation, "worker_data_version", self._data_version, nest_metadata=True)
+
+    def process_observation_core(self, observation, **kwargs):
+        self.threads.add(threading.current_thread().name)
+        self.seen.append(observation.getMetaData("_dataBlobID"))
+        if observation.getMetaData("_dataBlobID") in self.fail_uuids:
+            self.setMetaData(observation, "worker_bad_data", True)
+        self.setMetaData(observation, "done", True, nest_metadata=True)
+
+
+class plain_worker(abstract_worker):
+    """ Writes its fields at the top level of the observations """
+
+    def __init__(self, name, fail_uuids=()):
+        abstract_worker.__init__(self, name=name)
+        self.fail_uuids = set(fail_uuids)
+        self.seen = []
+
+    def process_observation_core(self, observation, **kwargs):
+        self.seen.append(observation.getMetaData("_dataBlobID"))
+        if observation.getMetaData("_dataBlobID") in self.fail_uuids:
+            self.setMetaData(observation, "worker_bad_data", True)
+        self.setMetaData(observation, self.get_name(), "done")
+
+
+class binary_worker(abstract_worker):
+    """ Replaces or deletes the image binary field of the observations """
+
+    def __init__(self, name, image=None):
+        abstract_worker.__init__(self, name=name)
+        self.image = image
+
+    def process_observation_core(self, observation, **kwargs):
+        if self.image is None:
+            observation.deleteBinaryData("image")
+        else:
+            observation.setBinaryData("image", "image/png", self.image)
+
+
+class worker_level_tests(unittest.TestCase):
+    def test_levels_from_dependencies(self):
+        a = recording_worker("a")
+        b = recording_worker("b")
+        c = recording_worker("c")
+        c.set_worker_dependency(a, [0])
+        d = recording_worker("d", worker_data_dependencies={"c": [0], "b": [0]})
+        levels = hybrid.manager.workerLevels([a, b, c, d])
+        self.assertEqual([[worker.get_name() for worker in level] for level in levels], [["a", "b"], ["c"], ["d"]])
+
+    def test_cycle_runs_in_order(self):
+        a = recording_worker("a", worker_data_dependencies={"b": [0]})
+        b = recording_worker("b", worker_data_dependencies={"a": [0]})
+        levels = hybrid.manager.workerLevels([a, b])
+        self.assertEqual(levels, [[a], [b]])
+
+    def test_evaluate_levels(self):
+        observations = [hybrid.data_blob.create("u%d" % i) for i in range(3)]
+        a = recording_worker("a")
+        b = recording_worker("b", fail_uuids=["u1"])
+        c = recording_worker("c")
+        c.set_worker_dependency(a, [0])
+        complete, incomplete = hybrid.manager.evaluateWorkerLevels([a, b, c], observations)
+
+        self.assertEqual([observation.getMetaData("_dataBlobID") for observation in complete], ["u0", "u2"])
+        self.assertEqual([observation.getMetaData("_dataBlobID") for observation in incomplete], ["u1"])
+        # c only sees what both workers of the first level completed
+        self.assertEqual(c.seen, ["u0", "u2"])
+        self.assertTrue(complete[0].getMetaData("a:done") and complete[0].getMetaData("b:done") and
+                        complete[0].getMetaData("c:done"))
+        self.assertNotEqual(a.threads, set([threading.current_thread().name]))
+
+    def test_shared_fields_stay_per_worker(self):
+        # Without nesting both workers write the same top level worker_data_version and worker_bad_data
+        observations = [hybrid.data_blob.create("u%d" % i) for i in range(3)]
+        a = plain_worker("a", fail_uuids=["u1"])
+        b = plain_worker("b")
+        complete, incomplete = hybrid.manager.evaluateWorkerLevels([a, b], observations)
+
+        self.assertEqual(sorted(a.seen), ["u0", "u1", "u2"])
+        self.assertEqual(sorted(b.seen), ["u0", "u1", "u2"])
+        self.assertEqual([observation.getMetaData("_dataBlobID") for observation in incomplete], ["u1"])
+        self.assertIs(complete[0], observations[0])
+        self.assertEqual((complete[0].getMetaData("a"), complete[0].getMetaData("b")), ("done", "done"))
+        self.assertTrue(observations[1].getMetaData("worker_bad_data"))
+
+    def getImageObservations(self):
+        observations = [hybrid.data_blob.create("u%d" % i) for i in range(2)]
+        for observation in observations:
+            observation.setBinaryData("image", "image/png", "original")
+        return observations
+
+    def test_binary_deletion_merges(self):
+        # b runs alongside a without touching the image, its copy must not bring the image back
+        observations = self.getImageObservations()
+        hybrid.manager.evaluateWorkerLevels([binary_worker("a"), plain_worker("b")], observations)
+        for observation in observations:
+            self.assertFalse(observation.hasBinaryData("image"))
+            self.assertEqual(observation.getMetaData("b"), "done")
+
+    def test_binary_change_merges(self):
+        observations = self.getImageObservations()
+        hybrid.manager.evaluateWorkerLevels([binary_worker("a", "changed"), plain_worker("b")], observations)
+        for observation in observations:
+            self.assertEqual(observation.getBinaryData("image"), "changed")
+
+
+class stored_model(hybrid.model.model):
+    """ Model without a database that counts the stores that get through """
+    stores = []
+
+    def storeToDB(self, lock_id=None, atomic=False):
+        if hybrid.model._deferred_stores is not None:
+            return hybrid.model.model.storeToDB(self, lock_id)
+        assert atomic, "retrained revisions are written in place"
+        stored_model.stores.append(self.getParameters().getDataBlobUUID())
+
+    def getModelObservationsManager(self):
+        return None
+
+
+class rows_manager(object):
+    """ Model observations manager over an in memory list """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def isValid(self):
+        return True
+
+    def isUpdated(self):
+        return True
+
+    def getRows(self):
+        return self.rows
+
+    def getTargetDB(self):
+        return None
+
+
+class stored_nb_model(sklearn_utils.gaussian_nb_model):
+    """ Gaussian NB model that records its stores instead of writing them to a database """
+    stores = []
+    rows = []
+
+    def getDB(self):
+        return self
+
+    def storeToDB(self, lock_id=None, atomic=False):
+        if hybrid.model._deferred_stores is not None:
+            return sklearn_utils.gaussian_nb_model.storeToDB(self, lock_id)
+        assert atomic, "retrained revisions are written in place"
+        stored_nb_model.stores.append(self.getParameters().getBinaryData("gnb_model", "application/pickle"))
+        return True
+
+    def getModelObservationsManager(self):
+        return rows_manager(stored_nb_model.rows)
+
+
+class retraining_worker(abstract_worker):
+    def __init__(self, valid=True, seconds=0.0):
+        abstract_worker.__init__(self, name="retraining_worker")
+        self._model = stored_model("m")
+        self.valid = valid
+        self.seconds = seconds
+
+    def get_model(self):
+        return self._model
+
+    def update_model(self):
+        time.sleep(self.seconds)
+        self._model.storeToDB()
+        if self.valid:
+            self._model.setValid()
+        self._model.storeToDB()
+        return True
+
+
+class retraining_manager(hybrid.manager.manager):
+    def projectModelObservations(self, worker, worker_model):
+        return
+
+
+class background_retraining_tests(unittest.TestCase):
+    def setUp(self):
+        stored_model.stores = []
+
+    def create_manager(self, **kwargs):
+        return retraining_manager(workers=[], worker_threads=1, observation_limit=10, background_retraining=True,
+                                  model_update_sleep=0, **kwargs)
+
+    def wait_for(self, manager, worker):
+        manager._retrains["m"]["process"].join(10)
+        return manager.retrainInBackground(worker, worker.get_model())
+
+    def test_deferred_stores_write_once(self):
+        worker = retraining_worker()
+        manager = self.create_manager()
+        self.assertRaises(SystemExit, manager.retrainModel, retraining_worker(valid=False))
+        self.assertEqual(stored_model.stores, [])
+        manager.retrainModel(worker)
+        self.assertEqual(stored_model.stores, ["m"])
+        self.assertIsNone(hybrid.model._deferred_stores)
+
+    def test_retrain_sklearn_worker(self):
+        stored_nb_model.stores = []
+        stored_nb_model.rows = []
+        for i in range(6):
+            observation = hybrid.data_blob.create("o%d" % i)
+            observation.setMetaData("x", float(i))
+            observation.setMetaData("label", int(i >= 3))
+            stored_nb_model.rows.append(observation)
+        worker = gaussiannb_worker.gaussiannb_worker(model=stored_nb_model("nb"), model_type=stored_nb_model,
+                                                     feature_vectors=["x"], truth_vectors=["label"])
+
+        self.create_manager().retrainModel(worker)
+        self.assertEqual(len(stored_nb_model.stores), 1)
+        estimator = pickle.loads(stored_nb_model.stores[0])
+        self.assertEqual(list(estimator.predict([[0.0], [5.0]])), [0, 1])
+
+    def test_scoring_continues_while_retraining(self):
+        worker = retraining_worker()
+        manager = self.create_manager()
+        self.assertTrue(manager.retrainInBackground(worker, worker.get_model()))
+        process = manager._retrains["m"]["process"]
+        self.assertTrue(self.wait_for(manager, worker))
+        self.assertEqual(process.exitcode, 0)
+        self.assertIsNone(manager._retrains["m"]["process"])
+        manager.modelCurrent(worker.get_model())
+        self.assertEqual(manager._retrains, {})
+
+    def test_failed_retrain_waits_to_retry(self):
+        worker = retraining_worker(valid=False)
+        manager = self.create_manager()
+        manager._model_update_sleep = 60
+        manager.retrainInBackground(worker, worker.get_model())
+        self.wait_for(manager, worker)
+        self.assertIsNone(manager._retrains["m"]["process"])
+
+    def test_staleness_bound(self):
+        worker = retraining_worker(seconds=1.0)
+        manager = self.create_manager(max_model_staleness=0)
+        manager.retrainInBackground(worker, worker.get_model())
+        time.sleep(0.01)
+        self.assertFalse(manager.retrainInBackground(worker, worker.get_model()))
+        manager._retrains["m"]["process"].join(10)
+
+
+class task_sizing_tests(unittest.TestCase):
+    def setUp(self):
+        self.manager = hybrid.manager.manager(workers=[], worker_threads=2, observation_limit=25)
+        self.uuids = ["doc%d" % i for i in range(100)]
+
+    def test_controller_sizes_tasks(self):
+        self.manager._controller = hybrid.controller.adaptive_controller(1, 4, 10, 100, batch_size=25)
+        tasks = self.manager.computeTasks(self.uuids)
+        self.assertEqual([task["num_docs"] for task in tasks], [25] * 4)
+
+        # Rows that can't be sized fall back to the same split
+        rows = [hybrid.data_blob.create(uuid) for uuid in self.uuids]
+        for row in rows:
+            row.setMetaData("_dataBlobID", row.getDataBlobUUID())
+            row.setBinaryDataStub("image", "image/png")
+        tasks = self.manager.computeTasks(self.uuids, rows)
+        self.assertEqual([task["num_docs"] for task in tasks], [25] * 4)
+
+    def test_chunks_without_controller(self):
+        tasks = self.manager.computeTasks(self.uuids)
+        self.assertEqual(len(tasks), 2 * hybrid.utils.CHUNKS_PER_THREAD)
+
+
+if __name__ == "__main__":
+    unittest.main()
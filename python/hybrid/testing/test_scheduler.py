@@ -0,0 +1,132 @@
+"""
+Copyright 2017 Sandia Corporation.
+Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
+the U.S. Government retains certain rights in this software.
+"""
+import os
+import time
+import unittest
+
+import hybrid.mp_pool
+import hybrid.scheduler
+
+
+def sleep_task(task, seconds):
+    time.sleep(seconds)
+    return task["num_docs"]
+
+
+def timed_task(task, seconds):
+    start_time = time.time()
+    time.sleep(seconds)
+    return {"start_time": start_time, "end_time": time.time()}
+
+
+def failing_task(task):
+    raise ValueError("bad batch")
+
+
+_initialized = []
+
+
+def initialize(value):
+    _initialized.append(value)
+
+
+def pid_task(task):
+    return os.getpid(), list(_initialized)
+
+
+def make_task(index, num_docs=2):
+    uuids = ["doc%d_%d" % (index, i) for i in range(num_docs)]
+    return {"start_key": uuids[0], "end_key": uuids[-1], "num_docs": num_docs, "uuids": uuids}
+
+
+class scheduler_tests(unittest.TestCase):
+    def setUp(self):
+        self.mp = hybrid.mp_pool.mp_pool(processes=2)
+        self.completed = []
+        self.elapsed = []
+        self.scheduler = hybrid.scheduler.task_scheduler(self.mp, max_outstanding=2, poll_interval=0.01,
+                                                         on_complete=self.record)
+
+    def tearDown(self):
+        self.mp.finish_and_close()
+
+    def record(self, task, successful, elapsed):
+        self.completed.append((task["start_key"], successful))
+        self.elapsed.append(elapsed)
+
+    def test_submit_does_not_wait(self):
+        start = time.time()
+        self.scheduler.submit(make_task(0), sleep_task, make_task(0), 0.5)
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(self.scheduler.num_outstanding, 1)
+        self.assertEqual(self.scheduler.in_flight_uuids(), set(["doc0_0", "doc0_1"]))
+        self.scheduler.wait_all()
+        self.assertEqual(self.scheduler.num_outstanding, 0)
+        self.assertEqual(self.scheduler.in_flight_uuids(), set())
+        self.assertEqual(self.completed, [("doc0_0", True)])
+
+    def test_max_outstanding(self):
+        for i in range(5):
+            self.scheduler.submit(make_task(i), sleep_task, make_task(i), 0.05)
+            self.assertLessEqual(self.scheduler.num_outstanding, 2)
+        self.scheduler.wait_all()
+        self.assertEqual(self.scheduler.num_completed, 5)
+        self.assertEqual(len(self.completed), 5)
+
+    def test_failed_task(self):
+        self.scheduler.submit(make_task(0), failing_task, make_task(0))
+        self.scheduler.wait_all()
+        self.assertEqual(self.scheduler.num_failed, 1)
+        self.assertEqual(self.completed, [("doc0_0", False)])
+
+    def test_service_time(self):
+        # With two processes the third task queues behind the first two, its time in the queue isn't counted
+        self.scheduler.max_outstanding = 3
+        for i in range(3):
+            self.scheduler.submit(make_task(i), timed_task, make_task(i), 0.3)
+        self.scheduler.wait_all()
+        self.assertEqual(len(self.elapsed), 3)
+        for elapsed in self.elapsed:
+            self.assertGreaterEqual(elapsed, 0.3)
+            self.assertLess(elapsed, 0.5)
+
+    def test_wait_any_timeout(self):
+        self.scheduler.submit(make_task(0), sleep_task, make_task(0), 0.5)
+        self.assertEqual(self.scheduler.wait_any(timeout=0.05), [])
+        self.assertEqual(self.scheduler.num_outstanding, 1)
+        self.assertEqual(len(self.scheduler.wait_any()), 1)
+
+
+class pool_tests(unittest.TestCase):
+    def run_tasks(self, mp, num_tasks):
+        results = [mp.submit(pid_task, make_task(i)) for i in range(num_tasks)]
+        return [result.get(timeout=30) for result in results]
+
+    def test_initializer_runs_once_per_child(self):
+        mp = hybrid.mp_pool.mp_pool(processes=1, initializer=initialize, initargs=("workers",))
+        try:
+            results = self.run_tasks(mp, 3)
+        finally:
+            mp.finish_and_close()
+        self.assertEqual(len(set(pid for pid, initialized in results)), 1)
+        self.assertEqual([initialized for pid, initialized in results], [["workers"]] * 3)
+
+    def test_rss_recycling(self):
+        # Every child is over a one byte limit, so each runs one task and is replaced
+        mp = hybrid.mp_pool.mp_pool(processes=1, initializer=initialize, initargs=("workers",), max_rss_bytes=1)
+        try:
+            results = self.run_tasks(mp, 3)
+        finally:
+            mp.finish_and_close()
+        self.assertEqual(len(set(pid for pid, initialized in results)), 3)
+        self.assertEqual([initialized for pid, initialized in results], [["workers"]] * 3)
+
+    def test_current_rss(self):
+        self.assertGreater(hybrid.mp_pool.currentRSS(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
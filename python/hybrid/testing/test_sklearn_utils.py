@@ -0,0 +1,224 @@
+"""
+Copyright 2017 Sandia Corporation.
+Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
+the U.S. Government retains certain rights in this software.
+"""
+import math
+import multiprocessing.pool
+import pickle
+import unittest
+
+import hybrid.data_blob as data_blob
+import numpy as np
+from hybrid_sklearn import gaussiannb_worker
+from hybrid_sklearn import sklearn_utils
+from sklearn.naive_bayes import GaussianNB
+
+
+class estimator_cache_tests(unittest.TestCase):
+    def setUp(self):
+        sklearn_utils.clear_estimator_cache()
+        self._budget = sklearn_utils.ESTIMATOR_CACHE_BYTES
+
+    def tearDown(self):
+        sklearn_utils.ESTIMATOR_CACHE_BYTES = self._budget
+        sklearn_utils.clear_estimator_cache()
+
+    def getParameters(self, truth):
+        gnb = GaussianNB()
+        gnb.fit([[0.0], [1.0], [2.0], [3.0]], truth)
+        params = data_blob.create("gnb_params")
+        params.setBinaryData("gnb_model", "application/pickle", pickle.dumps(gnb))
+        return params
+
+    def test_same_pickle_is_reused(self):
+        params = self.getParameters([0, 0, 1, 1])
+        estimator = sklearn_utils.load_estimator(params, "gnb_model")
+        self.assertIs(estimator, sklearn_utils.load_estimator(params, "gnb_model"))
+
+        # A copy of the same bytes (e.g. after a reload from the database) hits the cache too
+        copied = data_blob.create("gnb_params")
+        copied.setBinaryData("gnb_model", "application/pickle", str(bytearray(params.getBinaryData("gnb_model"))))
+        self.assertIs(estimator, sklearn_utils.load_estimator(copied, "gnb_model"))
+
+    def test_new_pickle_is_loaded(self):
+        first = sklearn_utils.load_estimator(self.getParameters([0, 0, 1, 1]), "gnb_model")
+        second = sklearn_utils.load_estimator(self.getParameters([1, 1, 0, 0]), "gnb_model")
+        self.assertIsNot(first, second)
+        self.assertEqual(list(second.predict([[0.0]])), [1])
+
+    def test_memory_budget(self):
+        sklearn_utils.ESTIMATOR_CACHE_BYTES = 0
+        params = self.getParameters([0, 0, 1, 1])
+        first = sklearn_utils.load_estimator(params, "gnb_model")
+        sklearn_utils.load_estimator(self.getParameters([1, 1, 0, 0]), "gnb_model")
+        self.assertEqual(len(sklearn_utils._estimator_cache), 1)
+        self.assertIsNot(first, sklearn_utils.load_estimator(params, "gnb_model"))
+
+    def test_concurrent_loads(self):
+        # Evicting on every load from several threads at once keeps the cache and its byte count consistent
+        sklearn_utils.ESTIMATOR_CACHE_BYTES = 0
+        parameters = [self.getParameters([0, 0, 1, 1]), self.getParameters([1, 1, 0, 0])]
+        thread_pool = multiprocessing.pool.ThreadPool(4)
+        try:
+            estimators = thread_pool.map(lambda i: sklearn_utils.load_estimator(parameters[i % 2], "gnb_model"),
+                                         range(200))
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+        self.assertEqual([list(estimator.predict([[0.0]])) for estimator in estimators[:2]], [[0], [1]])
+        self.assertEqual(len(sklearn_utils._estimator_cache), 1)
+        self.assertEqual(sklearn_utils._estimator_cache_bytes,
+                         sum(entry["size"] for entry in sklearn_utils._estimator_cache.values()))
+
+
+class observation_array_tests(unittest.TestCase):
+    def getObservations(self):
+        observations = []
+        for i, (size, color, label) in enumerate([(1, "red", "spam"), ("2.5", "blue", "ham"), (None, "green", 1)]):
+            blob = data_blob.create(uuid=i)
+            if size is not None:
+                blob.setMetaData("size", size)
+            blob.setMetaData("color", color)
+            blob.setMetaData("label", label)
+            observations.append(blob)
+        return observations
+
+    def test_observations_to_array(self):
+        array = sklearn_utils.observations_to_array(self.getObservations(), ["size", "color:red", "color"],
+                                                    missing_value=float("nan"),
+                                                    categories={"color": ["red", "blue"]})
+        self.assertEqual(array.shape, (3, 3))
+        self.assertEqual(list(array[:2, 0]), [1.0, 2.5])
+        self.assertTrue(math.isnan(array[2, 0]))
+        self.assertEqual(list(array[:, 1]), [1.0, 0.0, 0.0])
+        self.assertEqual(list(array[:2, 2]), [0.0, 1.0])
+        self.assertTrue(math.isnan(array[2, 2]))
+
+    def test_field_defaults(self):
+        array = sklearn_utils.observations_to_array(self.getObservations(), ["size"], field_defaults={"size": 7})
+        self.assertEqual(list(array[:, 0]), [1.0, 2.5, 7.0])
+
+    def test_non_numeric_value(self):
+        self.assertRaises(ValueError, sklearn_utils.observations_to_array, self.getObservations(), ["color"])
+
+    def test_observations_to_labels(self):
+        labels = sklearn_utils.observations_to_labels(self.getObservations(), "label")
+        self.assertEqual(list(labels), ["spam", "ham", "1.0"])
+
+
+class partial_update_tests(unittest.TestCase):
+    def setUp(self):
+        self.observations = [[0.0], [0.5], [1.0], [3.0], [3.5], [4.0]]
+        self.truth = [0, 0, 0, 1, 1, 1]
+
+    def test_partial_update_matches_fit(self):
+        model = sklearn_utils.gaussian_nb_model("gnb_stream")
+        chunks = [(self.observations[:3], self.truth[:3]), ([], []), (self.observations[3:], self.truth[3:])]
+        self.assertTrue(model.partial_update(iter(chunks), np.array([0, 1])))
+
+        streamed = sklearn_utils.load_estimator(model.getParameters(), "gnb_model")
+        fitted = GaussianNB().fit(self.observations, self.truth)
+        test_points = [[-1.0], [1.9], [2.1], [5.0]]
+        self.assertEqual(list(streamed.predict(test_points)), list(fitted.predict(test_points)))
+        self.assertTrue(model.isUpdated())
+
+    def test_partial_update_no_observations(self):
+        model = sklearn_utils.gaussian_nb_model("gnb_stream")
+        self.assertFalse(model.partial_update(iter([]), np.array([0, 1])))
+        self.assertFalse(model.getParameters().hasBinaryData("gnb_model"))
+
+    def test_incremental_update_matches_fit(self):
+        model = sklearn_utils.gaussian_nb_model("gnb_incremental")
+        self.assertIsNone(model.incremental_update([(self.observations, self.truth)]))
+
+        model.partial_update([(self.observations[:4], self.truth[:4])], np.array([0, 1]))
+        self.assertTrue(model.incremental_update([(self.observations[4:], self.truth[4:])]))
+
+        incremental = sklearn_utils.load_estimator(model.getParameters(), "gnb_model")
+        fitted = GaussianNB().fit(self.observations, self.truth)
+        self.assertTrue(np.allclose(incremental.theta_, fitted.theta_))
+        self.assertEqual(list(incremental.class_count_), list(fitted.class_count_))
+
+    def test_incremental_update_new_class(self):
+        model = sklearn_utils.gaussian_nb_model("gnb_incremental")
+        model.partial_update([(self.observations, self.truth)], np.array([0, 1]))
+        pickled = model.getParameters().getBinaryData("gnb_model")
+        self.assertIsNone(model.incremental_update([([[9.0]], [2])]))
+        self.assertEqual(model.getParameters().getBinaryData("gnb_model"), pickled)
+
+
+class changes_manager(object):
+    """ Model observations manager over an in memory changes feed, its position is the number of writes """
+
+    def __init__(self):
+        self.writes = []
+        self.read = []
+
+    def write(self, observation):
+        self.writes.append(observation)
+
+    def isValid(self):
+        return True
+
+    def isUpdated(self):
+        return True
+
+    def latest(self, since=0):
+        latest = {}
+        for position, observation in enumerate(self.writes):
+            latest[observation.getDataBlobUUID()] = (position, observation)
+        return [observation for position, observation in sorted(latest.values()) if position >= since]
+
+    def getRows(self):
+        return self.latest()
+
+    def getRowPositions(self):
+        return {"writes": len(self.writes)}
+
+    def iterRows(self, page_size=1000, include_binary=False, since=None, skip_uuids=None):
+        since = (since or {}).get("writes", 0)
+        page = [observation for observation in self.latest(since)
+                if observation.getDataBlobUUID() not in (skip_uuids or set())]
+        self.read.extend(observation.getDataBlobUUID() for observation in page)
+        yield page
+
+
+class changes_nb_model(sklearn_utils.gaussian_nb_model):
+    manager = None
+
+    def getModelObservationsManager(self):
+        return changes_nb_model.manager
+
+
+class incremental_worker_tests(unittest.TestCase):
+    def observation(self, index):
+        observation = data_blob.create("o%d" % index)
+        observation.setMetaData("x", float(index))
+        observation.setMetaData("label", int(index >= 3))
+        return observation
+
+    def test_folds_each_observation_once(self):
+        manager = changes_nb_model.manager = changes_manager()
+        for index in range(6):
+            manager.write(self.observation(index))
+        worker = gaussiannb_worker.gaussiannb_worker(model=changes_nb_model("nb"), model_type=changes_nb_model,
+                                                     feature_vectors=["x"], truth_vectors=["label"],
+                                                     incremental_update=True)
+        self.assertTrue(worker.update_model())
+        self.assertEqual(worker.get_model().getFoldedObservations(), set("o%d" % index for index in range(6)))
+
+        # o1 is written again (e.g. restamped by another worker) and o6 lands, only o6 is new
+        manager.read = []
+        manager.write(self.observation(1))
+        manager.write(self.observation(6))
+        self.assertTrue(worker.update_model())
+        self.assertEqual(manager.read, ["o6"])
+
+        estimator = pickle.loads(worker.get_model().getParameters().getBinaryData("gnb_model"))
+        self.assertEqual(list(estimator.class_count_), [3, 4])
+        self.assertEqual(worker.get_model().getObservationPositions(), {"writes": 8})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Copyright 2017 Sandia Corporation.
+Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
+the U.S. Government retains certain rights in this software.
+"""
+import unittest
+
+import datetime
+import json
+import os
+import tempfile
+
+import hybrid.data_blob as data_blob
+import hybrid.utils as utils
+
+
+class field_accessor_tests(unittest.TestCase):
+    def setUp(self):
+        self.doc = {"name": "Jim", "age": 10, "color": "red",
+                    "entities": [{"name": "Sandia", "type": "org"}, {"name": "Albuquerque", "type": "loc"}],
+                    "scores": {"a": 1.5, "b": [3, 4]}}
+        self.defaults = {"height": 1.8, "missing": "none"}
+        self.fields = ["name", "age", "color:red", "color:blue", "entities:0:name", "entities:1:type:loc",
+                       "entities:5:name", "entities:x", "scores:b:1", "scores:c", "height", "missing:deeper",
+                       "name:Jim:extra"]
+
+    def test_matches_get_field_value(self):
+        for field_name in self.fields:
+            accessor = utils.field_accessor(field_name, self.defaults)
+            self.assertEqual(accessor(self.doc), utils.get_field_value(self.doc, field_name, self.defaults),
+                             field_name)
+
+    def test_invalid_list_index(self):
+        accessor = utils.field_accessor("entities:name:first")
+        self.assertRaises(ValueError, accessor, self.doc)
+        self.assertRaises(ValueError, utils.get_field_value, self.doc, "entities:name:first", {})
+
+    def test_compile_field_accessors(self):
+        accessors = utils.compile_field_accessors(self.fields, self.defaults)
+        self.assertEqual([accessor.field_name for accessor in accessors], self.fields)
+
+
+class high_water_mark_tests(unittest.TestCase):
+    def stamp(self, day):
+        return utils.getDateTimeDict(datetime.datetime(2017, 1, day))
+
+    def setUp(self):
+        self.observations = []
+        for i, stamp in enumerate([self.stamp(1), self.stamp(3), None, "yesterday", self.stamp(2)]):
+            blob = data_blob.create(uuid=i)
+            if stamp is not None:
+                blob.setMetaData("processed_datetime", stamp)
+            self.observations.append(blob)
+
+    def test_latest_date_time_dict(self):
+        stamps = [observation.getMetaDataSafe("processed_datetime") for observation in self.observations]
+        self.assertEqual(utils.getLatestDateTimeDict(stamps), self.stamp(3))
+        self.assertIsNone(utils.getLatestDateTimeDict([]))
+
+    def test_split_observations(self):
+        new_observations, unmarked_observations = utils.splitObservationsOnHighWaterMark(self.observations,
+                                                                                         self.stamp(1))
+        self.assertEqual([o.getDataBlobUUID() for o in new_observations], [1, 4])
+        self.assertEqual([o.getDataBlobUUID() for o in unmarked_observations], [2, 3])
+
+
+class json_definition_tests(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(handle, "w") as f:
+            json.dump([{"_alias": "watcher", "_jsontype": "hybrid.mp_pool.process_manager", "auto_restart": False}], f)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_rebuild_from_definition(self):
+        json_definitions, classes, aliases = utils.loadJSON(self.filename)
+        definition = utils.getJSONDefinition(aliases["watcher"])
+        self.assertEqual(definition["alias"], "watcher")
+
+        rebuilt = utils.instantiateJSONDefinition(definition)
+        self.assertIsNot(rebuilt, aliases["watcher"])
+        self.assertEqual(rebuilt._auto_restart, False)
+        self.assertIsNone(utils.getJSONDefinition(object()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -108,5 +108,92 @@ class ViewTests(unittest.TestCase):
                           new_view.rows()], documents)
 
 
+class MangoSelectorTests(unittest.TestCase):
+    def test_tag_lists(self):
+        selector = view.create_mango_selector(["text", "lang"], ["sentiment"])
+        self.assertEqual(selector, {"_dataBlobID": {"$exists": True},
+                                    "text": {"$exists": True},
+                                    "lang": {"$exists": True},
+                                    "sentiment": {"$exists": False}})
+
+    def test_empty_lists(self):
+        self.assertEqual(view.create_mango_selector(None, []), {"_dataBlobID": {"$exists": True}})
+
+
+class all_docs_row(object):
+    def __init__(self, doc_id):
+        self.id = doc_id
+
+
+class all_docs_couchdb(object):
+    """ Stands in for a couch database, answering _all_docs but (like CouchDB before 2.0) not _find """
+    TAG_INDEX_DDOC = "hybrid-tags"
+
+    def __init__(self, has_index):
+        self.has_index = has_index
+        self.loaded_views = []
+        self._raw_db = self
+
+    def getInfo(self):
+        return "all_docs_couchdb"
+
+    def ensureTagIndexes(self, input_tags, output_tags):
+        return ["tags"] if self.has_index else []
+
+    def tagIndexName(self, input_tags, output_tags):
+        return "tags"
+
+    def viewExists(self, view_uri):
+        return view_uri == "_all_docs"
+
+    def view(self, view_uri, **kwargs):
+        return None
+
+    def find(self, selector, **kwargs):
+        raise db.couchdb_interface.http.ResourceNotFound(("not_found", "missing"))
+
+    def loadView(self, view_uri, **kwargs):
+        self.loaded_views.append((view_uri, kwargs))
+        return self
+
+    def rows(self):
+        return [all_docs_row("_design/views"), all_docs_row("a"), all_docs_row("b")]
+
+    def loadDataBlobArray(self, uuids, **kwargs):
+        blobs = []
+        for uuid in uuids:
+            blob = data_blob.create(uuid)
+            blob.setMetaData("_id", uuid)
+            blobs.append(blob)
+        return blobs, []
+
+
+class AllDocsFallbackTests(unittest.TestCase):
+    def setUp(self):
+        self._get_connection = db.get_connection
+        self.query_info = {"db_type": "couchdb", "query_name": "", "query_find_list": ["text"],
+                           "query_except_list": ["sentiment"]}
+
+    def tearDown(self):
+        db.get_connection = self._get_connection
+
+    def create_view(self, database):
+        db.get_connection = lambda *args, **kwargs: database
+        return view.create_view_from_query_info(self.query_info, limit=10)
+
+    def test_no_index(self):
+        database = all_docs_couchdb(has_index=False)
+        rows = self.create_view(database).rows()
+        self.assertEqual([row.getDataBlobUUID() for row in rows], ["a", "b"])
+        self.assertEqual(database.loaded_views, [("_all_docs", {"limit": 10})])
+
+    def test_find_not_found(self):
+        database = all_docs_couchdb(has_index=True)
+        couch_view = self.create_view(database)
+        self.assertEqual([len(page) for page in couch_view.iterpages()], [2])
+        self.assertEqual(couch_view.rows()[0].getDataBlobUUID(), "a")
+        self.assertEqual(database.loaded_views[-1], ("_all_docs", {"limit": 10}))
+
+
 if __name__ == '__main__':
     unittest.main()
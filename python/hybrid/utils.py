@@ -6,6 +6,7 @@ the U.S. Government retains certain rights in this software.
 """
 import copy
 import datetime
+import heapq
 import importlib
 import json
 import math
@@ -197,43 +198,45 @@ def instantiateClassFromJSON(json_data):
     return obj
 
 
-def instantiateJSONAliases(json_dict, alias_dict):
+def instantiateJSONAliases(json_dict, alias_dict, raw_alias_dict=None):
     for k in json_dict.iterkeys():
         v = json_dict[k]
-        json_dict[k] = instantiateAlias(v, alias_dict)
+        json_dict[k] = instantiateAlias(v, alias_dict, raw_alias_dict)
         if isinstance(v, basestring):
             if v.startswith("_alias_"):
                 alias = v[7:]
                 json_data_instance = alias_dict[alias]
-                instantiateJSONAliases(json_data_instance, alias_dict)
+                instantiateJSONAliases(json_data_instance, alias_dict, raw_alias_dict)
                 instantiation = instantiateClassFromJSON(json_data_instance)
+                setJSONDefinition(instantiation, alias, raw_alias_dict)
                 json_dict[k] = instantiation
         elif isinstance(v, dict):
-            instantiateJSONAliases(v, alias_dict)
+            instantiateJSONAliases(v, alias_dict, raw_alias_dict)
         elif isinstance(v, list):
             for list_element in v:
                 if isinstance(list_element, dict):
-                    instantiateJSONAliases(list_element, alias_dict)
+                    instantiateJSONAliases(list_element, alias_dict, raw_alias_dict)
 
 
-def instantiateAlias(value, alias_dict):
+def instantiateAlias(value, alias_dict, raw_alias_dict=None):
     if isinstance(value, basestring):
         if value.startswith("_alias_"):
             alias = value[7:]
             json_data_instance = alias_dict[alias]
-            instantiateJSONAliases(json_data_instance, alias_dict)
+            instantiateJSONAliases(json_data_instance, alias_dict, raw_alias_dict)
             instantiation = instantiateClassFromJSON(json_data_instance)
+            setJSONDefinition(instantiation, alias, raw_alias_dict)
             return instantiation
         return value
     elif isinstance(value, dict):
         for k in value.iterkeys():
             v = value[k]
-            value[k] = instantiateAlias(v, alias_dict)
+            value[k] = instantiateAlias(v, alias_dict, raw_alias_dict)
         return value
     elif isinstance(value, list):
         for list_index in range(0, len(value)):
             list_element = value[list_index]
-            value[list_index] = instantiateAlias(list_element, alias_dict)
+            value[list_index] = instantiateAlias(list_element, alias_dict, raw_alias_dict)
         #             if isinstance(list_element,dict):
         #                 return instantiateJSONAliases(list_element,alias_dict)
 
@@ -241,6 +244,28 @@ def instantiateAlias(value, alias_dict):
     return value
 
 
+def setJSONDefinition(obj, alias, raw_alias_dict):
+    """ Remember the definition (alias and the untouched definitions of the file) obj was built from, so
+        it can be built again elsewhere, eg once in every pool process """
+    if raw_alias_dict is None or obj is None or isinstance(obj, (dict, list, basestring)):
+        return
+    try:
+        obj._json_definition = {"alias": alias, "definitions": raw_alias_dict}
+    except AttributeError:
+        pass
+
+
+def getJSONDefinition(obj):
+    """ The definition obj was instantiated from by loadJSON, None if it wasn't """
+    return getattr(obj, "_json_definition", None)
+
+
+def instantiateJSONDefinition(json_definition):
+    """ Build a fresh instance of the object a definition from getJSONDefinition describes """
+    definitions = copy.deepcopy(json_definition["definitions"])
+    return instantiateAlias("_alias_" + json_definition["alias"], definitions)
+
+
 def loadJSON(filename):
     json_data_array = []
     json_data_alias_dict = {}
@@ -256,8 +281,11 @@ def loadJSON(filename):
                 return None, None
             json_data_alias_dict[alias] = json_data
 
+    # Instantiating replaces the aliases in place, keep the definitions as they were in the file
+    raw_alias_dict = copy.deepcopy(json_data_alias_dict)
+
     for json_data in json_data_array:
-        instantiateAlias(json_data, json_data_alias_dict)
+        instantiateAlias(json_data, json_data_alias_dict, raw_alias_dict)
 
     classes = []
 
@@ -268,6 +296,7 @@ def loadJSON(filename):
         print
         print "instantiating", json_data
         instantiation = instantiateClassFromJSON(json_data)
+        setJSONDefinition(instantiation, json_data["_alias"], raw_alias_dict)
         classes.append(instantiation)
         alias_class_dict[
             json_data["_alias"]] = instantiation  # duplicate processing for now until we find out what we want
@@ -380,6 +409,69 @@ def get_field_value(data_dict, field_name, field_defaults):
     return val
 
 
+class field_accessor(object):
+    """
+    A field path (e.g. "entities:0:name" or "color:red") parsed once, so it can be
+    applied to many rows without re-splitting it. Calling the accessor on a meta
+    data dict returns exactly what get_field_value would for the same path.
+    """
+
+    def __init__(self, field_name, field_defaults=None):
+        self._field_name = field_name
+        self._field_defaults = field_defaults or {}
+
+        # One step per path segment: (key, integer index or None, remainder of the path or None)
+        segments = field_name.split(':')
+        self._steps = []
+        for i, segment in enumerate(segments):
+            try:
+                index = int(segment)
+            except ValueError:
+                index = None
+            remainder = None
+            if i < len(segments) - 1:
+                remainder = ':'.join(segments[i + 1:])
+            self._steps.append((segment, index, remainder))
+
+    @property
+    def field_name(self):
+        return self._field_name
+
+    def __call__(self, data_dict):
+        node = data_dict
+        for segment, index, remainder in self._steps:
+            if isinstance(node, list):
+                if index is None:
+                    if remainder is None:
+                        return None
+                    raise ValueError("invalid list index %s in field %s" % (segment, self._field_name))
+                key = index
+                valid = len(node) > index
+            elif isinstance(node, dict):
+                key = segment
+                valid = segment in node
+            else:
+                valid = False
+
+            if not valid:
+                return self._field_defaults.get(segment)
+
+            node = node[key]
+            if remainder is not None and not (isinstance(node, dict) or isinstance(node, list)):
+                # We have a value here, check if it equals the required value
+                if encoding.convertToUnicode(node) == remainder:
+                    return 1
+                return 0
+        return node
+
+
+def compile_field_accessors(field_names, field_defaults=None):
+    """
+    Parse a list of field paths once, returning one field_accessor per path
+    """
+    return [field_accessor(field_name, field_defaults) for field_name in field_names]
+
+
 def is_number(s):
     try:
         x = float(s)
@@ -414,6 +506,9 @@ def strip_list_elements(list_to_strip):
 def create_observation_data(input_rows, field_names, field_defaults={}):
     observations = []
 
+    # Parse the field paths once rather than once per row
+    accessors = compile_field_accessors(field_names, field_defaults)
+
     for row in input_rows:
         observation = {}
         obs_meta = row.getMetaDataDict()  # The database document representing a row
@@ -421,9 +516,8 @@ def create_observation_data(input_rows, field_names, field_defaults={}):
             obs_uuid = obs_meta.get("_dataBlobID")  #
             observation["uuid"] = obs_uuid
 
-        for field_name in field_names:
-            val = get_field_value(obs_meta, field_name, field_defaults)
-            observation[field_name] = val
+        for accessor in accessors:
+            observation[accessor.field_name] = accessor(obs_meta)
 
         observations.append(observation)
     return observations
@@ -436,9 +530,8 @@ def create_observation_datum(row, field_names, field_defaults={}):
         obs_uuid = obs_meta.get("_dataBlobID")  #
         observation["uuid"] = obs_uuid
 
-    for field_name in field_names:
-        val = get_field_value(obs_meta, field_name, field_defaults)
-        observation[field_name] = val
+    for accessor in compile_field_accessors(field_names, field_defaults):
+        observation[accessor.field_name] = accessor(obs_meta)
 
     return observation
 
@@ -780,6 +873,41 @@ def compareDateTimeDict(datetime_dict1, datetime_dict2):
     return 0
 
 
+def getLatestDateTimeDict(datetime_dicts):
+    """ Return the latest of a sequence of datetime dicts, None if there are none """
+    latest = None
+    for datetime_dict in datetime_dicts:
+        if not isinstance(datetime_dict, dict):
+            continue
+        if latest is None or compareDateTimeDict(datetime_dict, latest) == 1:
+            latest = datetime_dict
+    return latest
+
+
+def splitObservationsOnHighWaterMark(observations, high_water_mark, field="processed_datetime"):
+    """ Split observations on a datetime high water mark
+        Input:
+            observations:    data blobs to split
+            high_water_mark: datetime dict, observations stamped at or before it have already been seen
+            field:           meta data field holding the datetime dict stamp of each observation
+        Returns (new_observations, unmarked_observations), the observations stamped after the mark
+        and the ones with no usable stamp, which can't be placed relative to the mark
+    """
+    new_observations = []
+    unmarked_observations = []
+    for observation in observations:
+        stamp = observation.getMetaDataSafe(field)
+        if not isinstance(stamp, dict):
+            unmarked_observations.append(observation)
+            continue
+        comparison = compareDateTimeDict(stamp, high_water_mark)
+        if comparison == -2:
+            unmarked_observations.append(observation)
+        elif comparison == 1:
+            new_observations.append(observation)
+    return new_observations, unmarked_observations
+
+
 def viewToVTKTable(view, arrays, **kwargs):
     """ Create a vtk table object from a database view object
         Input:
@@ -1305,43 +1433,94 @@ def is_valid_ipv6_address(address):
     return True
 
 
-def computeTaskProcessingRanges(rows, threads):
+# Size estimate units (bytes or characters) a document costs just for being processed at all
+DOCUMENT_OVERHEAD = 1024
+
+# Tasks per thread when documents can't be weighed, so the pool processes that finish early pick up the rest
+CHUNKS_PER_THREAD = 4
+
+
+def computeTaskProcessingRanges(rows, threads, cost_model=None, chunks_per_thread=CHUNKS_PER_THREAD):
+    """ Split data blob rows into one task per thread, balanced on the blobs' size estimates. cost_model
+        (see controller.task_cost_model) turns a size estimate into a weight, without one every document
+        weighs DOCUMENT_OVERHEAD plus its size. Falls back to computeTaskProcessingChunks (with
+        chunks_per_thread) if any row can't be sized. """
+    uuids = [row.getMetaData("_dataBlobID") for row in rows]
+    sizes = [row.getSizeEstimate() for row in rows]
+    if None in sizes:
+        return computeTaskProcessingChunks(uuids, threads, chunks_per_thread)
+
+    if cost_model is None:
+        weights = [DOCUMENT_OVERHEAD + size for size in sizes]
+    else:
+        weights = [cost_model.weight(size) for size in sizes]
+    return computeTaskProcessingRangesByCost(uuids, weights, threads, sizes)
+
+
+def computeTaskProcessingRangesByCost(uuids, weights, threads, sizes=None):
+    """ Split a list of document uuids into (at most) one task per thread with about the same total weight:
+        the heaviest documents go first, each to the task with the least weight so far. Each task records
+        its "cost" (total weight) and, given the documents' sizes, its "size"; the heaviest task comes first
+        so it starts first. """
+    if len(uuids) == 0:
+        return []
+
+    threads = max(1, min(threads, len(uuids)))
+    heap = [(0, i) for i in range(threads)]
+    members = [[] for i in range(threads)]
+    for index in sorted(range(len(uuids)), key=lambda i: weights[i], reverse=True):
+        cost, task_index = heapq.heappop(heap)
+        members[task_index].append(index)
+        heapq.heappush(heap, (cost + weights[index], task_index))
+
+    tasks = []
+    for indexes in members:
+        # Keep the view's order inside a task
+        indexes.sort()
+        task_uuids = [uuids[i] for i in indexes]
+        task = {"start_key": task_uuids[0], "end_key": task_uuids[-1], "num_docs": len(task_uuids),
+                "uuids": task_uuids, "cost": sum(weights[i] for i in indexes)}
+        if sizes is not None:
+            task["size"] = sum(sizes[i] for i in indexes)
+        tasks.append(task)
+
+    tasks.sort(key=lambda task: task["cost"], reverse=True)
+    return tasks
+
+
+def computeTaskProcessingChunks(uuids, threads, chunks_per_thread=CHUNKS_PER_THREAD):
+    """ Split documents that can't be weighed into chunks_per_thread small tasks per thread. The pool hands
+        the chunks out as processes free up, so a process stuck on heavy documents takes fewer of them. """
+    if len(uuids) == 0:
+        return []
+    return computeTaskProcessingRangesForUUIDs(uuids, max(1, min(len(uuids), threads * chunks_per_thread)))
+
+
+def computeTaskProcessingRangesForUUIDs(uuids, threads):
+    """ Split a list of document uuids into one task per thread """
     tasks = []
 
-    num_documents = len(rows)
+    num_documents = len(uuids)
 
     # Small numbers of documents can result in key 'collisions'
     # so just have one process do them all
     if num_documents < threads:
-        start_key = rows[0].getMetaData("_dataBlobID")
-        end_key = rows[num_documents - 1].getMetaData("_dataBlobID")
-        num_docs = num_documents
-        uuids = []
-        for i in range(0, num_documents):
-            uuids.append(rows[i].getMetaData("_dataBlobID"))
-        tasks.append({"start_key": start_key, "end_key": end_key, "num_docs": num_docs, "uuids": uuids})
+        tasks.append({"start_key": uuids[0], "end_key": uuids[num_documents - 1], "num_docs": num_documents,
+                      "uuids": list(uuids)})
         return tasks
 
     rows_per_worker = num_documents / threads
     for i in range(threads - 1):
-        start_key = rows[rows_per_worker * i].getMetaData("_dataBlobID")
-        end_key = rows[rows_per_worker * (i + 1) - 1].getMetaData("_dataBlobID")
-        uuids = []
-        for i in range(rows_per_worker * i, rows_per_worker * (i + 1)):
-            uuids.append(rows[i].getMetaData("_dataBlobID"))
+        task_uuids = list(uuids[rows_per_worker * i:rows_per_worker * (i + 1)])
 
         # create new task
-        tasks.append({"start_key": start_key, "end_key": end_key, "num_docs": rows_per_worker, "uuids": uuids})
+        tasks.append({"start_key": task_uuids[0], "end_key": task_uuids[-1], "num_docs": rows_per_worker,
+                      "uuids": task_uuids})
 
     # Last segment has whatever remains
-    start_key = rows[rows_per_worker * (threads - 1)].getMetaData("_dataBlobID")
-    end_key = rows[num_documents - 1].getMetaData("_dataBlobID")
-    num_docs = num_documents - rows_per_worker * (threads - 1)
-    uuids = []
-    for i in range(rows_per_worker * (threads - 1), num_documents):
-        uuids.append(rows[i].getMetaData("_dataBlobID"))
-
-    tasks.append({"start_key": start_key, "end_key": end_key, "num_docs": num_docs, "uuids": uuids})
+    task_uuids = list(uuids[rows_per_worker * (threads - 1):])
+    tasks.append({"start_key": task_uuids[0], "end_key": task_uuids[-1], "num_docs": len(task_uuids),
+                  "uuids": task_uuids})
 
     return tasks
 
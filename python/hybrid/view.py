@@ -15,10 +15,15 @@ the U.S. Government retains certain rights in this software.
 """
 import collections
 import copy
+import logging
+
+import pymongo
 
 import db
 import hybrid
 
+logger = logging.getLogger(__name__)
+
 
 def create_view(database, query_name, input_tags, output_tags, **kwargs):
     query_info = {}
@@ -38,7 +43,8 @@ def create_view(database, query_name, input_tags, output_tags, **kwargs):
             query = dict({tag: {"$exists": True}}, **query)
         for tag in output_tags:
             query = dict({tag: {"$exists": False}}, **query)
-        mview = mongo_view(query_info, db=database, query_name=query_name, query=query)
+        mview = mongo_view(query_info, db=database, query_name=query_name, query=query, limit=kwargs.get("limit"),
+                           sort=kwargs.get("sort"), batch_size=kwargs.get("batch_size"))
         return mview
     elif isinstance(database, db.couchdb):
         return couch_view(query_info, **kwargs)
@@ -56,12 +62,23 @@ def create_view_from_query_info(query_info, **kwargs):
     if (db_type == "couchdb"):
         return couch_view(query_info, **kwargs)
     else:
-        database = db.init(db_type, host=db_host, database=db_name, push_views=False, create=False)
+        database = db.get_connection(db_type, host=db_host, database=db_name, push_views=False, create=False)
         view = create_view(database, query_name, query_find_list, query_except_list, **kwargs)
 
         return view
 
 
+def create_mango_selector(find_list, except_list):
+    """ Compile the tag lists into a Mango selector: a data blob with every find tag present and
+        every except tag absent """
+    selector = {"_dataBlobID": {"$exists": True}}
+    for tag in find_list or []:
+        selector[tag] = {"$exists": True}
+    for tag in except_list or []:
+        selector[tag] = {"$exists": False}
+    return selector
+
+
 def make_hash(o):
     if isinstance(o, set) or isinstance(o, tuple) or isinstance(o, list):
         return tuple([make_hash(e) for e in o])
@@ -90,6 +107,41 @@ class couch_view():
             query_name = query_info.get("query_name")
         else:
             query_name = ""
+        if query_name is None:
+            query_name = ""
+
+        self._db_type = query_info.get("db_type")
+        self._db_host = query_info.get("db_host")
+        self._db_name = query_info.get("db_name")
+        self._db_keys = query_info.get("query_keys", None)
+
+        # Number of documents pulled per bulk fetch when loading the rows
+        self._fetch_page_size = kwargs.pop("fetch_page_size", query_info.get("fetch_page_size", 250))
+
+        database = db.get_connection(self._db_type, host=self._db_host, database=self._db_name, push_views=False,
+                                     create=False)
+
+        # Without a named view (or keys) select on the tag lists with _find, backed by a Mango index,
+        # rather than walking _all_docs. Servers without Mango (CouchDB before 2.0) can't create the
+        # index, they are left on _all_docs.
+        query_find_list = query_info.get("query_find_list", [])
+        query_except_list = query_info.get("query_except_list", [])
+        self._find_list = query_find_list or []
+        self._except_list = query_except_list or []
+        self._selector = None
+        if query_name == "" and not self._db_keys and (query_find_list or query_except_list) and \
+                database.ensureTagIndexes(query_find_list, query_except_list):
+            self._selector = create_mango_selector(query_find_list, query_except_list)
+            self._use_index = [database.TAG_INDEX_DDOC, database.tagIndexName(query_find_list, query_except_list)]
+            self._limit = kwargs.pop("limit", None)
+            self._view_uri = "_find"
+            self._view = None
+            self._name = "_find " + str(self._selector)
+            self._dbinfo = database.getInfo()
+            self._kwargs = kwargs
+            self._row_dict = {}
+            self._num_rows = 0
+            return
 
         if (query_name == ""):
             view_uri = "_all_docs"
@@ -100,15 +152,8 @@ class couch_view():
 
         self._view_uri = view_uri
 
-        self._db_type = query_info.get("db_type")
-        self._db_host = query_info.get("db_host")
-        self._db_name = query_info.get("db_name")
-        self._db_keys = query_info.get("query_keys", None)
-
         # TODO handle other keyword args like doclimits
 
-        database = db.init(self._db_type, host=self._db_host, database=self._db_name, push_views=False, create=False)
-
         if not database.viewExists(self._view_uri):
             # logger.error( "Could not open view", name, "in couch database", db.getInfo())
             raise RuntimeError("Could not open view", self._view_uri, "in couch database", database.getInfo())
@@ -132,6 +177,107 @@ class couch_view():
         for document in cursor:
             yield document
 
+    def iterfind(self, database, page_size=None, fields=None):
+        """ Page through the _find results with bookmarks, yielding a list of raw documents at a time. """
+        if page_size is None:
+            page_size = self._fetch_page_size
+
+        kwargs = {}
+        if self._use_index:
+            kwargs["use_index"] = self._use_index
+        if fields:
+            kwargs["fields"] = fields
+
+        remaining = self._limit
+        bookmark = None
+        while True:
+            limit = page_size
+            if remaining is not None:
+                limit = min(page_size, remaining)
+            if bookmark:
+                kwargs["bookmark"] = bookmark
+            result = database.find(self._selector, limit=limit, **kwargs)
+
+            docs = result.get("docs", [])
+            if docs:
+                yield docs
+            if remaining is not None:
+                remaining -= len(docs)
+                if remaining <= 0:
+                    return
+            bookmark = result.get("bookmark")
+            if len(docs) < limit or not bookmark:
+                return
+
+    def use_all_docs(self, database):
+        """ Walk _all_docs from now on, for when the server turns out not to answer _find """
+        logger.warning("_find not available in couch database %s, walking _all_docs instead" % (database.getInfo(),))
+        self._selector = None
+        self._view_uri = "_all_docs"
+        self._name = ""
+        if self._limit is not None:
+            self._kwargs["limit"] = self._limit
+        self._view = database._raw_db.view(self._view_uri, **self._kwargs)
+
+    def matches(self, doc):
+        """ True if a raw document from the changes feed belongs to the view's tag selection """
+        if doc.get("_dataBlobID") is None:
+            return False
+        for tag in self._find_list:
+            if tag not in doc:
+                return False
+        for tag in self._except_list:
+            if tag in doc:
+                return False
+        return True
+
+    def position(self):
+        """ Update sequence of the database, pass it to iterpages as since to read only the documents
+            changed after it. None if the view's documents can't be picked out of the changes feed
+            (named views and key lookups). """
+        if self._db_keys or (self._selector is None and self._view_uri != "_all_docs"):
+            return None
+        database = db.get_connection(self._db_type, host=self._db_host, database=self._db_name, push_views=False,
+                                     create=False)
+        return database._raw_db.info().get("update_seq", 0)
+
+    def iterchanges(self, database, since, page_size, include_binary=False):
+        """ Page through the documents of the view changed after the update sequence since """
+        while True:
+            result = database._raw_db.changes(since=since, include_docs="true", limit=page_size)
+            changes = result.get("results", [])
+            docs = []
+            for change in changes:
+                doc_id = change.get("id")
+                if change.get("deleted") or doc_id is None or doc_id.startswith("_"):
+                    continue
+                doc = change.get("doc")
+                if doc is not None and self.matches(doc):
+                    docs.append(doc)
+            if docs:
+                yield self.create_blobs(database, docs, include_binary=include_binary)
+            if len(changes) < page_size:
+                return
+            since = result.get("last_seq")
+
+    def create_blobs(self, database, docs, include_binary=False):
+        """ Turn _find documents into data blobs. _find only returns attachment stubs, so unless the
+            database loads attachments lazily, documents with attachments are pulled again (in bulk)
+            when the binaries are wanted. """
+        blobs = {}
+        refetch_uuids = []
+        for doc in docs:
+            if include_binary and doc.get("_attachments") and not database.lazy_binary:
+                refetch_uuids.append(doc["_id"])
+            else:
+                blobs[doc["_id"]] = database.create_blob_from_native_doc(doc, include_binary=include_binary)
+        if refetch_uuids:
+            observations, missing_uuids = database.loadDataBlobArray(refetch_uuids, include_binary=True,
+                                                                     page_size=self._fetch_page_size)
+            for observation in observations:
+                blobs[observation.getMetaData("_id")] = observation
+        return [blobs[doc["_id"]] for doc in docs if doc["_id"] in blobs]
+
     def rows(self):
         """ Get the results of the view as a python list. """
         db_name = self._db_name
@@ -139,7 +285,18 @@ class couch_view():
         db_type = self._db_type
         db_keys = self._db_keys
 
-        database = db.init(db_type, host=db_host, database=db_name, push_views=False, create=False)
+        database = db.get_connection(db_type, host=db_host, database=db_name, push_views=False, create=False)
+
+        if self._selector is not None:
+            try:
+                observations = []
+                for docs in self.iterfind(database):
+                    observations.extend(self.create_blobs(database, docs, include_binary=True))
+                self._row_dict = dict((observation.getMetaData("_id"), observation) for observation in observations)
+                self._num_rows = len(self._row_dict)
+                return observations
+            except db.couchdb_interface.http.ResourceNotFound:
+                self.use_all_docs(database)
 
         if db_keys:
             couch_view = database.loadView(self._view_uri, keys=db_keys, **self._kwargs)  # kwargs
@@ -147,15 +304,18 @@ class couch_view():
             couch_view = database.loadView(self._view_uri, **self._kwargs)  # kwargs
 
         rows = couch_view.rows()
-        observation_dict = {}
-        observations = []
+        uuids = []
         for row in rows:
-            if row.id.startswith("_"):
+            if row.id is None or row.id.startswith("_"):
                 continue
-            observation = database.loadDataBlob(row.id, include_binary=True)
-            if observation is None: continue
-            observations.append(observation)
-            observation_dict[row.id] = observation
+            uuids.append(row.id)
+
+        # Pull the documents a page at a time instead of one request per row
+        observations, missing_uuids = database.loadDataBlobArray(uuids, include_binary=True,
+                                                                 page_size=self._fetch_page_size)
+        observation_dict = {}
+        for observation in observations:
+            observation_dict[observation.getMetaData("_id")] = observation
 
         #        self._rows = observations
         self._row_dict = observation_dict
@@ -165,6 +325,69 @@ class couch_view():
         #         self._num_rows = len(self._rows)
         return observations
 
+    def iterpages(self, page_size=None, include_binary=False, since=None, skip_uuids=None):
+        """ Iterate over the results of the view a list of data blobs at a time, paging
+            through the view so only one page of documents is held in memory.
+                since:      update sequence from position(), only documents changed after it are read
+                skip_uuids: set of document ids to leave out, they are dropped before the documents
+                            are fetched """
+        if page_size is None:
+            page_size = self._fetch_page_size
+
+        database = db.get_connection(self._db_type, host=self._db_host, database=self._db_name, push_views=False,
+                                     create=False)
+
+        if since is not None:
+            for observations in self.iterchanges(database, since, page_size, include_binary=include_binary):
+                if skip_uuids:
+                    observations = [observation for observation in observations
+                                    if observation.getMetaData("_id") not in skip_uuids]
+                if observations:
+                    yield observations
+            return
+
+        if self._selector is not None:
+            pages = self.iterfind(database, page_size, fields=["_id"] if skip_uuids else None)
+            try:
+                docs = next(pages, None)
+            except db.couchdb_interface.http.ResourceNotFound:
+                self.use_all_docs(database)
+            else:
+                while docs is not None:
+                    if not skip_uuids:
+                        yield self.create_blobs(database, docs, include_binary=include_binary)
+                    else:
+                        # Only the ids were listed, fetch just the documents that aren't skipped
+                        uuids = [doc["_id"] for doc in docs if doc["_id"] not in skip_uuids]
+                        if uuids:
+                            observations, missing_uuids = database.loadDataBlobArray(
+                                uuids, include_binary=include_binary, page_size=page_size)
+                            yield observations
+                    docs = next(pages, None)
+                return
+
+        if self._db_keys:
+            rows = database.loadView(self._view_uri, keys=self._db_keys, **self._kwargs).rows()
+        else:
+            rows = database.loadView(self._view_uri, paging=True, page_size=page_size, **self._kwargs).rows()
+
+        uuids = []
+        for row in rows:
+            if row.id is None or row.id.startswith("_"):
+                continue
+            if skip_uuids and row.id in skip_uuids:
+                continue
+            uuids.append(row.id)
+            if len(uuids) >= page_size:
+                observations, missing_uuids = database.loadDataBlobArray(uuids, include_binary=include_binary,
+                                                                         page_size=page_size)
+                yield observations
+                uuids = []
+        if uuids:
+            observations, missing_uuids = database.loadDataBlobArray(uuids, include_binary=include_binary,
+                                                                     page_size=page_size)
+            yield observations
+
     def num_rows(self):
         """ Get the number of rows contained in the results of the view. """
 
@@ -181,7 +404,13 @@ class couch_view():
         db_type = self._db_type
         db_keys = self._db_keys
 
-        database = db.init(db_type, host=db_host, database=db_name, push_views=False, create=False)
+        database = db.get_connection(db_type, host=db_host, database=db_name, push_views=False, create=False)
+
+        if self._selector is not None:
+            try:
+                return sum(len(docs) for docs in self.iterfind(database, fields=["_id"]))
+            except db.couchdb_interface.http.ResourceNotFound:
+                self.use_all_docs(database)
 
         if db_keys:
             couch_view = database.loadView(self._view_uri, keys=db_keys, **self._kwargs)  # kwargs
@@ -225,6 +454,9 @@ class couch_view():
 class mongo_view():
     """ Interface for a MongoDB view object."""
 
+    # Documents pulled from the server per cursor round trip
+    DEFAULT_BATCH_SIZE = 1000
+
     def __init__(self, query_info, **kwargs):
         """ Create instance of MongoDB view
             Input:
@@ -237,13 +469,27 @@ class mongo_view():
         self._db_name = query_info.get("db_name")
         self._db_collection_name = query_info.get("collection_name", "test")
 
-        database = db.init(self._db_type, host=self._db_host, database=self._db_name, push_views=False, create=False)
+        database = db.get_connection(self._db_type, host=self._db_host, database=self._db_name, push_views=False,
+                                     create=False)
 
+        # Blobs read straight from the cursor only track their changes against the database handle when
+        # it stores to the collection the view reads
+        self._database = None
+        if database._collection == self._db_collection_name:
+            self._database = database
         self._view = database._raw_db[self._db_collection_name]
         self._name = query_name
         self._dbinfo = database.getInfo()
         self._kwargs = kwargs
         self._query = kwargs.get("query")
+        # Pushed to the server so only the documents that will be used come back, oldest first by default
+        self._limit = kwargs.get("limit")
+        self._sort = kwargs.get("sort")
+        if self._sort is None:
+            self._sort = [("_id", pymongo.ASCENDING)]
+        self._batch_size = kwargs.get("batch_size")
+        if self._batch_size is None:
+            self._batch_size = self.DEFAULT_BATCH_SIZE
         #        self._rows = []
         self._row_dict = {}
         self._num_rows = 0
@@ -253,30 +499,39 @@ class mongo_view():
         output_string += self._name + ": " + str(self._kwargs)
         return output_string
 
+    def cursor(self, batch_size=None):
+        """ Open a cursor over the query with the view's sort, limit and batch size. """
+        if batch_size is None:
+            batch_size = self._batch_size
+        cursor = self._view.find(self._query).sort(self._sort).batch_size(batch_size)
+        if self._limit:
+            cursor = cursor.limit(self._limit)
+        return cursor
+
     def iterdocs(self):
         """ Iterate over the documents in the database collection. """
-        cursor = self._view.find(self._query, **self._kwargs)
-        for document in cursor:
+        for document in self.cursor():
             yield document
 
+    def iterblobs(self, batch_size=None):
+        """ Iterate over the results of the view as data blobs, built straight from the
+            cursor's documents rather than loading each one again. """
+        for document in self.cursor(batch_size):
+            uuid = document.get("_dataBlobID")
+            if uuid is None or str(uuid).startswith("_"):
+                continue
+            blob = hybrid.data_blob.dict2blob(document)
+            if self._database is not None:
+                self._database.markDataBlobStored(blob)
+            yield blob
+
     def rows(self):
         """ Get the results of the view as a python list. """
-        mongo_rows = [record for record in
-                      self._view.find(self._query)]
-
-        db_type = self._db_type
-        db_host = self._db_host
-        db_name = self._db_name
-        database = db.init(db_type, host=db_host, database=db_name, push_views=False, create=False)
-
         observation_dict = {}
         observations = []
-        for row in mongo_rows:
-            uuid = str(row.get("_dataBlobID"))
-            if uuid.startswith("_"): continue
-            observation = database.loadDataBlob(row.get("_dataBlobID"), include_binary=True)
+        for observation in self.iterblobs():
             observations.append(observation)
-            observation_dict[row.get("_dataBlobID")] = observation
+            observation_dict[observation.getDataBlobUUID()] = observation
 
         #        self._rows = observations
         self._row_dict = observation_dict
@@ -284,6 +539,56 @@ class mongo_view():
 
         return observations
 
+    def position(self):
+        """ Mongo views have no change sequence to read from (see couch_view.position) """
+        return None
+
+    def iterpages(self, page_size=1000, include_binary=False, since=None, skip_uuids=None):
+        """ Iterate over the results of the view a list of data blobs at a time, so only
+            one page of documents is held in memory. since is ignored, position() is always None.
+            With skip_uuids only the ids are listed and just the documents that aren't skipped
+            are fetched. """
+        if skip_uuids:
+            for page in self.iterpagesskipping(page_size, skip_uuids):
+                yield page
+            return
+
+        observations = []
+        for observation in self.iterblobs(page_size):
+            observations.append(observation)
+            if len(observations) >= page_size:
+                yield observations
+                observations = []
+        if observations:
+            yield observations
+
+    def iterpagesskipping(self, page_size, skip_uuids):
+        cursor = self._view.find(self._query, {"_dataBlobID": 1}).sort(self._sort).batch_size(page_size)
+        if self._limit:
+            cursor = cursor.limit(self._limit)
+
+        uuids = []
+        for document in cursor:
+            uuid = document.get("_dataBlobID")
+            if uuid is None or str(uuid).startswith("_") or uuid in skip_uuids:
+                continue
+            uuids.append(uuid)
+            if len(uuids) >= page_size:
+                yield self.load_blobs(uuids)
+                uuids = []
+        if uuids:
+            yield self.load_blobs(uuids)
+
+    def load_blobs(self, uuids):
+        """ Build data blobs for the documents with the given ids, in the view's sort order """
+        blobs = []
+        for document in self._view.find({"_dataBlobID": {"$in": uuids}}).sort(self._sort):
+            blob = hybrid.data_blob.dict2blob(document)
+            if self._database is not None:
+                self._database.markDataBlobStored(blob)
+            blobs.append(blob)
+        return blobs
+
     def num_rows(self):
         ''' Get the number of rows contained in the results of the view. '''
         if self._row_dict is None:
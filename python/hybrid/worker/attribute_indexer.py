@@ -228,8 +228,30 @@ class attribute_indexer(modeling_worker):
         if not (model_observations_manager.isValid()):
             return False
 
-        # Get the valid rows (before something changes :/ )
-        model_observations = model_observations_manager.getRows()
+        if not self._incremental_update:
+            # Get the valid rows (before something changes :/ )
+            model_observations = model_observations_manager.getRows()
+        else:
+            # Only count the observations the index doesn't cover yet, reading the sources that have a
+            # server side position from the last update on. Positions are read before the observations so
+            # anything written meanwhile is seen (and skipped if it was counted) next time. Without a
+            # record of the counted observations the index is rebuilt from scratch.
+            positions = model_observations_manager.getRowPositions()
+            folded = old_model.getFoldedObservations()
+            if folded is None:
+                old_model.getParameters().setMetaData("value_index", {})
+                old_model.getParameters().setMetaData("processed_count", 0)
+                folded = set()
+                model_observations = model_observations_manager.getRows()
+            else:
+                model_observations = []
+                for page in model_observations_manager.iterRows(since=old_model.getObservationPositions(),
+                                                                skip_uuids=folded):
+                    model_observations.extend(page)
+
+            model_observations = self.get_new_model_observations(model_observations, folded)
+            old_model.setFoldedObservations(folded)
+            old_model.setObservationPositions(positions)
 
         model_observations = self.process_observations(model_observations, update_index=True)
 
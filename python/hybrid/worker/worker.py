@@ -115,6 +115,13 @@ class abstract_worker():
     def get_name(self):
         return self._name
 
+    def get_nest_name(self):
+        return self._current_nest_name
+
+    def get_worker_dependencies(self):
+        """ Names of the workers whose data this worker reads """
+        return self._worker_data_dependencies.keys()
+
     def get_version(self):
         return self._version
 
@@ -309,6 +316,9 @@ class modeling_worker(abstract_worker):
         self.set_uses_model(True)
         self._model_type = kwargs.get("model_type")
 
+        # Incremental updates fold in only the model observations the model hasn't been trained on yet
+        self._incremental_update = kwargs.get("incremental_update", False)
+
         if not (kwargs.get("model") is None):
             self.set_model(kwargs["model"])
         else:
@@ -329,7 +339,7 @@ class modeling_worker(abstract_worker):
         model_db_host = self._model_db_host
         model_db_name = self._model_db_name
 
-        model_db = db.init(model_db_type, host=model_db_host, database=model_db_name,
+        model_db = db.get_connection(model_db_type, host=model_db_host, database=model_db_name,
                            push_views=False, create=False, log_level=logging.DEBUG)
 
         return model_db
@@ -354,13 +364,32 @@ class modeling_worker(abstract_worker):
     def update_models(self, **kwargs):
         raise NotImplementedError("This method should be overloaded by the subclass.")
 
+    def get_new_model_observations(self, model_observations, folded):
+        """ Model observations not folded into the model yet, their uuids are added to folded """
+        new_observations = [observation for observation in model_observations
+                            if observation.getDataBlobUUID() not in folded]
+        folded.update(observation.getDataBlobUUID() for observation in new_observations)
+        return new_observations
+
+    def track_folded_observations(self, pages, model, folded):
+        """ Pass pages of model observations through, leaving out the ones in folded. Once the pages run
+            out the model records folded, with every observation passed through added, as the set of
+            observations it has been trained on. """
+        for page in pages:
+            new_observations = self.get_new_model_observations(page, folded)
+            if len(new_observations) > 0:
+                yield new_observations
+        model.setFoldedObservations(folded)
+
     def check_model_observations_current(self):
         worker_model = self.get_model()
         return worker_model.getModelObservationsCurrent()
 
     def check_hyperparameters(self, **kwargs):
-        # Making a deepcopy so that no non-picklable data is stored in the model    
-        model = copy.deepcopy(self.get_model())
+        # Work on a copy so that no non-picklable data is stored in the model. A shallow copy is
+        # enough since loadFromDB replaces the parameters rather than modifying them, and it avoids
+        # copying the (possibly large) parameters blob only to throw it away
+        model = copy.copy(self.get_model())
 
         model.loadFromDB()
         print "Checking hyperparams from worker perspective"
@@ -378,8 +407,10 @@ class modeling_worker(abstract_worker):
 
     def check_model(self, **kwargs):
 
-        # Making a deepcopy so that no non-picklable data is stored in the model    
-        model = copy.deepcopy(self.get_model())
+        # Work on a copy so that no non-picklable data is stored in the model. A shallow copy is
+        # enough since loadFromDB replaces the parameters rather than modifying them, and it avoids
+        # copying the (possibly large) parameters blob only to throw it away
+        model = copy.copy(self.get_model())
 
         model.loadFromDB()
 
@@ -28,6 +28,11 @@ class decision_tree_regressor_worker(modeling_worker):
       self._feature_vector_paths = kwargs.get("feature_vectors")
       self._truth_vector_paths = kwargs.get("truth_vectors")
 
+      # Explicit handling of missing and categorical feature values, see sklearn_utils.observations_to_array
+      self._field_defaults = kwargs.get("field_defaults")
+      self._missing_value = kwargs.get("missing_value", 0.0)
+      self._categories = kwargs.get("categories")
+
   @staticmethod
   def loadFromJSON(json_data):
       jsontype = json_data["_jsontype"]
@@ -37,19 +42,18 @@ class decision_tree_regressor_worker(modeling_worker):
       return decision_tree_regressor_worker(**json_data)
 
   def get_feature_vectors(self,observations):
-    model = self._model
-
-    feature_vectors = self._feature_vector_paths
-    observation_vector_dict = hybrid.utils.create_observation_data(observations, feature_vectors)
-    observation_array = sklearn_utils.observations_to_sklearn (observation_vector_dict, feature_vectors)
-    return observation_array
+    return sklearn_utils.observations_to_array (observations, self._feature_vector_paths,
+                                                field_defaults=self._field_defaults,
+                                                missing_value=self._missing_value,
+                                                categories=self._categories)
 
   def get_truth_vectors (self, observations):
-    model = self._model
-    truth_name_list = []
-
     truth_vectors = self._truth_vector_paths
-    truth_vector_dict = hybrid.utils.create_observation_data(observations, truth_vectors)
+    if (len (truth_vectors) == 1):
+      return sklearn_utils.observations_to_labels (observations, truth_vectors[0],
+                                                   field_defaults=self._field_defaults)
+
+    truth_vector_dict = hybrid.utils.create_observation_data(observations, truth_vectors, self._field_defaults or {})
     truth_array = sklearn_utils.observations_to_sklearn (truth_vector_dict, truth_vectors)
     return np.ravel (truth_array)
 
@@ -7,9 +7,12 @@ import hybrid
 from hybrid.worker.worker import modeling_worker
 from hybrid_sklearn import sklearn_utils
 from hybrid import view, data_blob
+from hybrid import logger
 
 import numpy as np
 
+logger = logger.logger()
+
 class gaussiannb_worker(modeling_worker):
   def __init__(self,**kwargs):
       # Call super class init first
@@ -27,6 +30,16 @@ class gaussiannb_worker(modeling_worker):
       self._feature_vector_paths = kwargs.get("feature_vectors")
       self._truth_vector_paths = kwargs.get("truth_vectors")
 
+      # Explicit handling of missing and categorical feature values, see sklearn_utils.observations_to_array
+      self._field_defaults = kwargs.get("field_defaults")
+      self._missing_value = kwargs.get("missing_value", 0.0)
+      self._categories = kwargs.get("categories")
+
+      # Streaming training pages through the model observations and calls partial_fit per page
+      self._streaming_update = kwargs.get("streaming_update", False)
+      self._streaming_page_size = kwargs.get("streaming_page_size", 1000)
+      self._classes = kwargs.get("classes")
+
   @staticmethod
   def loadFromJSON(json_data):
       jsontype = json_data["_jsontype"]
@@ -36,24 +49,31 @@ class gaussiannb_worker(modeling_worker):
       return gaussiannb_worker(**json_data)
 
   def get_feature_vectors(self,observations):
-    model = self._model
-
-    feature_vectors = self._feature_vector_paths
-
-    observation_vector_dict = hybrid.utils.create_observation_data(observations, feature_vectors)
-    observation_array = sklearn_utils.observations_to_sklearn (observation_vector_dict, feature_vectors)
-    return observation_array
+    return sklearn_utils.observations_to_array (observations, self._feature_vector_paths,
+                                                field_defaults=self._field_defaults,
+                                                missing_value=self._missing_value,
+                                                categories=self._categories)
 
   def get_truth_vectors (self, observations):
-    model = self._model
-    truth_name_list = []
-
     truth_vectors = self._truth_vector_paths
-    truth_vector_dict = hybrid.utils.create_observation_data(observations, truth_vectors)
+    if (len (truth_vectors) == 1):
+      return sklearn_utils.observations_to_labels (observations, truth_vectors[0],
+                                                   field_defaults=self._field_defaults)
+
+    truth_vector_dict = hybrid.utils.create_observation_data(observations, truth_vectors, self._field_defaults or {})
     truth_array = sklearn_utils.observations_to_sklearn (truth_vector_dict, truth_vectors)
     return np.ravel (truth_array)
 
   def update_model(self):
+    if (self._incremental_update):
+      updated = self.update_model_incremental ()
+      if (updated != None):
+        return updated
+      logger.logMessage ("info", "Incremental update not possible, retraining %s from scratch" % (self.get_name (),))
+
+    if (self._streaming_update):
+      return self.update_model_streaming ()
+
     old_model = self._model
 
     model_observations = None
@@ -65,6 +85,13 @@ class gaussiannb_worker(modeling_worker):
 
       if not model_observations_manager.isUpdated ():
         model_observations_manager.update ()
+
+    # Positions are read before the observations, anything written meanwhile is seen again next time
+    positions = None
+    if (self._incremental_update):
+      positions = self.get_model_observation_positions ()
+
+    if (self._model_observations_query_info == None):
       model_observations = model_observations_manager.getRows ()
     else:
       # else  use the old style of update
@@ -85,9 +112,112 @@ class gaussiannb_worker(modeling_worker):
     model.setDBHost (self._model_db_host)
     model.setDBName (self._model_db_name)
 
+    if (self._incremental_update):
+      model.setObservationPositions (positions)
+      model.setFoldedObservations (set (observation.getDataBlobUUID () for observation in model_observations))
+
     model.setModelData (model_data)
     return model.update ()
 
+  def get_model_observation_positions(self):
+    if (self._model_observations_query_info == None):
+      return self._model.getModelObservationsManager().getRowPositions ()
+
+    model_documents_view = view.create_view_from_query_info(self._model_observations_query_info)
+    return {"query": model_documents_view.position ()}
+
+  def iter_model_observation_pages(self, since=None, skip_uuids=None):
+    if (self._model_observations_query_info == None):
+      model_observations_manager = self._model.getModelObservationsManager()
+      return model_observations_manager.iterRows (page_size=self._streaming_page_size, since=since,
+                                                  skip_uuids=skip_uuids)
+
+    if (since == None):
+      since = {}
+    model_documents_view = view.create_view_from_query_info(self._model_observations_query_info)
+    return model_documents_view.iterpages (page_size=self._streaming_page_size, since=since.get ("query"),
+                                           skip_uuids=skip_uuids)
+
+  def update_model_streaming(self):
+    ''' Train one page of model observations at a time with partial_fit, so memory use is
+        bounded by streaming_page_size rather than by the size of the training corpus '''
+    old_model = self._model
+
+    if (self._model_observations_query_info == None):
+      model_observations_manager = old_model.getModelObservationsManager()
+
+      if not model_observations_manager.isValid():
+        return False
+
+      if not model_observations_manager.isUpdated ():
+        model_observations_manager.update ()
+
+    positions = None
+    if (self._incremental_update):
+      positions = self.get_model_observation_positions ()
+
+    # partial_fit needs every class up front, make a pass over the labels if they weren't configured
+    classes = self._classes
+    if (classes == None):
+      labels = set ()
+      for page in self.iter_model_observation_pages ():
+        labels.update (self.get_truth_vectors (page))
+      classes = sorted (labels)
+
+    model = self._model_type (old_model._parameters_uuid)
+    model._parameters = old_model._parameters
+
+    model.setDBType (self._model_db_type)
+    model.setDBHost (self._model_db_host)
+    model.setDBName (self._model_db_name)
+
+    pages = self.iter_model_observation_pages ()
+    if (self._incremental_update):
+      model.setObservationPositions (positions)
+      pages = self.track_folded_observations (pages, model, set ())
+
+    chunks = ((self.get_feature_vectors (page), self.get_truth_vectors (page)) for page in pages)
+
+    return model.partial_update (chunks, np.array (classes))
+
+  def update_model_incremental(self):
+    ''' Fold only the model observations the model hasn't been trained on into it. The sources that
+        have a server side position are only read from the position of the last update on, the
+        observations already folded in are skipped by uuid (so documents that are written again are
+        never counted twice). Returns None if a full update is needed instead (no record of the
+        folded observations or no trained model yet, or classes the model hasn't seen) '''
+    old_model = self._model
+
+    folded = old_model.getFoldedObservations ()
+    if (folded == None):
+      return None
+
+    if (self._model_observations_query_info == None):
+      model_observations_manager = old_model.getModelObservationsManager()
+
+      if not model_observations_manager.isValid():
+        return False
+
+      if not model_observations_manager.isUpdated ():
+        model_observations_manager.update ()
+
+    positions = self.get_model_observation_positions ()
+    pages = self.iter_model_observation_pages (since=old_model.getObservationPositions (), skip_uuids=folded)
+
+    model = self._model_type (old_model._parameters_uuid)
+    model._parameters = old_model._parameters
+
+    model.setDBType (self._model_db_type)
+    model.setDBHost (self._model_db_host)
+    model.setDBName (self._model_db_name)
+
+    model.setObservationPositions (positions)
+    pages = self.track_folded_observations (pages, model, folded)
+
+    chunks = ((self.get_feature_vectors (page), self.get_truth_vectors (page)) for page in pages)
+
+    return model.incremental_update (chunks)
+
   def process_observations_core(self, observations, **kwargs):
     model = self.loadModel ()
 
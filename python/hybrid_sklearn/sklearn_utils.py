@@ -3,9 +3,14 @@ Copyright 2017 Sandia Corporation.
 Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
 the U.S. Government retains certain rights in this software.
 """
+import collections
+import hashlib
 import pickle
+import threading
 
+import numpy as np
 from hybrid import logger
+from hybrid import utils
 from hybrid.model import model
 from sklearn.linear_model import LogisticRegression
 from sklearn.naive_bayes import GaussianNB
@@ -14,6 +19,58 @@ from sklearn.tree import DecisionTreeRegressor
 
 logger = logger.logger()
 
+# Fitted estimators unpickled from model parameters, most recently used last.
+# Keyed by a digest of the pickle so a retrained model can never be served stale.
+ESTIMATOR_CACHE_BYTES = 512 * 1024 * 1024
+_estimator_cache = collections.OrderedDict()
+_estimator_cache_bytes = 0
+
+# id() of each pickle string held by the cache -> its digest, so an unchanged
+# parameters blob does not have to be hashed again on every batch
+_estimator_digests = {}
+
+# Workers of a level load estimators from several threads (see manager.evaluateWorkerLevels)
+_estimator_lock = threading.Lock ()
+
+def load_estimator (params, field):
+  ''' Return the fitted estimator pickled in the binary field of params, unpickling
+      it only if the same pickle has not been loaded before in this process '''
+  global _estimator_cache_bytes
+
+  data = params.getBinaryData (field)
+  with _estimator_lock:
+    digest = _estimator_digests.get (id (data))
+    if (digest is None) or not (_estimator_cache[digest]["source"] is data):
+      digest = hashlib.sha1 (data).hexdigest ()
+
+    entry = _estimator_cache.pop (digest, None)
+    if (entry is None):
+      # The pickle is kept alive with the estimator, so count it twice
+      entry = {"estimator": pickle.loads (data), "source": data, "size": 2 * len (data)}
+      _estimator_cache_bytes += entry["size"]
+    else:
+      _estimator_digests.pop (id (entry["source"]), None)
+      entry["source"] = data
+
+    _estimator_cache[digest] = entry
+    _estimator_digests[id (data)] = digest
+
+    # Evict least recently used estimators, always keeping the one just requested
+    while (_estimator_cache_bytes > ESTIMATOR_CACHE_BYTES) and (len (_estimator_cache) > 1):
+      evicted_digest, evicted = _estimator_cache.popitem (last=False)
+      _estimator_digests.pop (id (evicted["source"]), None)
+      _estimator_cache_bytes -= evicted["size"]
+
+    return entry["estimator"]
+
+def clear_estimator_cache ():
+  ''' Drop every cached estimator in this process '''
+  global _estimator_cache_bytes
+  with _estimator_lock:
+    _estimator_cache.clear ()
+    _estimator_digests.clear ()
+    _estimator_cache_bytes = 0
+
 def observations_to_sklearn (observations, field_definitions):
   skobs = []
   for observation in observations:
@@ -26,6 +83,97 @@ def observations_to_sklearn (observations, field_definitions):
     skobs.append (skob)
   return skobs
 
+def observations_to_array (observations, field_names, field_defaults=None, missing_value=0.0, categories=None):
+  ''' Fill a preallocated (observations x fields) float array straight from the observation
+      data blobs, one column at a time, parsing each field path only once.
+      Input:
+          observations:   list of data blobs
+          field_names:    field paths, as used by utils.get_field_value
+          field_defaults: per field defaults, as used by utils.get_field_value
+          missing_value:  value for fields that are missing and have no default
+          categories:     dict of field name -> list of known values; those fields are
+                          encoded as the index of their value in the list, unknown
+                          values are treated as missing
+  '''
+  if (categories == None):
+    categories = {}
+
+  meta_dicts = [observation.getMetaDataDict () for observation in observations]
+  array = np.empty ((len (meta_dicts), len (field_names)), dtype=np.float64)
+
+  for column, accessor in enumerate (utils.compile_field_accessors (field_names, field_defaults)):
+    category_index = None
+    if (accessor.field_name in categories):
+      category_index = dict ((value, index) for index, value in enumerate (categories[accessor.field_name]))
+
+    values = array[:, column]
+    for row, meta_dict in enumerate (meta_dicts):
+      value = accessor (meta_dict)
+      if (category_index != None):
+        value = category_index.get (value)
+      if (value == None):
+        values[row] = missing_value
+        continue
+      try:
+        values[row] = float (value)
+      except (TypeError, ValueError):
+        raise ValueError ("Field %s has non numeric value %r, list its values in categories to encode it"
+                          % (accessor.field_name, value))
+  return array
+
+def observations_to_labels (observations, field_name, field_defaults=None, missing_label=None):
+  ''' Build a label array from a single field of the observation data blobs. Labels that
+      look numeric are converted to float, as observations_to_sklearn does.
+      Input:
+          observations:   list of data blobs
+          field_name:     field path of the label
+          field_defaults: per field defaults, as used by utils.get_field_value
+          missing_label:  label for observations where the field is missing and has no default
+  '''
+  accessor = utils.field_accessor (field_name, field_defaults)
+  labels = []
+  for observation in observations:
+    label = accessor (observation.getMetaDataDict ())
+    if (label == None):
+      label = missing_label
+    try:
+      label = float (label)
+    except (TypeError, ValueError):
+      pass
+    labels.append (label)
+  return np.array (labels)
+
+def partial_fit_chunks (estimator, chunks, classes):
+  ''' Feed (observation_vectors, truth_vectors) chunks to estimator.partial_fit one at a time.
+      Returns False if there was nothing to fit. '''
+  fitted = False
+  for observation_vectors, truth_vectors in chunks:
+    if (len (truth_vectors) == 0):
+      continue
+    estimator.partial_fit (observation_vectors, truth_vectors, classes=classes)
+    fitted = True
+  if not (fitted):
+    logger.logMessage ("warning", "No model observations to fit")
+  return fitted
+
+def incremental_fit (params, field, chunks):
+  ''' Continue training the estimator pickled in the binary field of params with partial_fit over
+      more (observation_vectors, truth_vectors) chunks. Returns the estimator, or None if it can't
+      absorb the chunks (there is no fitted estimator yet, or a chunk has a class it was never given) '''
+  if not (params.hasBinaryData (field)):
+    return None
+
+  # Unpickle a private copy, the one from load_estimator is shared by everything scoring with it
+  estimator = pickle.loads (params.getBinaryData (field))
+  for observation_vectors, truth_vectors in chunks:
+    if (len (truth_vectors) == 0):
+      continue
+    if not (np.all (np.in1d (truth_vectors, estimator.classes_))):
+      logger.logMessage ("warning", "New model observations have classes the model was not trained with")
+      return None
+    estimator.partial_fit (observation_vectors, truth_vectors)
+  return estimator
+
 class gaussian_nb_model(model):
   ''' Gaussian Naive Bayes Model '''
 
@@ -80,7 +228,40 @@ class gaussian_nb_model(model):
     gnb.fit (observation_vectors, truth_vectors)
     params.setBinaryData ("gnb_model", "application/pickle", pickle.dumps (gnb))
 
+    return self.finalize ()
+
+  def partial_update(self, chunks, classes):
+    ''' Streaming alternative to update, fits the model with partial_fit over an iterable
+        of (observation_vectors, truth_vectors) chunks instead of one model data blob
+        Input:
+            chunks:  iterable of (observation_vectors, truth_vectors) pairs
+            classes: every class label that can appear in the truth vectors
+    '''
+    params = self._parameters
+    params.validateMeta()
+    params.setMetaData("db_views", [])
+
+    gnb = GaussianNB ()
+    if not (partial_fit_chunks (gnb, chunks, classes)):
+      return False
+    params.setBinaryData ("gnb_model", "application/pickle", pickle.dumps (gnb))
+
+    self.finalize ()
+    return True
+
+  def incremental_update(self, chunks):
+    ''' Fold more (observation_vectors, truth_vectors) chunks into the already trained model.
+        Returns None if the model can't be updated incrementally and needs a full update '''
+    params = self._parameters
+    params.validateMeta()
+
+    gnb = incremental_fit (params, "gnb_model", chunks)
+    if (gnb == None):
+      return None
+    params.setBinaryData ("gnb_model", "application/pickle", pickle.dumps (gnb))
+
     self.finalize ()
+    return True
 
   def project_and_store(self,model_data,model_data_db):
     observation_vectors = self._model_data.getMetaData("observation_vectors")
@@ -90,7 +271,7 @@ class gaussian_nb_model(model):
     # Make sure all my meta data is ready to go
     params.validateMeta()
 
-    gnb = pickle.loads (params.getBinaryData ("gnb_model"))
+    gnb = load_estimator (params, "gnb_model")
 
     results = gnb.predict (observation_vectors)
     params.setMetaData ("gnb_results", results)
@@ -146,6 +327,14 @@ class multinomial_nb_model(model):
     params.setMetaData("db_views", [])
 
     # Houston we are go
+    mnb = self.create_estimator ()
+
+    mnb.fit (observation_vectors, truth_vectors)
+    params.setBinaryData ("mnb_model", "application/pickle", pickle.dumps (mnb))
+
+    return self.finalize ()
+
+  def create_estimator(self):
     mnb = MultinomialNB ()
 
     mnb.alpha = self.getMetaData ("alpha")
@@ -153,11 +342,34 @@ class multinomial_nb_model(model):
     class_prior = self.getMetaData ("class_prior")
     if (class_prior != None):
       mnb.class_prior = class_prior
+    return mnb
 
-    mnb.fit (observation_vectors, truth_vectors)
+  def partial_update(self, chunks, classes):
+    ''' Streaming alternative to update, see gaussian_nb_model.partial_update '''
+    params = self._parameters
+    params.validateMeta()
+    params.setMetaData("db_views", [])
+
+    mnb = self.create_estimator ()
+    if not (partial_fit_chunks (mnb, chunks, classes)):
+      return False
     params.setBinaryData ("mnb_model", "application/pickle", pickle.dumps (mnb))
 
     self.finalize ()
+    return True
+
+  def incremental_update(self, chunks):
+    ''' See gaussian_nb_model.incremental_update '''
+    params = self._parameters
+    params.validateMeta()
+
+    mnb = incremental_fit (params, "mnb_model", chunks)
+    if (mnb == None):
+      return None
+    params.setBinaryData ("mnb_model", "application/pickle", pickle.dumps (mnb))
+
+    self.finalize ()
+    return True
 
   def project_and_store(self,model_data,model_data_db):
     observation_vectors = self._model_data.getMetaData("observation_vectors")
@@ -167,7 +379,7 @@ class multinomial_nb_model(model):
     # Make sure all my meta data is ready to go
     params.validateMeta()
 
-    mnb = pickle.loads (params.getBinaryData ("mnb_model"))
+    mnb = load_estimator (params, "mnb_model")
 
     results = mnb.predict (observation_vectors)
     params.setMetaData ("mnb_results", results)
@@ -267,7 +479,7 @@ class logistic_regression_model(model):
     lr.fit (observation_vectors, truth_vectors)
     params.setBinaryData ("lr_model", "application/pickle", pickle.dumps (lr))
 
-    self.finalize ()
+    return self.finalize ()
 
   def project_and_store(self,model_data,model_data_db):
     observation_vectors = self._model_data.getMetaData("observation_vectors")
@@ -277,7 +489,7 @@ class logistic_regression_model(model):
     # Make sure all my meta data is ready to go
     params.validateMeta()
 
-    lr = pickle.loads (params.getBinaryData ("lr_model"))
+    lr = load_estimator (params, "lr_model")
 
     results = lr.predict (observation_vectors)
     probs = lr.predict_proba (observation_vectors)
@@ -376,7 +588,7 @@ class decision_tree_regressor_model(model):
 
     params.setBinaryData ("dtr_model", "application/pickle", pickle.dumps(dtr))
 
-    self.finalize ()
+    return self.finalize ()
 
   def project_and_store(self,model_data,model_data_db):
     observation_vectors = self._model_data.getMetaData("observation_vectors")
@@ -386,7 +598,7 @@ class decision_tree_regressor_model(model):
     # Make sure all my meta data is ready to go
     params.validateMeta()
 
-    dtr = pickle.loads (params.getBinaryData ("dtr_model"))
+    dtr = load_estimator (params, "dtr_model")
 
     results = dtr.predict (observation_vectors)
     params.setMetaData ("dtr_results", results)
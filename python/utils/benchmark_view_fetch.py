@@ -0,0 +1,212 @@
+#
+# Benchmark per document loads against bulk loads for view rows
+#
+"""
+Copyright 2017 Sandia Corporation.
+Under the terms of Contract DE-AC04-94AL85000 with Sandia Corporation,
+the U.S. Government retains certain rights in this software.
+"""
+import BaseHTTPServer
+import SocketServer
+import base64
+import json
+import optparse
+import os
+import sys
+import threading
+import time
+import urlparse
+
+from hybrid import db
+
+
+class couch_stand_in_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Tiny in-memory stand-in for the parts of the CouchDB HTTP API used by hybrid.db.couchdb """
+
+    protocol_version = "HTTP/1.1"
+
+    # Buffer the response so headers and body go out together
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        return
+
+    def _reply(self, code, body=None):
+        time.sleep(self.server.latency)
+        self.server.count(self.command, self.path)
+        content = ""
+        if body is not None:
+            content = json.dumps(body)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def _parse(self):
+        url = urlparse.urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        params = dict(urlparse.parse_qsl(url.query))
+        return parts, params
+
+    def _doc(self, db_name, doc_id, attachments):
+        doc = self.server.databases[db_name].get(doc_id)
+        if doc is None:
+            return None
+        doc = dict(doc)
+        if "_attachments" in doc:
+            stubs = {}
+            for name, attachment in doc["_attachments"].iteritems():
+                stub = {"content_type": attachment["content_type"], "length": len(attachment["data"])}
+                if attachments:
+                    stub["data"] = base64.b64encode(attachment["data"])
+                else:
+                    stub["stub"] = True
+                stubs[name] = stub
+            doc["_attachments"] = stubs
+        return doc
+
+    def _all_docs(self, db_name, params, keys):
+        include_docs = params.get("include_docs") == "true"
+        attachments = params.get("attachments") == "true"
+        database = self.server.databases[db_name]
+        if keys is None:
+            keys = sorted(database.keys())
+            if "limit" in params:
+                keys = keys[:int(params["limit"])]
+        rows = []
+        for key in keys:
+            if key not in database:
+                rows.append({"key": key, "error": "not_found"})
+                continue
+            row = {"id": key, "key": key, "value": {"rev": database[key]["_rev"]}}
+            if include_docs:
+                row["doc"] = self._doc(db_name, key, attachments)
+            rows.append(row)
+        return {"total_rows": len(database), "offset": 0, "rows": rows}
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        parts, params = self._parse()
+        if len(parts) == 0:
+            return self._reply(200, {"couchdb": "Welcome", "version": "stand-in"})
+        db_name = parts[0]
+        if db_name not in self.server.databases:
+            return self._reply(404, {"error": "not_found", "reason": "no_db_file"})
+        if len(parts) == 1:
+            return self._reply(200, {"db_name": db_name, "doc_count": len(self.server.databases[db_name])})
+        if parts[1] == "_all_docs":
+            return self._reply(200, self._all_docs(db_name, params, None))
+        doc = self._doc(db_name, "/".join(parts[1:]), params.get("attachments") == "true")
+        if doc is None:
+            return self._reply(404, {"error": "not_found", "reason": "missing"})
+        return self._reply(200, doc)
+
+    def do_POST(self):
+        parts, params = self._parse()
+        length = int(self.headers.getheader("content-length", 0))
+        body = json.loads(self.rfile.read(length))
+        if len(parts) == 2 and parts[1] == "_all_docs":
+            return self._reply(200, self._all_docs(parts[0], params, body.get("keys")))
+        return self._reply(404, {"error": "not_found", "reason": "unsupported"})
+
+
+class couch_stand_in(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), couch_stand_in_handler)
+        self.latency = latency
+        self.databases = {}
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % (self.server_address[1],)
+
+    def count(self, method, path):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def handle_error(self, request, client_address):
+        # Keep-alive connections are dropped when the benchmark exits
+        return
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests = {}
+
+    def populate(self, db_name, num_docs, attachment_size):
+        documents = {}
+        for i in range(num_docs):
+            doc_id = "doc%08d" % (i,)
+            documents[doc_id] = {"_id": doc_id, "_rev": "1-0", "_dataBlobID": doc_id, "type": "unknown",
+                                 "created": "2017-01-01 00:00", "text": "document %d" % (i,),
+                                 "_attachments": {"contents": {"content_type": "text/plain",
+                                                               "data": os.urandom(attachment_size)}}}
+        self.databases[db_name] = documents
+        return sorted(documents.keys())
+
+
+def time_call(server, func):
+    server.reset_counts()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.time()
+        blobs = func()
+        elapsed = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return len(blobs), elapsed, sum(server.requests.itervalues()), dict(server.requests)
+
+
+if __name__ == "__main__":
+
+    # Handle command-line arguments
+    parser = optparse.OptionParser()
+    parser.add_option("--documents", type="int", default=1000, help="Number of view rows to load.  Default: %default")
+    parser.add_option("--attachment-size", type="int", default=1024,
+                      help="Size in bytes of each document attachment.  Default: %default")
+    parser.add_option("--page-size", type="int", default=250,
+                      help="Documents per bulk request.  Default: %default")
+    parser.add_option("--latency-ms", type="float", default=1.0,
+                      help="Simulated server latency per request in milliseconds.  Default: %default")
+    (options, arguments) = parser.parse_args()
+
+    server = couch_stand_in(options.latency_ms / 1000.0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    uuids = server.populate("benchmark", options.documents, options.attachment_size)
+    database = db.init("couchdb", host=server.url, database="benchmark", create=False, push_views=False)
+
+    def per_document():
+        blobs = []
+        for uuid in uuids:
+            blobs.append(database.loadDataBlob(uuid, include_binary=True))
+        return blobs
+
+    def bulk():
+        blobs, missing = database.loadDataBlobArray(uuids, include_binary=True, page_size=options.page_size)
+        return blobs
+
+    print "%d documents, %d byte attachments, %.1fms latency per request" % (
+        options.documents, options.attachment_size, options.latency_ms)
+    for name, func in [("loadDataBlob per row", per_document), ("loadDataBlobArray", bulk)]:
+        num_blobs, elapsed, num_requests, requests = time_call(server, func)
+        print "%-22s blobs=%-6d requests=%-6d wall=%.3fs %s" % (name, num_blobs, num_requests, elapsed,
+                                                                 requests)
+
+    server.shutdown()
+    server.server_close()
+
+    # Skip interpreter teardown while keep-alive handler threads are still blocked on their sockets
+    sys.stdout.flush()
+    os._exit(0)